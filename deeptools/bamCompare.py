@@ -304,6 +304,7 @@ def main(args=None):
 
     """
     args = process_args(args)
+    parserCommon.apply_run_options(args)
 
     scale_factors = get_scale_factors(args)
     if args.verbose:
@@ -98,6 +98,17 @@ def get_optional_args():
                           choices=['forward', 'reverse'],
                           default=None)
 
+    optional.add_argument('--additionalOutput',
+                          help='Additional output files, each with its own bin size, '
+                          'given as FILE:BINSIZE (e.g. coverage.50bp.bw:50). The coverage '
+                          'of every output is computed from the same pass over the BAM file, '
+                          'with the same filters and normalization, and written in the '
+                          'format of --outFileFormat.',
+                          metavar='FILE:BINSIZE',
+                          nargs='+',
+                          type=outputBinSize,
+                          default=None)
+
     return parser
 
 
@@ -113,6 +124,20 @@ def scaleFactor(string):
     return scalefactors
 
 
+def outputBinSize(string):
+    try:
+        fileName, binSize = string.rsplit(":", 1)
+        binSize = int(binSize)
+        if not fileName or binSize <= 0:
+            raise ValueError
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "Format of additionalOutput is file:binSize, with a positive "
+            "binSize. The value given ( {} ) is not valid".format(string))
+
+    return fileName, binSize
+
+
 def process_args(args=None):
     args = parseArguments().parse_args(args)
 
@@ -128,6 +153,7 @@ def process_args(args=None):
 
 def main(args=None):
     args = process_args(args)
+    parserCommon.apply_run_options(args)
 
     global debug
     if args.verbose:
@@ -234,7 +260,8 @@ def main(args=None):
 
     wr.run(writeBedGraph.scaleCoverage, func_args, args.outFileName,
            blackListFileName=args.blackListFileName,
-           format=args.outFileFormat, smoothLength=args.smoothLength)
+           format=args.outFileFormat, smoothLength=args.smoothLength,
+           additionalOutputs=args.additionalOutput)
 
 
 class OffsetFragment(writeBedGraph.WriteBedGraph):
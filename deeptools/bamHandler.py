@@ -1,11 +1,20 @@
 import sys
 import pysam
 
+from deeptools import threadBudget
 
-def openBam(bamFile):
+
+def openBam(bamFile, threads=None):
+    """
+    Opens an indexed BAM file. The BGZF blocks are decompressed with
+    `threads` extra htslib threads, by default those given to the
+    current task by mapReduce (see threadBudget).
+    """
+    if threads is None:
+        threads = threadBudget.threadsFor(bamFile)
 
     try:
-        bam = pysam.Samfile(bamFile, 'rb')
+        bam = _samfile(bamFile, 'rb', threads)
     except IOError:
         sys.exit("The file {} does not exist".format(bamFile))
     except:
@@ -27,3 +36,21 @@ def openBam(bamFile):
                  "it contains mapped reads.".format(bamFile))
 
     return bam
+
+
+def openBamWriter(fileName, template, threads=0):
+    """
+    Opens a BAM file for writing, with the header of template. The BGZF
+    blocks are compressed with `threads` extra htslib threads.
+    """
+    return _samfile(fileName, 'wb', threads, template=template)
+
+
+def _samfile(fileName, mode, threads, **kwargs):
+    if threads > 0:
+        try:
+            return pysam.Samfile(fileName, mode, threads=threads, **kwargs)
+        except TypeError:
+            # pysam < 0.10 has no threads option
+            pass
+    return pysam.Samfile(fileName, mode, **kwargs)
@@ -82,6 +82,7 @@ def parse_arguments(args=None):
 
 def main(args=None):
     args = parse_arguments().parse_args(args)
+    parserCommon.apply_run_options(args)
 
     if args.scaleFactors:
         scaleFactors = [float(x) for x in args.scaleFactors.split(":")]
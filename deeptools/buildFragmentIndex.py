@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import sys
+import multiprocessing
+
+from deeptools import fragmentIndex
+from deeptools._version import __version__
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+This tool saves the alignments of BAM files in a columnar index (a <file>.bam.dtfrag
+directory next to each BAM file) that the tools computing read coverages from
+BAM files (e.g. bamCoverage, bamCompare, multiBamSummary and plotFingerprint)
+use instead of decoding the alignments again, as long as the BAM file is
+not modified after the index is built.
+
+The index takes about 100 bytes per alignment.
+
+detailed usage help:
+  $ buildFragmentIndex -h
+
+""",
+        usage='An example usage is:'
+        '$ buildFragmentIndex -b reads1.bam reads2.bam')
+
+    parser.add_argument('--bamfiles', '-b',
+                        metavar='FILE1 FILE2',
+                        help='List of indexed bam files separated by spaces.',
+                        nargs='+',
+                        required=True)
+
+    parser.add_argument('--numberOfProcessors', '-p',
+                        help='Number of BAM files to index at the same time. '
+                        'The default is to use 1.',
+                        metavar="INT",
+                        type=int,
+                        default=1,
+                        required=False)
+
+    parser.add_argument('--verbose', '-v',
+                        help='Set to see processing messages.',
+                        action='store_true')
+
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s {}'.format(__version__))
+
+    return parser
+
+
+def buildIndex_wrapper(args):
+    bamFile, verbose = args
+    fragmentIndex.build(bamFile, verbose=verbose)
+    if verbose:
+        sys.stderr.write("{} indexed\n".format(bamFile))
+    return fragmentIndex.indexDir(bamFile)
+
+
+def main(args=None):
+    if args is None and len(sys.argv) == 1:
+        args = ["--help"]
+    args = parse_arguments().parse_args(args)
+
+    tasks = [(bamFile, args.verbose) for bamFile in args.bamfiles]
+    if args.numberOfProcessors > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(args.numberOfProcessors, len(tasks)))
+        res = pool.map_async(buildIndex_wrapper, tasks).get(9999999)
+        pool.close()
+    else:
+        res = [buildIndex_wrapper(x) for x in tasks]
+
+    for directory in res:
+        print(directory)
@@ -0,0 +1,227 @@
+import os
+import sys
+import shutil
+import hashlib
+import pickle
+import time
+import types
+import numpy as np
+
+# files modified after this time are outputs of the
+# current run, and are not part of the fingerprints
+_start_time = time.time()
+
+# attributes (e.g. of the parsed command line arguments) that
+# do not change the results, and are not part of the keys
+IGNORED_ATTRIBUTES = ('workDir', 'resume', 'numberOfProcessors',
+                      'executor', 'verbose', 'trace')
+
+
+class Checkpoint(object):
+    r"""
+    Saves the result of each task of a mapReduce call in a work
+    directory, such that a run that is restarted can skip the tasks
+    that were already completed.
+
+    A result is stored under a key derived from the function that is
+    called, the task (chrom, start, end and bed regions), the static
+    arguments, the attributes of the `self_` object and the size and
+    modification time of all the files they mention. If any of these
+    change, the previous results are not used.
+
+    Files returned by the workers (e.g. the temporary bedGraph files) are
+    copied into the work directory. When a result is loaded, the files
+    are copied again to new temporary files, thus the caller can remove
+    them as usual.
+
+    Each result is written to a temporary name and then renamed, such that
+    a run that is killed never leaves a partial result behind.
+
+    >>> import tempfile
+    >>> workDir = tempfile.mkdtemp()
+    >>> c = Checkpoint(workDir, True, abs, [1, 2])
+    >>> key = c.key(('chr1', 0, 100))
+    >>> c.load(key) is None
+    True
+    >>> c.submit(None, len, ('chr1', 0, 100)).get()
+    3
+    >>> c.load(key)
+    (3,)
+    >>> c.submit(None, None, ('chr1', 0, 100)).get()
+    3
+    >>> shutil.rmtree(workDir)
+    """
+
+    def __init__(self, workDir, resume, func, staticArgs, self_=None):
+        self.workDir = workDir
+        self.resume = resume
+        if not os.path.isdir(workDir):
+            os.makedirs(workDir)
+        context = [_stableRepr(func), _stableRepr(staticArgs),
+                   _stableRepr(self_),
+                   _stableRepr(fileFingerprints([staticArgs, self_]))]
+        self.context = hashlib.sha1("\n".join(context).encode('utf-8')).hexdigest()
+
+    def key(self, task):
+        """
+        Returns the key of the task (chrom, start, end[, bed regions])
+        """
+        return hashlib.sha1((self.context + _stableRepr(task)).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.workDir, key + ".pickle")
+
+    def load(self, key):
+        """
+        Returns the result stored under key, wrapped in a tuple, or None if
+        there is no such result (or if resuming is not requested).
+        """
+        if not self.resume or not os.path.exists(self._path(key)):
+            return None
+        with open(self._path(key), 'rb') as fh:
+            result = pickle.load(fh)
+        return (_mapFiles(result, _restoreFile),)
+
+    def commit(self, key, result):
+        """
+        Stores the result of a task under key
+        """
+        try:
+            counter = [0]
+
+            def saveFile(fileName):
+                counter[0] += 1
+                dest = os.path.join(self.workDir, "{}.{}{}".format(
+                    key, counter[0], os.path.splitext(fileName)[1]))
+                shutil.copyfile(fileName, dest + ".tmp")
+                os.rename(dest + ".tmp", dest)
+                return dest
+
+            stored = _mapFiles(result, saveFile)
+            with open(self._path(key) + ".tmp", 'wb') as fh:
+                pickle.dump(stored, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(self._path(key) + ".tmp", self._path(key))
+        except Exception as e:
+            # a failed commit only means that the task will
+            # be computed again
+            sys.stderr.write("Warning: could not save the result "
+                             "of a task in {}: {}\n".format(self.workDir, e))
+
+    def submit(self, pool, func, task):
+        """
+        Returns an object whose get() method returns the result of func(task).
+
+        The result is loaded from the work directory, if available, or
+        otherwise computed in the pool (or in this process, if pool is None)
+        and then stored.
+        """
+        key = self.key(task)
+        stored = self.load(key)
+        if stored is not None:
+            return _Ready(stored[0])
+        if pool is None:
+            result = func(task)
+            self.commit(key, result)
+            return _Ready(result)
+        # the callback is run by the pool, in this process, as
+        # soon as the task is done and before get() returns
+        return pool.apply_async(func, (task,),
+                                callback=lambda result: self.commit(key, result))
+
+
+class _Ready(object):
+    """
+    Same interface as the AsyncResult of a pool
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self, timeout=None):
+        return self.value
+
+
+def fileFingerprints(obj):
+    """
+    Returns a sorted list of (path, size, mtime) for all the existing files
+    mentioned in obj (which can be a nested structure of lists, tuples,
+    dictionaries and objects). Files modified after the start of the run
+    (i.e. output files) are skipped.
+
+    >>> fileFingerprints(['/nonexistent', {'a': 1}])
+    []
+    """
+    files = set()
+    _walkStrings(obj, files.add)
+    fingerprints = []
+    for fileName in files:
+        if os.path.isfile(fileName):
+            stat = os.stat(fileName)
+            if stat.st_mtime >= _start_time:
+                continue
+            fingerprints.append((os.path.abspath(fileName), stat.st_size, stat.st_mtime))
+    return sorted(fingerprints)
+
+
+def _walkStrings(obj, func, depth=0):
+    if depth > 10:
+        return
+    if isinstance(obj, str):
+        func(obj)
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            _walkStrings(value, func, depth + 1)
+    elif isinstance(obj, (list, tuple, set)):
+        for value in obj:
+            _walkStrings(value, func, depth + 1)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, (types.FunctionType, types.ModuleType, type)):
+        _walkStrings(vars(obj), func, depth + 1)
+
+
+def _mapFiles(result, func):
+    """
+    Applies func to all the strings in result that are
+    absolute paths of existing files
+    """
+    if isinstance(result, str):
+        if os.path.isabs(result) and os.path.isfile(result):
+            return func(result)
+        return result
+    elif isinstance(result, tuple):
+        return tuple(_mapFiles(x, func) for x in result)
+    elif isinstance(result, list):
+        return [_mapFiles(x, func) for x in result]
+    return result
+
+
+def _restoreFile(fileName):
+    from deeptools.utilities import getTempFileName
+    dest = getTempFileName(suffix=os.path.splitext(fileName)[1])
+    shutil.copyfile(fileName, dest)
+    return dest
+
+
+def _stableRepr(obj, depth=0):
+    """
+    Like repr, but without memory addresses, such that it is
+    the same from one run to the next
+
+    >>> _stableRepr({'b': [1, 2.5], 'a': (None, 'x'), 'f': np.mean})
+    "{'a':[None,'x'],'b':[1,2.5],'f':numpy.mean}"
+    """
+    if depth > 10:
+        return '...'
+    if isinstance(obj, dict):
+        items = sorted((_stableRepr(k, depth + 1), _stableRepr(v, depth + 1)) for k, v in obj.items())
+        return "{" + ",".join("{}:{}".format(k, v) for k, v in items) + "}"
+    elif isinstance(obj, (list, tuple)):
+        return "[" + ",".join(_stableRepr(x, depth + 1) for x in obj) + "]"
+    elif isinstance(obj, np.ndarray):
+        return "array:{}:{}:{}".format(obj.dtype, obj.shape,
+                                       hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest())
+    elif callable(obj) and hasattr(obj, '__module__') and hasattr(obj, '__name__'):
+        return "{}.{}".format(obj.__module__, obj.__name__)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, types.ModuleType):
+        attributes = dict((k, v) for k, v in vars(obj).items() if k not in IGNORED_ATTRIBUTES)
+        return obj.__class__.__name__ + _stableRepr(attributes, depth + 1)
+    return repr(obj)
@@ -0,0 +1,332 @@
+import os
+import struct
+import numpy as np
+
+from deeptools import bamHandler
+from deeptools import mapReduce
+from deeptools import intervalIndex
+
+# size of the windows of the BAI linear index
+LINEAR_INDEX_WINDOW = 2 ** 14
+# id of the BAI pseudo-bin that holds the per reference statistics
+BAI_PSEUDO_BIN = 37450
+# rough number of bytes of worker memory per read of a chunk,
+# used to turn the memory limit into a number of reads
+BYTES_PER_READ = 1000
+
+# see setMemoryLimit()
+_memory_limit = None
+
+
+def setMemoryLimit(megabytes):
+    """
+    Sets the memory (in MB) that a worker should use at most to process a
+    chunk. Chunks with more reads than what fits in that memory are split
+    by planChunks. None removes the limit.
+
+    >>> setMemoryLimit(1)
+    >>> maxChunkReads()
+    1048
+    >>> setMemoryLimit(None)
+    >>> maxChunkReads() is None
+    True
+    """
+    global _memory_limit
+    if megabytes is not None and megabytes <= 0:
+        raise ValueError("the memory limit must be positive")
+    _memory_limit = megabytes
+
+
+def maxChunkReads():
+    """
+    Returns the maximum expected number of reads of a chunk for the
+    memory limit set with setMemoryLimit(), or None
+    """
+    if _memory_limit is None:
+        return None
+    return max(int(_memory_limit * 2 ** 20 / BYTES_PER_READ), 1)
+
+
+def planChunks(bamFilesList, chromSizes, genomeChunkLength, alignTo=1,
+               region=None, maxChunkLength=None, maxReads=None):
+    """
+    Splits the genome into chunks that are expected to contain a similar
+    number of reads, such that the workers receive tasks of similar cost.
+
+    The read density along each chromosome is estimated from the BAM
+    index (see readDensity()) and summed over all the bam files. On
+    average, a chunk has the length `genomeChunkLength`, but chunks
+    are shorter where the read density is high and longer where it is
+    low.
+
+    Parameters
+    ----------
+    bamFilesList : list
+        List of indexed bam files.
+    chromSizes : list
+        List of (chrom, size) tuples, as returned by getCommonChrNames.
+    genomeChunkLength : int
+        Mean length of the chunks.
+    alignTo : int
+        The chunk boundaries are multiples of alignTo (counting from the
+        region start). Usually the bin or step size.
+    region : str
+        Region in the chrom:start:end:tileSize format. See
+        mapReduce.getUserRegion.
+    maxChunkLength : int
+        Upper limit for the chunk length. Default: 10 * genomeChunkLength
+    maxReads : int
+        Upper limit for the expected number of reads of a chunk, such that
+        read-dense regions are split further. Default: maxChunkReads()
+
+    Returns
+    -------
+    list
+        List of (chrom, start, end, expected number of reads) tuples, in
+        genomic order. These can be passed to mapReduce as `chunks`.
+
+    Examples
+    --------
+    >>> root = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+    >>> planChunks([root + "testA.bam"], [('3R', 200)], 100, alignTo=25)
+    [('3R', 0, 100, 1.0), ('3R', 100, 200, 1.0)]
+
+    Chunks longer than maxChunkLength are split
+
+    >>> [x[:3] for x in planChunks([root + "testA.bam"], [('3R', 200)], 100,
+    ...                            alignTo=25, maxChunkLength=75)]
+    [('3R', 0, 50), ('3R', 50, 100), ('3R', 100, 150), ('3R', 150, 200)]
+
+    as well as chunks with more than maxReads reads
+
+    >>> [x[:3] for x in planChunks([root + "testA.bam"], [('3R', 200)], 100,
+    ...                            alignTo=25, maxReads=0.5)]
+    [('3R', 0, 50), ('3R', 50, 100), ('3R', 100, 150), ('3R', 150, 200)]
+    """
+    genomeChunkLength = max(int(genomeChunkLength), 1)
+    alignTo = max(int(alignTo), 1)
+    if maxChunkLength is None:
+        maxChunkLength = 10 * genomeChunkLength
+    maxChunkLength = max(int(maxChunkLength), alignTo)
+    if maxReads is None:
+        maxReads = maxChunkReads()
+
+    region_start = 0
+    if region:
+        chromSizes, region_start, region_end, __ = mapReduce.getUserRegion(chromSizes, region)
+
+    densities = [readDensity(bam) for bam in bamFilesList]
+
+    # total expected reads and length, to compute
+    # the number of reads that a chunk should have
+    per_chrom = []
+    total_reads = 0.0
+    total_length = 0
+    for chrom, size in chromSizes:
+        start = region_start
+        bounds, cum = _cumulativeDensity(densities, chrom, size)
+        reads = _interp(size, bounds, cum) - _interp(start, bounds, cum)
+        per_chrom.append((chrom, start, size, bounds, cum))
+        total_reads += reads
+        total_length += max(size - start, 0)
+
+    if total_reads > 0 and total_length > 0:
+        target = total_reads * genomeChunkLength / total_length
+    else:
+        target = None
+    if target and maxReads:
+        target = min(target, maxReads)
+
+    chunks = []
+    for chrom, start, end, bounds, cum in per_chrom:
+        if start >= end:
+            continue
+        reads = _interp(end, bounds, cum) - _interp(start, bounds, cum)
+        if target and reads > 0:
+            num_chunks = max(int(round(reads / target)), 1)
+            levels = _interp(start, bounds, cum) + reads * np.arange(1, num_chunks) / num_chunks
+            cuts = _inverseInterp(levels, bounds, cum)
+        else:
+            cuts = np.arange(start + genomeChunkLength, end, genomeChunkLength)
+
+        # align the boundaries to the bin (or step) size
+        cuts = start + np.round((np.asarray(cuts, dtype=float) - start) / alignTo).astype(np.int64) * alignTo
+        cuts = np.unique(cuts[(cuts > start) & (cuts < end)])
+        edges = [start] + cuts.tolist() + [end]
+
+        for chunk_start, chunk_end in zip(edges[:-1], edges[1:]):
+            # split chunks that are too long
+            num_pieces = int(np.ceil(float(chunk_end - chunk_start) / maxChunkLength))
+            piece_length = int(np.ceil(float(chunk_end - chunk_start) / num_pieces / alignTo)) * alignTo
+            for piece_start in range(chunk_start, chunk_end, piece_length):
+                piece_end = min(piece_start + piece_length, chunk_end)
+                weight = _interp(piece_end, bounds, cum) - _interp(piece_start, bounds, cum)
+                chunks.append((chrom, int(piece_start), int(piece_end), float(weight)))
+
+    return chunks
+
+
+def readDensity(bamFile):
+    """
+    Estimates the number of mapped reads in each 16kb window of each
+    reference.
+
+    For BAI indices, the number of reads of a reference is distributed
+    over the windows in proportion to the (compressed) bytes between
+    consecutive entries of the linear index. As a consequence, the
+    resolution is that of the BGZF blocks. For other indices (e.g. CSI),
+    the reads are spread uniformly over the reference.
+
+    Returns a dictionary {chrom: numpy array of reads per window}
+
+    >>> root = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+    >>> readDensity(root + "testA.bam")['3R']
+    array([ 2.])
+    """
+    bam = bamHandler.openBam(bamFile)
+    names = list(bam.references)
+    lengths = list(bam.lengths)
+    mapped = _mappedPerReference(bam)
+    bam.close()
+
+    linear_index = None
+    index_file = _baiFileName(bamFile)
+    if index_file is not None:
+        try:
+            linear_index = _readBaiLinearIndex(index_file)
+        except (IOError, struct.error, ValueError):
+            linear_index = None
+        if linear_index is not None and len(linear_index) != len(names):
+            linear_index = None
+
+    density = {}
+    for idx, chrom in enumerate(names):
+        num_windows = max(int(np.ceil(float(lengths[idx]) / LINEAR_INDEX_WINDOW)), 1)
+        reads = float(mapped.get(chrom, 0))
+        weights = None
+        if linear_index is not None:
+            ioffsets, ref_end, n_mapped = linear_index[idx]
+            if n_mapped is not None:
+                reads = float(n_mapped)
+            weights = _linearIndexWeights(ioffsets, ref_end, num_windows)
+        if weights is None or weights.sum() == 0:
+            # uniform spread
+            weights = np.full(num_windows, float(LINEAR_INDEX_WINDOW))
+            weights[-1] = lengths[idx] - LINEAR_INDEX_WINDOW * (num_windows - 1)
+        density[chrom] = reads * weights / weights.sum()
+
+    return density
+
+
+def _mappedPerReference(bam):
+    """
+    Returns a dictionary {chrom: number of mapped reads}
+    """
+    try:
+        return dict((x.contig, x.mapped) for x in bam.get_index_statistics())
+    except AttributeError:
+        # pysam < 0.9, spread the mapped reads by length
+        total = float(sum(bam.lengths))
+        return dict((chrom, bam.mapped * length / total)
+                    for chrom, length in zip(bam.references, bam.lengths))
+
+
+def _baiFileName(bamFile):
+    for name in [bamFile + ".bai", os.path.splitext(bamFile)[0] + ".bai"]:
+        if os.path.exists(name):
+            return name
+    return None
+
+
+def _readBaiLinearIndex(indexFile):
+    """
+    Parses a BAI file. Returns a list, with one entry per reference,
+    of (linear index offsets, virtual offset of the end of the reference
+    or None, number of mapped reads or None).
+    """
+    with open(indexFile, 'rb') as fh:
+        data = fh.read()
+    if data[:4] != b"BAI\x01":
+        raise ValueError("{} is not a BAI file".format(indexFile))
+    n_ref, = struct.unpack_from('<i', data, 4)
+    offset = 8
+    references = []
+    for __ in range(n_ref):
+        n_bin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        ref_end = None
+        n_mapped = None
+        for __ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+            if bin_id == BAI_PSEUDO_BIN and n_chunk == 2:
+                __, ref_end, n_mapped, __ = struct.unpack_from('<QQQQ', data, offset)
+            offset += 16 * n_chunk
+        n_intv, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        ioffsets = np.frombuffer(data, dtype='<u8', count=n_intv, offset=offset)
+        offset += 8 * n_intv
+        references.append((ioffsets, ref_end, n_mapped))
+    return references
+
+
+def _linearIndexWeights(ioffsets, ref_end, num_windows):
+    """
+    Computes the compressed bytes per window from the linear index
+
+    >>> _linearIndexWeights(np.array([0, 5 << 16, 5 << 16, 9 << 16], dtype=np.uint64), 20 << 16, 5)
+    array([  0.,   0.,   4.,  11.,   0.])
+    """
+    if len(ioffsets) == 0:
+        return None
+    # compressed offsets of the BGZF blocks
+    coffsets = (np.asarray(ioffsets, dtype=np.uint64) >> np.uint64(16)).astype(np.float64)
+    nonzero = np.flatnonzero(coffsets)
+    if len(nonzero) == 0:
+        return None
+    # windows before the first read have no offset
+    coffsets[:nonzero[0]] = coffsets[nonzero[0]]
+    coffsets = np.maximum.accumulate(coffsets)
+    if ref_end is not None:
+        last = float(ref_end >> 16)
+    else:
+        last = coffsets[-1]
+    coffsets = np.append(coffsets, max(last, coffsets[-1]))
+    weights = np.zeros(num_windows)
+    deltas = np.diff(coffsets)[:num_windows]
+    weights[:len(deltas)] = deltas
+    return weights
+
+
+def _cumulativeDensity(densities, chrom, size):
+    """
+    Returns the window boundaries and the cumulative number of reads
+    at those boundaries, summed over all the bam files
+    """
+    num_windows = max(int(np.ceil(float(size) / LINEAR_INDEX_WINDOW)), 1)
+    reads = np.zeros(num_windows)
+    for density in densities:
+        name = intervalIndex.matchChromName(chrom, density)
+        if name is None:
+            continue
+        _d = density[name][:num_windows]
+        reads[:len(_d)] += _d
+    bounds = np.minimum(np.arange(num_windows + 1) * LINEAR_INDEX_WINDOW, size)
+    cum = np.concatenate([[0.0], np.cumsum(reads)])
+    return bounds, cum
+
+
+def _interp(pos, bounds, cum):
+    return float(np.interp(pos, bounds, cum))
+
+
+def _inverseInterp(levels, bounds, cum):
+    """
+    Returns the positions at which the cumulative number of reads
+    reaches the given levels, interpolating within the windows
+    """
+    idx = np.searchsorted(cum, levels, side='left')
+    idx = np.clip(idx, 1, len(cum) - 1)
+    window_reads = cum[idx] - cum[idx - 1]
+    frac = np.where(window_reads > 0, (levels - cum[idx - 1]) / np.where(window_reads > 0, window_reads, 1), 1)
+    return bounds[idx - 1] + frac * (bounds[idx] - bounds[idx - 1])
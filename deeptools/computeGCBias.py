@@ -9,18 +9,18 @@ import argparse
 from scipy.stats import poisson
 import twobitreader as twobit
 
-from deeptoolsintervals import GTF
 from deeptools.utilities import getGC_content, tbitToBamChrName
-from deeptools import parserCommon, mapReduce
+from deeptools import parserCommon, mapReduce, intervalIndex
 from deeptools.getFragmentAndReadSize import get_read_and_fragment_length
 from deeptools import bamHandler
+from deeptools import fileHandles
 
 debug = 0
 old_settings = np.seterr(all='ignore')
 
 
 def parse_arguments(args=None):
-    parentParser = parserCommon.getParentArgParse(binSize=False, blackList=True)
+    parentParser = parserCommon.getParentArgParse(binSize=False, blackList=True, checkpoint=False)
     requiredArgs = getRequiredArgs()
     parser = argparse.ArgumentParser(
         parents=[requiredArgs, parentParser],
@@ -157,12 +157,12 @@ def getPositionsToSample(chrom, start, end, stepSize):
     positions_to_sample = np.arange(start, end, stepSize)
 
     if global_vars['filter_out']:
-        filter_out_tree = GTF(global_vars['filter_out'])
+        filter_out_tree = intervalIndex.getIndex(global_vars['filter_out'])
     else:
         filter_out_tree = None
 
     if global_vars['extra_sampling_file']:
-        extra_tree = GTF(global_vars['extra_sampling_file'])
+        extra_tree = intervalIndex.getIndex(global_vars['extra_sampling_file'])
     else:
         extra_tree = None
 
@@ -213,8 +213,8 @@ def countReadsPerGC_worker(chromNameBam,
     """
 
     chromNameBit = chrNameBamToBit[chromNameBam]
-    tbit = twobit.TwoBitFile(global_vars['2bit'])
-    bam = bamHandler.openBam(global_vars['bam'])
+    tbit = fileHandles.openTwoBit(global_vars['2bit'])
+    bam = fileHandles.openBam(global_vars['bam'])
     c = 1
     sub_reads_per_gc = []
     positions_to_sample = getPositionsToSample(chromNameBit,
@@ -312,8 +312,8 @@ def tabulateGCcontent_worker(chromNameBam, start, end, stepSize,
     subN_gc = np.zeros(fragmentLength['median'] + 1, dtype='int')
     subF_gc = np.zeros(fragmentLength['median'] + 1, dtype='int')
 
-    tbit = twobit.TwoBitFile(global_vars['2bit'])
-    bam = bamHandler.openBam(global_vars['bam'])
+    tbit = fileHandles.openTwoBit(global_vars['2bit'])
+    bam = fileHandles.openBam(global_vars['bam'])
     peak = 0
     startTime = time.time()
 
@@ -590,6 +590,7 @@ def plotGCbias(file_name, frequencies, reads_per_gc, region_size, image_format=N
 
 def main(args=None):
     args = parse_arguments().parse_args(args)
+    parserCommon.apply_run_options(args)
 
     if args.extraSampling:
         extra_sampling_file = args.extraSampling.name
@@ -655,6 +656,16 @@ def main(args=None):
     for key in global_vars:
         print("{}: {}".format(key, global_vars[key]))
 
+    # the interval files are parsed once, here, and inherited
+    # by the workers (see getPositionsToSample)
+    for key in ['filter_out', 'extra_sampling_file']:
+        if global_vars[key]:
+            intervalIndex.getIndex(global_vars[key])
+
+    # the workers need to see the global variables set above. Thus,
+    # any shared pool forked before they were set is discarded.
+    mapReduce.closePool()
+
     print("computing frequencies")
     # the GC of the genome is sampled each stepSize bp.
     stepSize = max(int(global_vars['genome_size'] / args.sampleSize), 1)
@@ -324,6 +324,19 @@ def computeMatrixOptArgs(case=['scale-regions', 'reference-point'][0]):
                           default=cfg.config.get('general',
                                                  'default_proc_number'),
                           required=False)
+    optional.add_argument('--executor',
+                          help='How the work is distributed among the '
+                          '--numberOfProcessors workers. "processes" uses '
+                          'separate processes. "threads" uses threads of a '
+                          'single process, which avoids copying the data '
+                          'between processes and is usually faster when most '
+                          'of the time is spent reading bigWig files. '
+                          '"serial" does all the work in a single process.',
+                          choices=['processes', 'threads', 'serial'],
+                          default=cfg.config.get('general',
+                                                 'default_executor'),
+                          required=False)
+    parserCommon.run_options(optional)
     return parser
 
 
@@ -351,6 +364,7 @@ def process_args(args=None):
 def main(args=None):
 
     args = process_args(args)
+    parserCommon.apply_run_options(args)
 
     parameters = {'upstream': args.beforeRegionStartLength,
                   'downstream': args.afterRegionStartLength,
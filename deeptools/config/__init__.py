@@ -53,6 +53,7 @@ if os.environ.get('DEEP_TOOLS_NO_CONFIG', False):
     config = configparser.ConfigParser()
     config.add_section('general')
     config.set('general', 'default_proc_number', 'max/2')
+    config.set('general', 'default_executor', 'processes')
     # N.B., the TMPDIR variable can be used!
     config.set('general', 'tmp_dir', tempfile.gettempdir())
 
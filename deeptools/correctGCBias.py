@@ -18,12 +18,16 @@ from scipy.stats import binom
 from deeptools.utilities import getGC_content, tbitToBamChrName
 from deeptools import writeBedGraph, parserCommon, mapReduce
 from deeptools import utilities
+from deeptools import fileHandles
+from deeptools import bamHandler
+from deeptools import threadBudget
 
 old_settings = np.seterr(all='ignore')
 
 
 def parse_arguments(args=None):
-    parentParser = parserCommon.getParentArgParse(binSize=True, blackList=False)
+    parentParser = parserCommon.getParentArgParse(binSize=True, blackList=False, checkpoint=False, trace=False,
+                                                  memory=False)
     requiredArgs = getRequiredArgs()
     parser = argparse.ArgumentParser(
         parents=[requiredArgs, parentParser],
@@ -186,23 +190,21 @@ def writeCorrected_worker(chrNameBam, chrNameBit, start, end, step):
 
     i = 0
 
-    tbit = twobit.TwoBitFile(global_vars['2bit'])
-    bam = pysam.Samfile(global_vars['bam'])
+    tbit = fileHandles.openTwoBit(global_vars['2bit'])
+    bam = fileHandles.openBam(global_vars['bam'], threads=global_vars.get('threads', 0))
     read_repetitions = 0
     removed_duplicated_reads = 0
     startTime = time.time()
 
-    # caching seems to be faster
+    # the reads are streamed, not cached, such that the memory
+    # used does not depend on the number of reads of the region.
     # r.flag & 4 == 0 is to skip unmapped
     # reads that nevertheless are asigned
     # to a genomic position
-    reads = [r for r in bam.fetch(chrNameBam, start, end)
-             if r.flag & 4 == 0]
+    reads = (r for r in bam.fetch(chrNameBam, start, end)
+             if r.flag & 4 == 0)
 
-    bam.close()
-    r_index = -1
-    for read in reads:
-        r_index += 1
+    for previous, read in withPrevious(reads):
         try:
             # calculate GC content of read fragment
             gc = getReadGCcontent(tbit, read, fragmentLength,
@@ -216,9 +218,9 @@ def writeCorrected_worker(chrNameBam, chrNameBit, start, end, step):
             continue
 
         # is this read in the same orientation and position as the previous?
-        if r_index > 0 and read.pos == reads[r_index - 1].pos and \
-                read.is_reverse == reads[r_index - 1].is_reverse \
-                and read.pnext == reads[r_index - 1].pnext:
+        if previous is not None and read.pos == previous.pos and \
+                read.is_reverse == previous.is_reverse \
+                and read.pnext == previous.pnext:
             read_repetitions += 1
             if read_repetitions >= global_vars['max_dup_gc'][gc]:
                 removed_duplicated_reads += 1
@@ -247,15 +249,20 @@ def writeCorrected_worker(chrNameBam, chrNameBit, start, end, step):
     if i == 0:
         return None
 
+    # mean of each bin of step bases, the last one can be shorter
+    num_full = len(cvg_corr) // step
+    values = cvg_corr[:num_full * step].reshape(num_full, step).mean(axis=1)
+    if len(cvg_corr) > num_full * step:
+        values = np.append(values, np.mean(cvg_corr[num_full * step:]))
+    bins = np.flatnonzero(values > 0)
+    writeStarts = start + bins * step
+    writeEnds = np.minimum(writeStarts + step, end)
+
     _file = open(utilities.getTempFileName(suffix='.bg'), 'w')
-    # save in bedgraph format
-    for bin in range(0, len(cvg_corr), step):
-        value = np.mean(cvg_corr[bin:min(bin + step, end)])
-        if value > 0:
-            writeStart = start + bin
-            writeEnd = min(start + bin + step, end)
-            _file.write("%s\t%d\t%d\t%.1f\n" % (chrNameBit, writeStart,
-                                                writeEnd, value))
+    # save in bedgraph format, all the bins at once
+    _file.write("".join(["%s\t%d\t%d\t%.1f\n" % (chrNameBit, writeStart, writeEnd, value)
+                         for writeStart, writeEnd, value in zip(writeStarts.tolist(), writeEnds.tolist(),
+                                                                values[bins].tolist())]))
 
     tempFileName = _file.name
     _file.close()
@@ -331,25 +338,28 @@ def writeCorrectedSam_worker(chrNameBam, chrNameBit, start, end,
         print("Sam for %s %s %s " % (chrNameBit, start, end))
     i = 0
 
-    tbit = twobit.TwoBitFile(global_vars['2bit'])
+    tbit = fileHandles.openTwoBit(global_vars['2bit'])
 
-    bam = pysam.Samfile(global_vars['bam'])
+    # the extra threads of the worker (see threadBudget) are used
+    # to decompress the input and to compress the output
+    bam = fileHandles.openBam(global_vars['bam'], threads=global_vars.get('threads', 0))
     tempFileName = utilities.getTempFileName(suffix='.bam')
 
-    outfile = pysam.Samfile(tempFileName, 'wb', template=bam)
+    outfile = bamHandler.openBamWriter(tempFileName, template=bam,
+                                       threads=global_vars.get('threads', 0))
     startTime = time.time()
     matePairs = {}
     read_repetitions = 0
     removed_duplicated_reads = 0
-    # cache data
+    num_reads = 0
+    # the reads are streamed, see writeCorrected_worker
     # r.flag & 4 == 0 is to filter unmapped reads that
     # have a genomic position
-    reads = [r for r in bam.fetch(chrNameBam, start, end)
-             if r.pos > start and r.flag & 4 == 0]
+    reads = (r for r in bam.fetch(chrNameBam, start, end)
+             if r.pos > start and r.flag & 4 == 0)
 
-    r_index = -1
-    for read in reads:
-        r_index += 1
+    for previous, read in withPrevious(reads):
+        num_reads += 1
         copies = None
         gc = None
 
@@ -371,9 +381,9 @@ def writeCorrectedSam_worker(chrNameBam, chrNameBit, start, end,
             else:
                 copies = 1
         # is this read in the same orientation and position as the previous?
-        if gc and r_index > 0 and read.pos == reads[r_index - 1].pos \
-                and read.is_reverse == reads[r_index - 1].is_reverse \
-                and read.pnext == reads[r_index - 1].pnext:
+        if gc and previous is not None and read.pos == previous.pos \
+                and read.is_reverse == previous.is_reverse \
+                and read.pnext == previous.pnext:
             read_repetitions += 1
             if read_repetitions >= global_vars['max_dup_gc'][gc]:
                 copies = 0  # in other words do not take into account this read
@@ -448,14 +458,27 @@ def writeCorrectedSam_worker(chrNameBam, chrNameBit, start, end,
               "@ {}:{}-{}".format(multiprocessing.current_process().name,
                                   i, i / (endTime - startTime),
                                   chrNameBit, start, end))
-        percentage = float(removed_duplicated_reads) * 100 / len(reads) \
-            if len(reads) > 0 else 0
+        percentage = float(removed_duplicated_reads) * 100 / num_reads \
+            if num_reads > 0 else 0
         print("duplicated reads removed %d of %d (%.2f) " %
-              (removed_duplicated_reads, len(reads), percentage))
+              (removed_duplicated_reads, num_reads, percentage))
 
     return tempFileName
 
 
+def withPrevious(reads):
+    """
+    Yields (previous read or None, read) for each read
+
+    >>> list(withPrevious(['a', 'b', 'c']))
+    [(None, 'a'), ('a', 'b'), ('b', 'c')]
+    """
+    previous = None
+    for read in reads:
+        yield previous, read
+        previous = read
+
+
 def getFragmentFromRead(read, defaultFragmentLength, extendPairedEnds=True):
     """
     The read has to be pysam object.
@@ -546,6 +569,7 @@ def run_shell_command(command):
 
 def main(args=None):
     args = process_args(args)
+    parserCommon.apply_run_options(args)
     global F_gc, N_gc, R_gc
 
     data = np.loadtxt(args.GCbiasFrequenciesFile.name)
@@ -616,7 +640,13 @@ def main(args=None):
                             bedGraphStep))
             c += 1
 
-    pool = multiprocessing.Pool(args.numberOfProcessors)
+    # processors left idle when there are fewer tasks than processors
+    global_vars['threads'] = threadBudget.workerThreads(args.numberOfProcessors, len(mp_args))
+
+    # the workers need to see the global variables set above. Thus,
+    # any shared pool forked before they were set is discarded.
+    mapReduce.closePool()
+    pool = mapReduce.getPool(args.numberOfProcessors)
 
     if args.correctedFile.name.endswith('bam'):
         if len(mp_args) > 1 and args.numberOfProcessors > 1:
@@ -635,7 +665,8 @@ def main(args=None):
         else:
             print("concatenating (sorted) intermediate BAMs")
             header = pysam.Samfile(res[0])
-            of = pysam.Samfile(args.correctedFile.name, "wb", template=header)
+            of = bamHandler.openBamWriter(args.correctedFile.name, template=header,
+                                          threads=args.numberOfProcessors - 1)
             header.close()
             for f in res:
                 f = pysam.Samfile(f)
@@ -680,6 +711,8 @@ def main(args=None):
                                            args.correctedFile.name)
             os.remove(_temp_bg_file)
 
+    mapReduce.closePool()
+
 
 class Tester():
     def __init__(self):
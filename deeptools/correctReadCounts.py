@@ -10,56 +10,63 @@ debug = 1
 old_settings = np.seterr(all='ignore')
 
 
+@writeBedGraph.tileArray
 def computeLambda(tileCoverage, args):
     """
-    This function is called by the writeBedGraph workers for every
-    tile in the genome that is considered
+    This function is called by the writeBedGraph workers for the
+    tiles of each region of the genome that is considered
     """
 
-    treatmentWindowTags = tileCoverage[0]
-    controlWindowTags = tileCoverage[1]
+    tiles, result = writeBedGraph.asTiles(tileCoverage)
+    treatmentWindowTags = tiles[:, 0]
+    controlWindowTags = tiles[:, 1]
     treatmentExtraSignalTags = treatmentWindowTags - args['treatmentMean']
 
     controlLambda = args['controlMean'] + (treatmentExtraSignalTags * args['controlSignalRatio'])
 
     log10pvalue = -1 * poisson.logsf(controlWindowTags, controlLambda) / np.log(10)
 
-    return log10pvalue
+    return result(log10pvalue)
 
 
+@writeBedGraph.tileArray
 def computePvalue(tileCoverage, args):
     """
-    This function is called by the writeBedGraph workers for every
-    tile in the genome that is considered
+    This function is called by the writeBedGraph workers for the
+    tiles of each region of the genome that is considered
 
     It computes a pvalue based on an expected lambda comming from
     the correction of treatment when the input is considered.
     """
 
-    treatmentWindowTags = tileCoverage[0]
-    controlWindowTags = tileCoverage[1]
+    tiles, result = writeBedGraph.asTiles(tileCoverage)
+    treatmentWindowTags = tiles[:, 0]
+    controlWindowTags = tiles[:, 1]
 
     treatmentLambda = controlWindowTags * args['treatmentControlRatio']
 
-    log10pvalue = min(300, -1 * poisson.logsf(treatmentWindowTags, treatmentLambda) / np.log(10))
+    # fmin, as min(), keeps 300 when the pvalue is nan
+    log10pvalue = np.fmin(300, -1 * poisson.logsf(treatmentWindowTags, treatmentLambda) / np.log(10))
 
-    return log10pvalue
+    return result(log10pvalue)
 
 
+@writeBedGraph.tileArray
 def computeCorrectedReadcounts(tileCoverage, args):
     """
-    This function is called by the writeBedGraph workers for every
-    tile in the genome that is considered
+    This function is called by the writeBedGraph workers for the
+    tiles of each region of the genome that is considered
 
     It computes a pvalue based on an expected lambda comming from
     the correction of treatment when the input is considered.
     """
 
-    treatmentWindowTags = tileCoverage[0]
-    controlWindowTags = tileCoverage[1]
+    tiles, result = writeBedGraph.asTiles(tileCoverage)
+    treatmentWindowTags = tiles[:, 0]
+    controlWindowTags = tiles[:, 1]
     treatmentCorrectedTags = treatmentWindowTags - args['treatmentControlRatio'] * (controlWindowTags - args['controlMean'])
 
-    return treatmentCorrectedTags
+    return result(treatmentCorrectedTags)
 
 
 def correctReadCounts(bamFilesList, binLength, numberOfSamples, defaultFragmentLength,
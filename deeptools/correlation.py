@@ -66,12 +66,14 @@ class Correlation:
         loads a matrix file saved using the numpy
         savez method. Two keys are expected:
         'matrix' and 'labels'. The matrix should
-        contain one sample per row
+        contain one sample per row. Matrices saved
+        with a compact dtype (e.g. multiBamSummary
+        --countsDtype uint16) are converted to float64
         """
 
         _ma = np.load(matrix_file)
         # matrix:  cols correspond to  samples
-        self.matrix = np.asarray(_ma['matrix'].tolist())
+        self.matrix = np.asarray(_ma['matrix'], dtype='float64')
         if np.any(np.isnan(self.matrix)):
             num_nam = len(np.flatnonzero(np.isnan(self.matrix.flatten())))
             sys.stderr.write("*Warning*. {} NaN values were found. They will be removed along with the "
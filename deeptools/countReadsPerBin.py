@@ -3,17 +3,31 @@ import os
 import time
 import sys
 import multiprocessing
+from itertools import repeat
 import numpy as np
 
 # deepTools packages
 import deeptools.utilities
 from deeptools import bamHandler
 from deeptools import mapReduce
-from deeptoolsintervals import GTF
+from deeptools import chunkPlanner
+from deeptools import taskTrace
+from deeptools import intervalIndex
+from deeptools import sharedOutput
+from deeptools import readFilter
+from deeptools import fragmentIndex
+from deeptools import fileHandles
 
 debug = 0
 old_settings = np.seterr(all='ignore')
 
+# regions (e.g. sampled bins) closer than this are fetched
+# from the bam files together, see coalescedFetch()
+FETCH_MERGE_GAP = 1000
+
+# the dtypes in which the counts can be kept, see castCounts()
+COUNTS_DTYPES = ('float64', 'float32', 'uint32', 'uint16')
+
 
 def countReadsInRegions_wrapper(args):
     """
@@ -27,6 +41,141 @@ def countReadsInRegions_wrapper(args):
     return CountReadsPerBin.count_reads_in_region(*args)
 
 
+def coalescedFetch(bamHandle, chrom, windows, maxGap=None):
+    """
+    Yields, for each (start, end) of windows, the mapped reads that
+    bamHandle.fetch(chrom, start, end) returns, or None if the window
+    is None. The reads of a window that is fetched alone are streamed
+    from the bam file, thus, they have to be consumed before the next
+    window is requested.
+
+    Consecutive windows (sorted by start) that are less than maxGap bp
+    (by default FETCH_MERGE_GAP) apart are read with a single fetch, instead of seeking and
+    decompressing the same BGZF blocks once per window. The reads of the
+    fetch are assigned to the windows in a single pass, only keeping in
+    memory the reads that overlap the current window.
+
+    >>> test = Tester()
+    >>> import pysam
+    >>> bam = pysam.AlignmentFile(test.bamFile2)
+    >>> windows = [(0, 50), (100, 150), None, (140, 160)]
+    >>> [len(list(x)) if x is not None else None for x in coalescedFetch(bam, '3R', windows)]
+    [0, 1, None, 3]
+    >>> [len(list(bam.fetch('3R', s, e))) for s, e in [(0, 50), (100, 150), (140, 160)]]
+    [0, 1, 3]
+    """
+    if maxGap is None:
+        maxGap = FETCH_MERGE_GAP
+    i = 0
+    while i < len(windows):
+        if windows[i] is None:
+            yield None
+            i += 1
+            continue
+
+        # the windows fetched together
+        group = [i]
+        group_start, group_end = windows[i]
+        last_start = group_start
+        j = i + 1
+        while j < len(windows):
+            if windows[j] is not None:
+                if windows[j][0] < last_start or windows[j][0] - group_end >= maxGap:
+                    break
+                last_start = windows[j][0]
+                group_end = max(group_end, windows[j][1])
+            group.append(j)
+            j += 1
+        i = j
+
+        if len(group) == 1:
+            yield (r for r in bamHandle.fetch(chrom, group_start, group_end)
+                   if r.flag & 4 == 0)
+            continue
+
+        reads = iter(bamHandle.fetch(chrom, group_start, group_end))
+        next_read = next(reads, None)
+        # (end, read) of the reads that may overlap the next windows
+        pending = []
+        for k in group:
+            if windows[k] is None:
+                yield None
+                continue
+            start, end = windows[k]
+            while next_read is not None and next_read.reference_start < end:
+                if next_read.flag & 4 == 0:
+                    pending.append((_fetchEnd(next_read), next_read))
+                next_read = next(reads, None)
+            # the windows are sorted by start, thus, reads ending
+            # before this window do not overlap the next windows
+            pending = [x for x in pending if x[0] > start]
+            # a window can end before the previous ones (e.g. when it is
+            # clipped by a blacklist), the reads starting after its end
+            # are kept for the next windows
+            yield [x[1] for x in pending if x[1].reference_start < end]
+
+
+def castCounts(values, dtype):
+    """
+    Returns the counts as the given dtype (one of COUNTS_DTYPES). The
+    counts larger than the maximum of an integer dtype are set to the
+    maximum (see countSaturated()).
+
+    >>> castCounts(np.array([0., 3., 70000.]), 'uint16')
+    array([    0,     3, 65535], dtype=uint16)
+    >>> castCounts(np.array([np.nan]), 'uint16')
+    Traceback (most recent call last):
+    ...
+    ValueError: NaN counts can not be saved as uint16
+    """
+    dtype = np.dtype(dtype)
+    values = np.asarray(values)
+    if values.dtype == dtype:
+        return values
+    if dtype.kind == 'u':
+        if np.any(np.isnan(values)):
+            raise ValueError("NaN counts can not be saved as {}".format(dtype))
+        values = np.clip(values, 0, np.iinfo(dtype).max)
+    return values.astype(dtype)
+
+
+def countSaturated(values):
+    """
+    Returns the number of counts that reached the maximum of the
+    (integer) dtype of values, thus, that may have been truncated
+
+    >>> countSaturated(np.array([1, 65535], dtype='uint16'))
+    1
+    >>> countSaturated(np.array([1., 65535.]))
+    0
+    """
+    if values.dtype.kind != 'u':
+        return 0
+    return int(np.count_nonzero(values == np.iinfo(values.dtype).max))
+
+
+def _fetchEnd(read):
+    """
+    End of the read as used by fetch() (htslib's bam_endpos)
+    """
+    end = read.reference_end
+    if end is None or end <= read.reference_start:
+        return read.reference_start + 1
+    return end
+
+
+def countReadsInRegions_shared_wrapper(args):
+    """
+    Like countReadsInRegions_wrapper, but the counts are written to
+    the SharedRows object given as static argument, in the rows reserved
+    for the task (the last argument). In place of the counts, the
+    (offset, number of rows) written is returned.
+    """
+    self_, chrom, start, end, output = args[:5]
+    _values, tempFileName = CountReadsPerBin.count_reads_in_region(self_, chrom, start, end, *args[5:-1])
+    return output.write(args[-1], _values), tempFileName
+
+
 class CountReadsPerBin(object):
 
     r"""Collects coverage over multiple bam files using multiprocessing
@@ -120,6 +269,12 @@ class CountReadsPerBin(object):
     out_file_for_raw_data : str
         File name to save the raw counts computed
 
+    countsDtype : str
+        dtype of the counts returned, one of COUNTS_DTYPES. The integer
+        dtypes (e.g. uint16, which takes a quarter of the memory of float64)
+        saturate at their maximum value, in which case a warning is printed.
+        Default: float64
+
     Returns
     -------
     numpy array
@@ -159,7 +314,8 @@ class CountReadsPerBin(object):
                  smoothLength=0,
                  minFragmentLength=0,
                  maxFragmentLength=0,
-                 out_file_for_raw_data=None):
+                 out_file_for_raw_data=None,
+                 countsDtype='float64'):
 
         self.bamFilesList = bamFilesList
         self.binLength = binLength
@@ -212,6 +368,12 @@ class CountReadsPerBin(object):
         self.zerosToNans = zerosToNans
         self.smoothLength = smoothLength
 
+        if countsDtype not in COUNTS_DTYPES:
+            raise ValueError("countsDtype has to be one of {}".format(", ".join(COUNTS_DTYPES)))
+        if zerosToNans and np.dtype(countsDtype).kind == 'u':
+            raise ValueError("zerosToNans requires a floating point countsDtype")
+        self.countsDtype = countsDtype
+
         if out_file_for_raw_data:
             self.save_data = True
             self.out_file_for_raw_data = out_file_for_raw_data
@@ -277,43 +439,83 @@ class CountReadsPerBin(object):
             # in case a region is used, append the tilesize
             self.region += ":{}".format(self.binLength)
 
+        # the chunks have similar expected numbers of reads, with
+        # chunkSize as their mean length
+        chunks = chunkPlanner.planChunks(self.bamFilesList, chromSizes, chunkSize,
+                                         alignTo=self.stepSize, region=self.region)
+
         # Handle GTF options
         transcriptID, exonID, transcript_id_designator, keepExons = deeptools.utilities.gtfOptions(allArgs)
 
-        # use map reduce to call countReadsInRegions_wrapper
-        imap_res = mapReduce.mapReduce([],
-                                       countReadsInRegions_wrapper,
-                                       chromSizes,
-                                       self_=self,
-                                       genomeChunkLength=chunkSize,
-                                       bedFile=self.bedFile,
-                                       blackListFileName=self.blackListFileName,
-                                       region=self.region,
-                                       numberOfProcessors=self.numberOfProcessors,
-                                       transcriptID=transcriptID,
-                                       exonID=exonID,
-                                       keepExons=keepExons,
-                                       transcript_id_designator=transcript_id_designator)
-
         if self.out_file_for_raw_data:
             if len(non_common):
                 sys.stderr.write("*Warning*\nThe resulting bed file does not contain information for "
                                  "the chromosomes that were not common between the bigwig files\n")
 
-            # concatenate intermediary bedgraph files
             ofile = open(self.out_file_for_raw_data, "w")
-            for _values, tempFileName in imap_res:
-                if tempFileName:
-                    # concatenate all intermediate tempfiles into one
-                    _foo = open(tempFileName, 'r')
-                    shutil.copyfileobj(_foo, ofile)
-                    _foo.close()
-                    os.remove(tempFileName)
 
+        # the per chunk arrays are collected as the workers return them,
+        # and the intermediary bed files are concatenated at the same time
+        # such that they do not pile up on disk
+        values_list = []
+
+        def collect(result):
+            _values, tempFileName = result
+            values_list.append(_values)
+            if tempFileName:
+                # concatenate all intermediate tempfiles into one
+                _foo = open(tempFileName, 'r')
+                shutil.copyfileobj(_foo, ofile)
+                _foo.close()
+                os.remove(tempFileName)
+
+        # the workers write the counts directly in a matrix shared with
+        # this process, in rows reserved for each task as it is created.
+        # The results of a checkpointed run are loaded, not computed,
+        # thus, in that case, the counts are returned as usual.
+        output = None
+        staticArgs = []
+        worker = countReadsInRegions_wrapper
+        if mapReduce.getCheckpoint()[0] is None:
+            output = sharedOutput.SharedRows(len(self.bamFilesList), dtype=self.countsDtype)
+            staticArgs = [output]
+            worker = countReadsInRegions_shared_wrapper
+
+        def reserveRows(task):
+            return output.reserve(self.get_max_rows(*task))
+
+        # use map reduce to call countReadsInRegions_wrapper
+        mapReduce.mapReduce(staticArgs,
+                            worker,
+                            chromSizes,
+                            self_=self,
+                            genomeChunkLength=chunkSize,
+                            bedFile=self.bedFile,
+                            blackListFileName=self.blackListFileName,
+                            region=self.region,
+                            numberOfProcessors=self.numberOfProcessors,
+                            transcriptID=transcriptID,
+                            exonID=exonID,
+                            keepExons=keepExons,
+                            transcript_id_designator=transcript_id_designator,
+                            consumer=collect,
+                            chunks=chunks,
+                            taskInfo=reserveRows if output else None)
+
+        if self.out_file_for_raw_data:
             ofile.close()
 
         try:
-            num_reads_per_bin = np.concatenate([x[0] for x in imap_res], axis=0)
+            if output is None:
+                num_reads_per_bin = np.concatenate(values_list, axis=0)
+            elif len(values_list):
+                num_reads_per_bin = output.rows(values_list)
+            else:
+                raise ValueError("no results")
+            saturated = countSaturated(num_reads_per_bin)
+            if saturated:
+                sys.stderr.write("*WARNING*: {} counts reached the maximum value of {} and were "
+                                 "truncated. Use a larger countsDtype.\n".format(saturated, self.countsDtype))
             return num_reads_per_bin
 
         except ValueError:
@@ -324,6 +526,28 @@ class CountReadsPerBin(object):
             else:
                 sys.exit('\nNo coverage values could be computed.\n\nCheck that all bam files are valid and '
                          'contain mapped reads.')
+        finally:
+            if output is not None:
+                output.close()
+
+    def get_max_rows(self, chrom, start, end, bed_regions_list=None):
+        """
+        Returns the maximum number of rows that count_reads_in_region
+        returns for the given region. Fewer rows are returned when bins
+        overlapping the blacklist are skipped.
+
+        >>> c = CountReadsPerBin([], binLength=10, stepSize=10)
+        >>> c.get_max_rows('chr1', 0, 105)
+        10
+        >>> c.stepSize = 5
+        >>> c.get_max_rows('chr1', 0, 105), len(range(0, 96, 5))
+        (20, 20)
+        """
+        if bed_regions_list is not None:
+            return len(bed_regions_list)
+        if self.stepSize == self.binLength:
+            return max((end - start) // self.binLength, 0)
+        return len(range(start, end - self.binLength + 1, self.stepSize))
 
     def count_reads_in_region(self, chrom, start, end, bed_regions_list=None):
         """Counts the reads in each bam file at each 'stepSize' position
@@ -387,11 +611,11 @@ class CountReadsPerBin(object):
 
         start_time = time.time()
 
-        bam_handlers = [bamHandler.openBam(bam) for bam in self.bamFilesList]
+        bam_handlers = [fileHandles.openBam(bam) for bam in self.bamFilesList]
 
         blackList = None
         if self.blackListFileName is not None:
-            blackList = GTF(self.blackListFileName)
+            blackList = intervalIndex.getIndex(self.blackListFileName)
 
         # A list of lists of tuples
         transcriptsToConsider = []
@@ -415,6 +639,13 @@ class CountReadsPerBin(object):
             _file_name = ''
 
         for bam in bam_handlers:
+            if bed_regions_list is None and self.stepSize != self.binLength:
+                # the sampled bins are computed in a single call, such
+                # that nearby bins are fetched together
+                if len(transcriptsToConsider):
+                    subnum_reads_per_bin.extend(
+                        self.get_coverage_of_region(bam, chrom, [x[0] for x in transcriptsToConsider]))
+                continue
             for trans in transcriptsToConsider:
                 tcov = self.get_coverage_of_region(bam, chrom, trans)
                 if bed_regions_list is not None:
@@ -423,6 +654,7 @@ class CountReadsPerBin(object):
                     subnum_reads_per_bin.extend(tcov)
 
         subnum_reads_per_bin = np.concatenate([subnum_reads_per_bin]).reshape(-1, len(self.bamFilesList), order='F')
+        subnum_reads_per_bin = castCounts(subnum_reads_per_bin, self.countsDtype)
 
         if self.save_data:
             idx = 0
@@ -455,11 +687,16 @@ class CountReadsPerBin(object):
         return subnum_reads_per_bin, _file_name
 
     def get_coverage_of_region(self, bamHandle, chrom, regions,
-                               fragmentFromRead_func=None):
+                               fragmentFromRead_func=None, tileSizes=None):
         """
         Returns a numpy array that corresponds to the number of reads
         that overlap with each tile.
 
+        If tileSizes is given, the regions (chrom, start, tileSize) are
+        split into tiles of each of these sizes instead, and a list with
+        the array of each tile size is returned. The reads are fetched
+        and filtered only once for all the tile sizes.
+
         >>> test = Tester()
         >>> import pysam
         >>> c = CountReadsPerBin([], stepSize=1, extendReads=300)
@@ -488,16 +725,28 @@ class CountReadsPerBin(object):
         >>> c.get_coverage_of_region(pysam.AlignmentFile(test.bamFile2), '3R', [(148, 150), (150, 152), (152, 154)])
         array([ 1.,  2.,  2.])
 
+        The same reads counted in tiles of 2 and 6 bases
+
+        >>> c.get_coverage_of_region(pysam.AlignmentFile(test.bamFile2), '3R', [(148, 154, 2)], tileSizes=[2, 6])
+        [array([ 1.,  2.,  2.]), array([ 3.])]
+
 
         """
+        use_index = fragmentFromRead_func is None and \
+            getattr(self.get_fragment_from_read, '__func__', None) is CountReadsPerBin.__dict__['get_fragment_from_read']
         if not fragmentFromRead_func:
             fragmentFromRead_func = self.get_fragment_from_read
-        nbins = len(regions)
-        if len(regions[0]) == 3:
-            nbins = 0
-            for reg in regions:
-                nbins += (reg[1] - reg[0]) // reg[2]
-        coverages = np.zeros(nbins, dtype='float64')
+        sizes = [None] if tileSizes is None else tileSizes
+
+        def regionTiles(reg, size):
+            # the tile size and the number of tiles of the region
+            if len(reg) == 3:
+                tileSize = int(reg[2] if size is None else size)
+                return tileSize, (reg[1] - reg[0]) // tileSize
+            return int(reg[1] - reg[0]), 1
+
+        coverages = [np.zeros(sum(regionTiles(reg, size)[1] for reg in regions), dtype='float64')
+                     for size in sizes]
 
         if self.defaultFragmentLength == 'read length':
             extension = 0
@@ -506,19 +755,18 @@ class CountReadsPerBin(object):
 
         blackList = None
         if self.blackListFileName is not None:
-            blackList = GTF(self.blackListFileName)
+            blackList = intervalIndex.getIndex(self.blackListFileName)
 
-        vector_start = 0
-        for idx, reg in enumerate(regions):
-            if len(reg) == 3:
-                tileSize = int(reg[2])
-                nRegBins = (reg[1] - reg[0]) // tileSize
-            else:
-                nRegBins = 1
-                tileSize = int(reg[1] - reg[0])
+        if chrom not in bamHandle.references:
+            raise NameError("chromosome {} not found in bam file".format(chrom))
 
+        # the interval of reads to fetch for each region
+        # (None for blacklisted regions)
+        fetch_windows = []
+        for reg in regions:
             # Blacklisted regions have a coverage of 0
             if blackList and blackList.findOverlaps(chrom, reg[0], reg[1]):
+                fetch_windows.append(None)
                 continue
             regStart = int(max(0, reg[0] - extension))
             regEnd = reg[1] + int(extension)
@@ -532,86 +780,207 @@ class CountReadsPerBin(object):
                 o = blackList.findOverlaps(chrom, reg[1], regEnd)
                 if o is not None and len(o) > 0:
                     regEnd = o[0][0]
+            fetch_windows.append((regStart, regEnd))
+
+        read_filter = readFilter.ReadFilter(minMappingQuality=self.minMappingQuality,
+                                            samFlagInclude=self.samFlag_include,
+                                            samFlagExclude=self.samFlag_exclude,
+                                            minFragmentLength=self.minFragmentLength,
+                                            maxFragmentLength=self.maxFragmentLength,
+                                            ignoreDuplicates=self.ignoreDuplicates)
+
+        # the reads are taken from the fragment index of the bam file, if
+        # there is one and the fragments are those of get_fragment_from_read
+        index = None
+        if use_index:
+            index = fragmentIndex.getIndex(bamHandle.filename)
+
+        vector_starts = [0] * len(sizes)
+        if index is None:
+            # nearby regions (e.g. sampled bins) are fetched together
+            fetched = coalescedFetch(bamHandle, chrom, fetch_windows)
+        else:
+            fetched = repeat(None)
+        for reg, window, reads in zip(regions, fetch_windows, fetched):
+            tiles = [regionTiles(reg, size) for size in sizes]
+
+            if window is None:
+                continue
 
             start_time = time.time()
-            # caching seems faster. TODO: profile the function
-            c = 0
-            if chrom in bamHandle.references:
-                reads = [r for r in bamHandle.fetch(chrom, regStart, regEnd)
-                         if r.flag & 4 == 0]
+            blocks = None
+            if index is not None:
+                blocks = self.blocks_from_index(index, chrom, window, read_filter)
+                if blocks is None:
+                    reads = (r for r in bamHandle.fetch(chrom, window[0], window[1])
+                             if r.flag & 4 == 0)
+            if blocks is None:
+                # the reads are streamed, such that only a batch of
+                # them is in memory at any time
+                batches = self.blocks_from_reads(reads, read_filter, fragmentFromRead_func)
             else:
-                raise NameError("chromosome {} not found in bam file".format(chrom))
-
-            prev_start_pos = None  # to store the start positions
-            # of previous processed read pair
-            for read in reads:
-                if self.minMappingQuality and read.mapq < self.minMappingQuality:
-                    continue
-
-                # filter reads based on SAM flag
-                if self.samFlag_include and read.flag & self.samFlag_include != self.samFlag_include:
-                    continue
-                if self.samFlag_exclude and read.flag & self.samFlag_exclude != 0:
-                    continue
-
-                # Fragment lengths
-                if self.minFragmentLength > 0 and abs(read.template_length) < self.minFragmentLength:
-                    continue
-                if self.maxFragmentLength > 0 and abs(read.template_length) > self.maxFragmentLength:
-                    continue
-
-                # get rid of duplicate reads that have same position on each of the
-                # pairs
-                if self.ignoreDuplicates and prev_start_pos \
-                        and prev_start_pos == (read.reference_start, read.pnext, read.is_reverse):
-                    continue
-
-                # since reads can be split (e.g. RNA-seq reads) each part of the
-                # read that maps is called a position block.
-                try:
-                    position_blocks = fragmentFromRead_func(read)
-                except TypeError:
-                    # the get_fragment_from_read functions returns None in some cases.
-                    # Those cases are to be skipped, hence the continue line.
-                    continue
-
-                last_eIdx = None
-                for fragmentStart, fragmentEnd in position_blocks:
-                    if fragmentEnd is None or fragmentStart is None:
-                        continue
-                    fragmentLength = fragmentEnd - fragmentStart
-                    if fragmentLength == 0:
-                        continue
-                    # skip reads that are not in the region being
-                    # evaluated.
-                    if fragmentEnd <= reg[0] or fragmentStart >= reg[1]:
-                        continue
-
-                    sIdx = vector_start + max((fragmentStart - reg[0]) // tileSize, 0)
-                    eIdx = vector_start + min(np.ceil(float(fragmentEnd - reg[0]) / tileSize).astype('int'), nRegBins)
-                    if last_eIdx is not None:
-                        sIdx = max(last_eIdx, sIdx)
-                        if sIdx >= eIdx:
-                            continue
-                    coverages[sIdx:eIdx] += 1
-                    last_eIdx = eIdx
-
-                prev_start_pos = (read.reference_start, read.pnext, read.is_reverse)
-                c += 1
+                batches = [blocks]
 
+            c = 0
+            for block_starts, block_ends, block_reads, n in batches:
+                for coverage, vector_start, (tileSize, nRegBins) in zip(coverages, vector_starts, tiles):
+                    coverage[vector_start:vector_start + nRegBins] += \
+                        self.coverage_from_blocks(block_starts, block_ends, block_reads,
+                                                  reg[0], reg[1], tileSize, nRegBins)
+                c += n
+
+            taskTrace.addCount('reads', c)
             if self.verbose:
                 endTime = time.time()
                 print("%s,  processing %s (%.1f per sec) reads @ %s:%s-%s" % (
                     multiprocessing.current_process().name, c, c / (endTime - start_time), chrom, reg[0], reg[1]))
 
-            vector_start += nRegBins
+            vector_starts = [vector_start + nRegBins for vector_start, (_, nRegBins) in zip(vector_starts, tiles)]
 
         # change zeros to NAN
         if self.zerosToNans:
-            coverages[coverages == 0] = np.nan
+            for coverage in coverages:
+                coverage[coverage == 0] = np.nan
 
+        if tileSizes is None:
+            return coverages[0]
         return coverages
 
+    def blocks_from_reads(self, reads, read_filter, fragmentFromRead_func):
+        """
+        Yields, for consecutive batches of read_filter.batchSize reads, the
+        starts and ends of the fragment blocks of the reads that pass
+        read_filter, the read number (within the batch) of each block and
+        the number of those reads. All the blocks of a read are in the same
+        batch.
+        """
+        for batch, mask, position_blocks in read_filter.batches(reads, fragmentFromRead_func):
+            block_starts = []
+            block_ends = []
+            block_reads = []
+            # since reads can be split (e.g. RNA-seq reads) each part of the
+            # read that maps is called a position block.
+            # the blocks are counted all at once, by coverage_from_blocks
+            for c, idx in enumerate(np.flatnonzero(mask)):
+                for fragmentStart, fragmentEnd in position_blocks[idx]:
+                    if fragmentEnd is None or fragmentStart is None:
+                        continue
+                    block_starts.append(fragmentStart)
+                    block_ends.append(fragmentEnd)
+                    block_reads.append(c)
+            yield block_starts, block_ends, block_reads, int(np.sum(mask))
+
+    def blocks_from_index(self, index, chrom, window, read_filter):
+        """
+        Like blocks_from_reads() for the reads of a fragment index (see
+        fragmentIndex) that overlap window, with the fragments of
+        get_fragment_from_read() computed for all the reads at once.
+
+        Returns None if some read lacks the information needed (e.g. it
+        has no reference end), such that the reads of the bam file are
+        used instead.
+        """
+        columns = index.columns(chrom)
+        idx = index.fetch(chrom, window[0], window[1])
+        reads = dict((name, np.asarray(values[idx])) for name, values in columns.items())
+        keep, _ = read_filter.mask(reads)
+        idx = idx[keep]
+        if self.defaultFragmentLength == 'read length':
+            block_starts, block_ends, block_reads = index.blocks(chrom, idx)
+            return block_starts, block_ends, block_reads, len(idx)
+
+        reads = dict((name, values[keep]) for name, values in reads.items())
+        start = reads['reference_start']
+        end = reads['reference_end']
+        if np.any(end < 0):
+            return None
+        flag = reads['flag']
+        tlen = np.abs(reads['template_length'])
+        pnext = reads['next_reference_start']
+        reverse = flag & 16 == 16
+        # as is_proper_pair()
+        proper = (flag & 2 == 2) & (reads['same_chrom'] == 1) & \
+            (tlen <= self.maxPairedFragmentLength) & (reverse != (flag & 32 == 32)) & \
+            np.where(reverse, start >= pnext, start <= pnext)
+        fragmentStart = np.where(proper,
+                                 np.where(reverse, pnext, start),
+                                 np.where(reverse, end - self.defaultFragmentLength, start))
+        fragmentEnd = np.where(proper,
+                               np.where(reverse, end, start + tlen),
+                               np.where(reverse, end, start + self.defaultFragmentLength))
+
+        if self.center_read:
+            query_length = reads['query_length']
+            if np.any(query_length < 0):
+                return None
+            # the same arithmetic as get_fragment_from_read()
+            divide = np.floor_divide if sys.version_info[0] == 2 else np.true_divide
+            fragmentCenter = fragmentEnd - divide(fragmentEnd - fragmentStart, 2)
+            fragmentStart = fragmentCenter - divide(query_length, 2)
+            fragmentEnd = fragmentStart + query_length
+
+        if np.any(fragmentStart >= fragmentEnd):
+            # get_fragment_from_read() raises the error
+            return None
+        return fragmentStart, fragmentEnd, np.arange(len(idx)), len(idx)
+
+    @staticmethod
+    def coverage_from_blocks(starts, ends, read_ids, reg_start, reg_end, tile_size, nbins):
+        """
+        Returns the number of blocks (the parts of a read or fragment, as
+        returned by get_fragment_from_read) that overlap each of the nbins
+        tiles of size tile_size starting at reg_start.
+
+        The blocks of a read (identified by read_ids, which must be sorted)
+        are counted once per tile: a block only counts on the tiles after
+        the last tile of the previous blocks of the same read.
+
+        The tiles are counted with a difference array, thus the cost does
+        not depend on the length of the blocks.
+
+        >>> CountReadsPerBin.coverage_from_blocks([0, 5, 25, 38], [10, 15, 30, 60], [0, 0, 1, 2], 0, 40, 10, 4)
+        array([ 1.,  1.,  1.,  1.])
+        >>> CountReadsPerBin.coverage_from_blocks([], [], [], 0, 40, 10, 4)
+        array([ 0.,  0.,  0.,  0.])
+        """
+        coverage = np.zeros(nbins, dtype='float64')
+        if len(starts) == 0 or nbins == 0:
+            return coverage
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        read_ids = np.asarray(read_ids, dtype=np.int64)
+
+        # skip empty blocks and blocks out of the region
+        keep = (ends != starts) & (ends > reg_start) & (starts < reg_end)
+        starts = starts[keep]
+        ends = ends[keep]
+        read_ids = read_ids[keep]
+        if len(starts) == 0:
+            return coverage
+
+        first_tile = np.maximum((starts - reg_start) // tile_size, 0)
+        # ceil((ends - reg_start) / tile_size)
+        last_tile = np.minimum(-((reg_start - ends) // tile_size), nbins)
+
+        # the last tile of the previous blocks of the same read is the
+        # running maximum of last_tile, taken over read_ids * stride +
+        # last_tile, such that the blocks of other reads do not count.
+        # Blocks ending before they start are ignored, unless they are
+        # the first block of the read.
+        stride = nbins + 1
+        offset = read_ids * stride
+        first_block = np.concatenate([[True], read_ids[1:] != read_ids[:-1]])
+        running = np.maximum.accumulate(offset + np.where(first_block | (first_tile < last_tile), last_tile, 0))
+        previous = np.concatenate([[-1], running[:-1]])
+        same_read = previous >= offset
+        first_tile = np.where(same_read, np.maximum(first_tile, previous - offset), first_tile)
+
+        counted = first_tile < last_tile
+        changes = np.bincount(first_tile[counted], minlength=stride) - \
+            np.bincount(last_tile[counted], minlength=stride)
+        coverage += np.cumsum(changes[:nbins])
+        return coverage
+
     def getReadLength(self, read):
         return len(read)
 
@@ -0,0 +1,139 @@
+import os
+import threading
+import collections
+import multiprocessing.util
+
+from deeptools import taskTrace
+from deeptools import threadBudget
+
+# maximum number of files kept open by each worker (thread)
+MAX_OPEN_FILES = 32
+
+# open handles of the current thread, see getHandle()
+_local = threading.local()
+
+# the process that registered closeAll() to be called at exit
+_finalizer_pid = None
+
+
+def getHandle(kind, fileName, opener):
+    """
+    Returns a handle of fileName, as returned by opener(fileName), reusing
+    the handle opened by a previous task of the same worker if the file
+    has not changed since. The tasks of mapReduce open their input files
+    (BAM, bigWig, 2bit) with this, such that the files are opened, and
+    their headers and indices checked, once per worker instead of once per
+    task.
+
+    The handles are kept per thread (the handles of pysam and pyBigWig can
+    not be used by several threads at once), the least recently used one
+    is closed when more than MAX_OPEN_FILES are open. The handles are
+    closed when the worker exits or by closeAll(). The number of files
+    opened and closed are counted in the trace of the tasks (see
+    taskTrace.addCount).
+
+    The handles must not be closed by the caller.
+
+    >>> import tempfile
+    >>> _, fileName = tempfile.mkstemp()
+    >>> getHandle('text', fileName, open) is getHandle('text', fileName, open)
+    True
+    >>> closeAll()
+    >>> os.remove(fileName)
+    """
+    handles = _handles()
+    key = (kind, fileName)
+    stamp = _fileStamp(fileName)
+    if key in handles:
+        handle, handle_stamp = handles[key]
+        del handles[key]
+        if handle_stamp == stamp:
+            # most recently used
+            handles[key] = (handle, handle_stamp)
+            return handle
+        # the file changed, e.g. it was replaced
+        _close(handle)
+
+    handle = opener(fileName)
+    taskTrace.addCount('files_opened', 1)
+    handles[key] = (handle, stamp)
+    while len(handles) > MAX_OPEN_FILES:
+        _, (old_handle, _) = handles.popitem(last=False)
+        _close(old_handle)
+    return handle
+
+
+def openBam(fileName, threads=None):
+    """
+    bamHandler.openBam, through the worker handle cache. By default the
+    file is decompressed with the threads of the current task (see
+    threadBudget).
+    """
+    from deeptools import bamHandler
+    if threads is None:
+        threads = threadBudget.threadsFor(fileName)
+    return getHandle(('bam', threads), fileName,
+                     lambda x: bamHandler.openBam(x, threads=threads))
+
+
+def openBigWig(fileName):
+    """
+    pyBigWig.open, through the worker handle cache
+    """
+    import pyBigWig
+    return getHandle('bigwig', fileName, pyBigWig.open)
+
+
+def openTwoBit(fileName):
+    """
+    twobitreader.TwoBitFile, through the worker handle cache
+    """
+    import twobitreader
+    return getHandle('2bit', fileName, twobitreader.TwoBitFile)
+
+
+def closeAll():
+    """
+    Closes the handles opened by the current thread
+    """
+    handles = getattr(_local, 'handles', None)
+    _local.handles = None
+    if handles is None or getattr(_local, 'pid', None) != os.getpid():
+        return
+    for handle, _ in handles.values():
+        _close(handle)
+
+
+def _handles():
+    global _finalizer_pid
+    # a forked worker must not share the open files of its parent
+    if getattr(_local, 'handles', None) is None or _local.pid != os.getpid():
+        _local.handles = collections.OrderedDict()
+        _local.pid = os.getpid()
+        if threading.current_thread().name == 'MainThread' and _finalizer_pid != os.getpid():
+            # the workers of a process pool run the tasks in their
+            # main thread, the handles are closed when they exit
+            multiprocessing.util.Finalize(None, closeAll, exitpriority=10)
+            _finalizer_pid = os.getpid()
+    return _local.handles
+
+
+def _fileStamp(fileName):
+    """
+    (inode, size, modification time) of the file, or None (e.g. for URLs)
+    """
+    try:
+        stat = os.stat(fileName)
+    except (OSError, TypeError, ValueError):
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime
+
+
+def _close(handle):
+    close = getattr(handle, 'close', None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            pass
+    taskTrace.addCount('files_closed', 1)
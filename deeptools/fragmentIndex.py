@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import shutil
+import numpy as np
+
+from deeptools import bamHandler
+from deeptools.utilities import toString
+
+VERSION = 2
+
+# the per read columns of the index, the pysam attribute names are used
+# where possible. fetch_end is the end used by fetch() (see
+# countReadsPerBin._fetchEnd) and max_fetch_end its running maximum.
+# same_chrom is reference_id == next_reference_id. reference_end and
+# query_length (infer_query_length(always=False)) are -1 for None.
+COLUMNS = ['reference_start', 'reference_end', 'fetch_end', 'max_fetch_end',
+           'flag', 'mapping_quality', 'template_length', 'next_reference_start',
+           'same_chrom', 'query_length']
+
+# the reads are written to the files of the index in chunks of this
+# many reads (and blocks)
+BUFFER_SIZE = 100000
+
+# indices already opened by this process, by bam file name (None if
+# the bam file has no usable index)
+_indices = {}
+
+
+def indexDir(bamFile):
+    """
+    The directory of the fragment index of a BAM file
+
+    >>> indexDir('/data/sample.bam')
+    '/data/sample.bam.dtfrag'
+    """
+    return bamFile + ".dtfrag"
+
+
+class FragmentIndex(object):
+    """
+    Columnar index of the mapped reads of a BAM file, built by
+    buildFragmentIndex, that gives the reads that pysam's fetch() would
+    return as numpy arrays.
+
+    For each chromosome, the directory has one file per column of the
+    reads, in the order of the BAM file (<n>.<column>.bin), the starts
+    and ends of the aligned blocks of the reads (as returned by
+    get_blocks(), <n>.block_starts.bin and <n>.block_ends.bin) and the
+    offset of the first block of each read (<n>.offsets.bin), as int64
+    values. manifest.json has the chromosomes and the size and
+    modification time of the BAM file, such that an index is not used
+    once the BAM file changes. The arrays are memory mapped as they are
+    needed.
+
+    >>> from deeptools.countReadsPerBin import Tester
+    >>> import tempfile
+    >>> test = Tester()
+    >>> out = tempfile.mkdtemp()
+    >>> index = build(test.bamFile2, os.path.join(out, "test2.dtfrag"))
+    >>> index.chroms
+    ['3R']
+    >>> idx = index.fetch('3R', 140, 160)
+    >>> index.columns('3R')['reference_start'][idx].tolist()
+    [100, 150, 150]
+    >>> [r.reference_start for r in bamHandler.openBam(test.bamFile2).fetch('3R', 140, 160)]
+    [100, 150, 150]
+    >>> starts, ends, read_ids = index.blocks('3R', idx)
+    >>> list(zip(starts.tolist(), ends.tolist(), read_ids.tolist()))
+    [(100, 150, 0), (150, 200, 1), (150, 200, 2)]
+    >>> shutil.rmtree(out)
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "manifest.json")) as fh:
+            self.manifest = json.load(fh)
+        self.chroms = [x[0] for x in self.manifest['chroms']]
+        self._files = dict((x[0], i) for i, x in enumerate(self.manifest['chroms']))
+        self._arrays = {}
+
+    def isFresh(self, bamFile):
+        """
+        True if the index was built from the current version of bamFile
+        """
+        if self.manifest.get('version') != VERSION:
+            return False
+        stat = os.stat(bamFile)
+        return self.manifest['bam_size'] == stat.st_size and \
+            self.manifest['bam_mtime'] == stat.st_mtime and \
+            os.path.getmtime(os.path.join(self.directory, "manifest.json")) >= stat.st_mtime
+
+    def _load(self, chrom, name):
+        key = (chrom, name)
+        if key not in self._arrays:
+            fileName = os.path.join(self.directory, "{}.{}.bin".format(self._files[chrom], name))
+            if os.path.getsize(fileName):
+                self._arrays[key] = np.memmap(fileName, dtype=np.int64, mode='r')
+            else:
+                # empty files can not be memory mapped
+                self._arrays[key] = np.zeros(0, dtype=np.int64)
+        return self._arrays[key]
+
+    def columns(self, chrom):
+        """
+        Returns a dictionary with the columns of the reads of chrom
+        """
+        return dict((name, self._load(chrom, name)) for name in self.manifest['columns'])
+
+    def fetch(self, chrom, start, end):
+        """
+        Returns the indices of the reads of chrom that
+        bam.fetch(chrom, start, end) returns (except unmapped reads)
+        """
+        if chrom not in self._files:
+            return np.zeros(0, dtype=np.int64)
+        columns = self.columns(chrom)
+        hi = np.searchsorted(columns['reference_start'], end, side='left')
+        lo = np.searchsorted(columns['max_fetch_end'][:hi], start, side='right')
+        return lo + np.flatnonzero(columns['fetch_end'][lo:hi] > start)
+
+    def blocks(self, chrom, idx):
+        """
+        Returns the starts and ends of the blocks of the reads idx of chrom,
+        and for each block the position in idx of its read
+        """
+        offsets = self._load(chrom, 'offsets')
+        first = np.asarray(offsets[idx], dtype=np.int64)
+        counts = np.asarray(offsets[np.asarray(idx) + 1], dtype=np.int64) - first
+        read_ids = np.repeat(np.arange(len(first)), counts)
+        # the position of each block in the blocks arrays
+        positions = np.arange(counts.sum()) + np.repeat(first - np.cumsum(counts) + counts, counts)
+        return self._load(chrom, 'block_starts')[positions], self._load(chrom, 'block_ends')[positions], read_ids
+
+
+class _ColumnFiles(object):
+    """
+    Appends rows of int64 values to one file per column, through a
+    buffer of BUFFER_SIZE rows
+    """
+
+    def __init__(self, prefix, names):
+        self.files = [open("{}.{}.bin".format(prefix, name), 'wb') for name in names]
+        # column major, such that each column of the buffer is written at once
+        self.buffer = np.zeros((BUFFER_SIZE, len(names)), dtype=np.int64, order='F')
+        self.rows = 0
+        self.written = 0
+
+    def __len__(self):
+        return self.written + self.rows
+
+    def append(self, row):
+        self.buffer[self.rows] = row
+        self.rows += 1
+        if self.rows == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        for column, fh in enumerate(self.files):
+            self.buffer[:self.rows, column].tofile(fh)
+        self.written += self.rows
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        for fh in self.files:
+            fh.close()
+
+
+def build(bamFile, directory=None, verbose=False):
+    """
+    Builds the index of bamFile and returns it. The index is written to
+    a temporary directory that is renamed at the end, replacing any
+    previous index.
+    """
+    if directory is None:
+        directory = indexDir(bamFile)
+    stat = os.stat(bamFile)
+    bam = bamHandler.openBam(bamFile)
+    tmpDir = "{}.tmp{}".format(directory, os.getpid())
+    if os.path.exists(tmpDir):
+        shutil.rmtree(tmpDir)
+    os.makedirs(tmpDir)
+
+    chroms = []
+    for i, chrom in enumerate(bam.references):
+        if verbose:
+            sys.stderr.write("indexing {}\n".format(chrom))
+        prefix = os.path.join(tmpDir, str(i))
+        reads = _ColumnFiles(prefix, COLUMNS)
+        offsets = _ColumnFiles(prefix, ['offsets'])
+        blocks = _ColumnFiles(prefix, ['block_starts', 'block_ends'])
+        previous_start = -1
+        max_fetch_end = -1
+        for read in bam.fetch(chrom):
+            if read.flag & 4:
+                continue
+            start = read.reference_start
+            if start < previous_start:
+                for files in [reads, offsets, blocks]:
+                    files.close()
+                shutil.rmtree(tmpDir)
+                sys.exit("The file {} is not sorted by position".format(bamFile))
+            previous_start = start
+            end = read.reference_end
+            fetch_end = end if end is not None and end > start else start + 1
+            max_fetch_end = max(fetch_end, max_fetch_end)
+            query_length = read.infer_query_length(always=False)
+            # in the order of COLUMNS
+            reads.append((start,
+                          end if end is not None else -1,
+                          fetch_end,
+                          max_fetch_end,
+                          read.flag,
+                          read.mapping_quality,
+                          read.template_length,
+                          read.next_reference_start,
+                          read.reference_id == read.next_reference_id,
+                          query_length if query_length is not None else -1))
+            offsets.append((len(blocks),))
+            for block in read.get_blocks():
+                blocks.append(block)
+        offsets.append((len(blocks),))
+
+        for files in [reads, offsets, blocks]:
+            files.close()
+        chroms.append([toString(chrom), len(reads), len(blocks)])
+    bam.close()
+
+    manifest = {'version': VERSION,
+                'bam': os.path.abspath(bamFile),
+                'bam_size': stat.st_size,
+                'bam_mtime': stat.st_mtime,
+                'columns': COLUMNS,
+                'chroms': chroms}
+    with open(os.path.join(tmpDir, "manifest.json"), 'w') as fh:
+        json.dump(manifest, fh)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(tmpDir, directory)
+    return FragmentIndex(directory)
+
+
+def getIndex(bamFile):
+    """
+    Returns the FragmentIndex of bamFile, or None if the bam file has no
+    index or it is older than the bam file
+    """
+    bamFile = toString(bamFile)
+    if bamFile not in _indices:
+        index = None
+        directory = indexDir(bamFile)
+        if os.path.exists(os.path.join(directory, "manifest.json")):
+            try:
+                index = FragmentIndex(directory)
+                if not index.isFresh(bamFile):
+                    index = None
+            except (IOError, OSError, ValueError, KeyError):
+                index = None
+        _indices[bamFile] = index
+    return _indices[bamFile]
@@ -0,0 +1,129 @@
+from deeptools import mapReduce
+
+
+def samplingWindows(chromSizes, windowSize, spacing, roundNumber):
+    """
+    Returns the (chrom, start, end) windows of the genome that are sampled
+    for the first time in the given round (see sampleRounds()).
+
+    In round 0, the windows of length windowSize start every `spacing`
+    bases. Each following round halves the spacing, thus, the new windows
+    start in between the windows of the previous rounds. The new windows
+    are trimmed such that they do not overlap the windows already sampled.
+
+    >>> samplingWindows([('chr1', 1000)], 150, 400, 0)
+    [('chr1', 0, 150), ('chr1', 400, 550), ('chr1', 800, 950)]
+    >>> samplingWindows([('chr1', 1000)], 150, 400, 1)
+    [('chr1', 200, 350), ('chr1', 600, 750)]
+    >>> samplingWindows([('chr1', 1000)], 150, 400, 2)
+    [('chr1', 150, 200), ('chr1', 350, 400), ('chr1', 550, 600), ('chr1', 750, 800), ('chr1', 950, 1000)]
+    """
+    return [window[:3] for window in _windows(chromSizes, windowSize, spacing, roundNumber)]
+
+
+def _windows(chromSizes, windowSize, spacing, roundNumber):
+    """
+    Returns the windows of samplingWindows() as (chrom, start, end,
+    sharedStart, sharedEnd) tuples, where sharedStart (sharedEnd) is True
+    if the window starts (ends) where a window of an earlier round ends
+    (starts).
+
+    >>> _windows([('chr1', 1000)], 150, 400, 1)
+    [('chr1', 200, 350, False, False), ('chr1', 600, 750, False, False)]
+    >>> _windows([('chr1', 1000)], 150, 400, 2)[:2]
+    [('chr1', 150, 200, True, True), ('chr1', 350, 400, True, True)]
+    """
+    step = float(spacing) / 2 ** roundNumber
+    # in round 0 all the grid points are new, later only the odd ones
+    first, every = (0, 1) if roundNumber == 0 else (1, 2)
+
+    def position(m):
+        return int(round(m * step))
+
+    windows = []
+    for chrom, size in chromSizes:
+        m = first
+        while position(m) < size:
+            start = position(m)
+            end = min(start + windowSize, size, position(m + 1))
+            sharedStart = sharedEnd = False
+            if roundNumber > 0:
+                # the previous grid point was sampled before
+                start = max(start, position(m - 1) + windowSize)
+                sharedStart = start == position(m - 1) + windowSize
+                # and so was the next one
+                sharedEnd = end == position(m + 1) and end < size
+            if start < end:
+                windows.append((chrom, start, end, sharedStart, sharedEnd))
+            m += every
+    return windows
+
+
+def readsOnce(reads, chrom, start, end, edges=None):
+    """
+    Yields the reads of the window that do not cross the edges shared
+    with the windows of earlier rounds, which already counted them (see
+    sampleRounds()). The edges are the (sharedStarts, sharedEnds) sets
+    of (chrom, position) tuples; if None, all the reads are yielded.
+    """
+    sharedStarts, sharedEnds = edges if edges is not None else ((), ())
+    checkStart = (chrom, start) in sharedStarts
+    checkEnd = (chrom, end) in sharedEnds
+    for read in reads:
+        if checkStart and read.reference_start < start:
+            continue
+        if checkEnd and read.reference_end is not None and read.reference_end > end:
+            continue
+        yield read
+
+
+def sampleRounds(staticArgs, func, chromSizes, windowSize, spacing,
+                 blackListFileName=None, numberOfProcessors=None, verbose=False):
+    """
+    Samples the genome in rounds, of increasing density, until the whole
+    genome has been sampled. For each round, the list of results of
+    func(chrom, start, end, staticArgs) for the new windows of the round
+    (see samplingWindows()) is yielded.
+
+    Unlike restarting the sampling with a smaller spacing, no window is
+    visited twice: the caller accumulates the results of each round and
+    stops iterating as soon as it has sampled enough. As the windows of a
+    round can end where those of the previous rounds start, the set of
+    (sharedStarts, sharedEnds) edges of the round is appended to
+    staticArgs and func should only use the reads that do not cross them
+    (see readsOnce()). The edges created by the blacklist are not shared.
+
+    Parameters
+    ----------
+    staticArgs : tuple
+        Arguments passed to func, see mapReduce.mapReduce.
+    func : function
+        The wrapper of the function that samples a window.
+    chromSizes : list
+        List of (chrom, size) tuples.
+    windowSize : int
+        Length of the sampled windows.
+    spacing : int
+        Distance between the starts of the windows of the first round.
+    blackListFileName : str
+        The parts of the windows within the regions of this BED file are
+        not sampled.
+    """
+    roundNumber = 0
+    while True:
+        step = float(spacing) / 2 ** roundNumber
+        windows = _windows(chromSizes, windowSize, spacing, roundNumber)
+        edges = (set((chrom, start) for chrom, start, end, sharedStart, _ in windows if sharedStart),
+                 set((chrom, end) for chrom, start, end, _, sharedEnd in windows if sharedEnd))
+        if verbose:
+            print("sampling {} windows of {} bases, {} bases apart".format(len(windows), windowSize, int(step)))
+        if len(windows):
+            yield mapReduce.mapReduce(tuple(staticArgs) + (edges,), func, chromSizes,
+                                      chunks=[window[:3] for window in windows],
+                                      blackListFileName=blackListFileName,
+                                      numberOfProcessors=numberOfProcessors,
+                                      verbose=verbose)
+        if step <= windowSize:
+            # the windows cover the whole genome
+            return
+        roundNumber += 1
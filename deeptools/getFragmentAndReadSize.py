@@ -1,20 +1,37 @@
+import os
+import sys
+import json
+import hashlib
+import tempfile
 import numpy as np
 
 # own tools
 from deeptools import bamHandler
+from deeptools import fileHandles
+from deeptools import genomeSampler
 from deeptools import mapReduce
+from deeptools.utilities import toString
 
 old_settings = np.seterr(all='ignore')
 
+# version of the saved stats files, see sampleLengths()
+STATS_VERSION = 3
+
+# the lengths already sampled by this process, by cache key
+_sampled = {}
+
 
 def getFragmentLength_wrapper(args):
     return getFragmentLength_worker(*args)
 
 
-def getFragmentLength_worker(chrom, start, end, bamFile, distanceBetweenBins):
+def getFragmentLength_worker(chrom, start, end, bamFile, distanceBetweenBins, edges=None):
     """
     Queries the reads at the given region for the distance between
-    reads and the read length
+    reads and the read length. The reads that cross the edges shared
+    with the regions sampled before are not used, such that the reads
+    overlapping two adjacent regions (see genomeSampler.sampleRounds)
+    are used once.
 
     Parameters
     ----------
@@ -28,6 +45,8 @@ def getFragmentLength_worker(chrom, start, end, bamFile, distanceBetweenBins):
         BAM file name
     distanceBetweenBins : int
         the number of bases at the end of each bin to ignore
+    edges : tuple
+        the (sharedStarts, sharedEnds) edges, see genomeSampler.readsOnce
 
     Returns
     -------
@@ -35,18 +54,18 @@ def getFragmentLength_worker(chrom, start, end, bamFile, distanceBetweenBins):
         an np.array, where first column is fragment length, the
         second is for read length
     """
-    bam = bamHandler.openBam(bamFile)
+    bam = fileHandles.openBam(bamFile)
     end = max(start + 1, end - distanceBetweenBins)
     if chrom in bam.references:
         reads = np.array([(abs(r.template_length), r.infer_query_length(always=False))
-                          for r in bam.fetch(chrom, start, end)
+                          for r in genomeSampler.readsOnce(bam.fetch(chrom, start, end), chrom, start, end, edges)
                           if r.is_proper_pair and r.is_read1])
         if not len(reads):
             # if the previous operation produces an empty list
             # it could be that the data is not paired, then
             # we try with out filtering
             reads = np.array([(abs(r.template_length), r.infer_query_length(always=False))
-                              for r in bam.fetch(chrom, start, end)])
+                              for r in genomeSampler.readsOnce(bam.fetch(chrom, start, end), chrom, start, end, edges)])
     else:
         raise NameError("chromosome {} not found in bam file".format(chrom))
 
@@ -79,23 +98,9 @@ def get_read_and_fragment_length(bamFile, return_lengths=False, blackListFileNam
         for the read length. The dictionaries summarise the mean, median etc. values
     """
 
-    bam_handle = bamHandler.openBam(bamFile)
-    chrom_sizes = list(zip(bam_handle.references, bam_handle.lengths))
-
-    distanceBetweenBins *= 2
-    fl = []
-    while len(fl) < 1000 and distanceBetweenBins > 1:
-        distanceBetweenBins /= 2
-        stepsize = binSize + distanceBetweenBins
-        imap_res = mapReduce.mapReduce((bam_handle.filename, distanceBetweenBins),
-                                       getFragmentLength_wrapper,
-                                       chrom_sizes,
-                                       genomeChunkLength=stepsize,
-                                       blackListFileName=blackListFileName,
-                                       numberOfProcessors=numberOfProcessors,
-                                       verbose=verbose)
-
-        fl = np.concatenate(imap_res)
+    fl = sampleLengths(bamFile, blackListFileName=blackListFileName, binSize=binSize,
+                       distanceBetweenBins=distanceBetweenBins,
+                       numberOfProcessors=numberOfProcessors, verbose=verbose)
 
     if len(fl):
         fragment_length = fl[:, 0]
@@ -130,3 +135,145 @@ def get_read_and_fragment_length(bamFile, return_lengths=False, blackListFileNam
         read_len_dict = None
 
     return fragment_len_dict, read_len_dict
+
+
+def sampleLengths(bamFile, blackListFileName=None, binSize=50000, distanceBetweenBins=1000000,
+                  numberOfProcessors=None, verbose=False):
+    """
+    Samples the fragment and read lengths of the reads of bamFile, see
+    get_read_and_fragment_length(). Returns an array with the fragment
+    lengths in the first column and the read lengths in the second, each
+    column in increasing order.
+
+    The lengths are sampled only once per process and their distribution
+    is also saved in the --workDir or, else, the temporary directory (see
+    _statsFile(), unless it is not writable), for the given sampling
+    parameters and blacklist, as long as the BAM file and the blacklist
+    are not modified.
+    """
+    try:
+        key = _statsKey(bamFile, blackListFileName, binSize, distanceBetweenBins)
+    except OSError:
+        # e.g. a file that does not exist, openBam() reports it below
+        key = None
+    if key in _sampled:
+        return _sampled[key]
+
+    stats = {'lengths': {}}
+    if key is not None:
+        statsFile = _statsFile(bamFile)
+        stats = _readStats(statsFile, bamFile)
+    if key in stats['lengths']:
+        fl = _lengths(stats['lengths'][key])
+        if verbose:
+            sys.stderr.write("fragment and read lengths read from {}\n".format(statsFile))
+    else:
+        bam_handle = bamHandler.openBam(bamFile)
+        chrom_sizes = list(zip(bam_handle.references, bam_handle.lengths))
+
+        # windows of binSize bases are sampled, in rounds of increasing
+        # density, until at least 1000 reads are found
+        fl = [np.array([]).reshape(0, 2)]
+        num_sampled = 0
+        for res in genomeSampler.sampleRounds((bam_handle.filename, 0),
+                                              getFragmentLength_wrapper,
+                                              chrom_sizes,
+                                              windowSize=binSize,
+                                              spacing=binSize + distanceBetweenBins,
+                                              blackListFileName=blackListFileName,
+                                              numberOfProcessors=numberOfProcessors,
+                                              verbose=verbose):
+            fl.extend(res)
+            num_sampled += sum(len(x) for x in res)
+            if num_sampled >= 1000:
+                break
+
+        distribution = _distribution(np.concatenate(fl))
+        fl = _lengths(distribution)
+        if key is None:
+            return fl
+        stats['lengths'][key] = distribution
+        _writeStats(statsFile, stats)
+
+    _sampled[key] = fl
+    return fl
+
+
+def _distribution(lengths):
+    """
+    Returns the [values, counts] of each column of lengths
+
+    >>> _distribution(np.array([[200, 50], [180, 50], [200, 36]]))
+    [[[180, 200], [1, 2]], [[36, 50], [1, 2]]]
+    """
+    return [[x.tolist() for x in np.unique(column, return_counts=True)]
+            for column in lengths.T]
+
+
+def _lengths(distribution):
+    """
+    Returns the lengths of a distribution (see _distribution()), the
+    lengths of each column in increasing order
+
+    >>> _lengths([[[180, 200], [1, 2]], [[36, 50], [1, 2]]]).tolist()
+    [[180, 36], [200, 50], [200, 50]]
+    """
+    return np.array([np.repeat(values, counts) for values, counts in distribution]).T.reshape(-1, 2)
+
+
+def _fingerprint(fileName):
+    stat = os.stat(fileName)
+    return [os.path.abspath(fileName), stat.st_size, stat.st_mtime]
+
+
+def _statsKey(bamFile, blackListFileName, binSize, distanceBetweenBins):
+    blackList = blackListFileName
+    if blackList is not None:
+        if not isinstance(blackList, (list, tuple)):
+            blackList = [blackList]
+        blackList = [_fingerprint(x) for x in blackList]
+    return json.dumps([_fingerprint(toString(bamFile)), blackList, binSize, distanceBetweenBins])
+
+
+def _statsFile(bamFile):
+    """
+    Returns the name of the file where the stats of bamFile are saved,
+    in the work directory of mapReduce, if any, or in the temporary
+    directory of the configuration
+    """
+    from deeptools import config as cfg
+    directory = mapReduce.getCheckpoint()[0]
+    if not directory or not os.path.isdir(directory):
+        directory = cfg.config.get('general', 'tmp_dir')
+        if directory == 'default' or not os.path.isdir(directory):
+            directory = tempfile.gettempdir()
+    digest = hashlib.sha1(os.path.abspath(toString(bamFile)).encode('utf-8')).hexdigest()
+    return os.path.join(directory, "_deeptools_stats_{}.json".format(digest))
+
+
+def _readStats(statsFile, bamFile):
+    """
+    Returns the contents of statsFile, or empty stats if it does
+    not exist or it is older than bamFile
+    """
+    stats = {'version': STATS_VERSION, 'bam': _fingerprint(bamFile), 'lengths': {}}
+    try:
+        with open(statsFile) as fh:
+            saved = json.load(fh)
+        if saved.get('version') == STATS_VERSION and saved.get('bam') == stats['bam']:
+            stats = saved
+    except (IOError, OSError, ValueError):
+        pass
+    return stats
+
+
+def _writeStats(statsFile, stats):
+    tmpFile = "{}.tmp{}".format(statsFile, os.getpid())
+    try:
+        with open(tmpFile, 'w') as fh:
+            json.dump(stats, fh)
+        os.rename(tmpFile, statsFile)
+    except (IOError, OSError):
+        # e.g. the directory is not writable
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
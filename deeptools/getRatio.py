@@ -1,29 +1,39 @@
 import numpy as np
 
+from deeptools.writeBedGraph import tileArray, asTiles
+
 old_settings = np.seterr(all='ignore')
 
 
 def compute_ratio(value1, value2, args):
+    """
+    The ratio (or log2, reciprocal ratio) of the arrays value1 and value2,
+    after adding the pseudocount to both.
+    """
     value1 = value1 + args['pseudocount']
     value2 = value2 + args['pseudocount']
 
-    ratio = float(value1) / value2
+    ratio = value1 / value2
     if args['valueType'] == 'log2':
         ratio = np.log2(ratio)
 
     elif args['valueType'] == 'reciprocal_ratio':
         # the reciprocal ratio of a/b
         # is a/b if a/b > 1 else -1* b/a
-        ratio = ratio if ratio >= 1 else -1.0 / ratio
+        ratio = np.where(ratio >= 1, ratio, -1.0 / ratio)
 
     return ratio
 
 
+@tileArray
 def getRatio(tileCoverage, args):
     r"""
     The mapreduce method calls this function
-    for each tile. The parameters (args) are fixed
-    in the main method.
+    for the tiles of each region, given as the rows of
+    tileCoverage (one column per sample), and gets a value
+    per tile. The parameters (args) are fixed
+    in the main method. The coverage of a single tile gives
+    a single value.
 
     >>> funcArgs= {'valueType': 'ratio', 'scaleFactors': (1,1), 'pseudocount': 1}
     >>> getRatio([9, 19], funcArgs)
@@ -34,9 +44,11 @@ def getRatio(tileCoverage, args):
     nan
     >>> getRatio([np.nan, 1.0], funcArgs)
     nan
+    >>> getRatio(np.array([[9, 19], [0, 0], [np.nan, 1.0]]), funcArgs)
+    array([0.5, 1. , nan])
     >>> funcArgs['valueType'] ='subtract'
     >>> getRatio([20, 10], funcArgs)
-    10
+    10.0
     >>> funcArgs['scaleFactors'] = (1, 0.5)
     >>> getRatio([10, 20], funcArgs)
     0.0
@@ -53,14 +65,9 @@ def getRatio(tileCoverage, args):
     >>> getRatio([1, 1], funcArgs)
     1.0
     """
-
-    value1 = args['scaleFactors'][0] * tileCoverage[0]
-    value2 = args['scaleFactors'][1] * tileCoverage[1]
-
-    # if any of the two values to compare
-    # is nan, return nan
-    if np.isnan(value1) or np.isnan(value2):
-        return np.nan
+    tiles, result = asTiles(tileCoverage)
+    value1 = args['scaleFactors'][0] * tiles[:, 0]
+    value2 = args['scaleFactors'][1] * tiles[:, 1]
 
     # ratio case
     if args['valueType'] in ['ratio', 'log2', 'reciprocal_ratio']:
@@ -77,4 +84,8 @@ def getRatio(tileCoverage, args):
         elif args['valueType'] == 'second':
             bin_value = value2
 
-    return bin_value
+    # if any of the two values to compare
+    # is nan, the value is nan
+    bin_value = np.where(np.isnan(value1) | np.isnan(value2), np.nan, bin_value)
+
+    return result(bin_value)
@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-import deeptools.mapReduce as mapReduce
+from deeptools import genomeSampler
 from deeptools import bamHandler
+from deeptools import fileHandles
 from deeptools import utilities
+from deeptools import readFilter
 import sys
 
 debug = 0
@@ -14,66 +16,23 @@ def getFractionKept_wrapper(args):
     return getFractionKept_worker(*args)
 
 
-def getFractionKept_worker(chrom, start, end, bamFile, args):
+def getFractionKept_worker(chrom, start, end, bamFile, args, edges=None):
     """
     Queries the BAM file and counts the number of alignments kept/found in the
-    first 50000 bases.
+    first 50000 bases. The alignments that cross the edges shared with the
+    regions sampled before are not counted, such that those overlapping two
+    adjacent regions (see genomeSampler.sampleRounds) are counted once.
     """
-    bam = bamHandler.openBam(bamFile)
+    bam = fileHandles.openBam(bamFile)
     end = min(end, start + 50000)
     tot = 0
     filtered = 0
-    prev_start_pos = None  # to store the start positions
     if chrom in bam.references:
-        for read in bam.fetch(chrom, start, end):
-            tot += 1
-            if args.minMappingQuality and read.mapq < args.minMappingQuality:
-                filtered += 1
-                continue
-
-            # filter reads based on SAM flag
-            if args.samFlagInclude and read.flag & args.samFlagInclude != args.samFlagInclude:
-                filtered += 1
-                continue
-            if args.samFlagExclude and read.flag & args.samFlagExclude != 0:
-                filtered += 1
-                continue
-
-            # fragment length filtering
-            if args.minFragmentLength > 0 and abs(read.template_length) < args.minFragmentLength:
-                filtered += 1
-                continue
-            if args.maxFragmentLength > 0 and abs(read.template_length) > args.maxFragmentLength:
-                filtered += 1
-                continue
-
-            # get rid of duplicate reads that have same position on each of the
-            # pairs
-            if args.ignoreDuplicates and prev_start_pos \
-                    and prev_start_pos == (read.reference_start, read.pnext, read.is_reverse):
-                filtered += 1
-                continue
-            prev_start_pos = (read.reference_start, read.pnext, read.is_reverse)
-
-            # If filterRNAstrand is in args, then filter accordingly
-            # This is very similar to what's used in the get_fragment_from_read function in the filterRnaStrand class
-            if hasattr(args, "filterRNAstrand"):
-                if read.is_paired:
-                    if args.filterRNAstrand == 'forward':
-                        if not ((read.flag & 128 == 128 and read.flag & 16 == 0) or (read.flag & 64 == 64 and read.flag & 32 == 0)):
-                            filtered += 1
-                            continue
-                    elif args.filterRNAstrand == 'reverse':
-                        if not (read.flag & 144 == 144 or read.flag & 96 == 96):
-                            filtered += 1
-                            continue
-                else:
-                    if args.filterRNAstrand == 'forward' and read.flag & 16 == 0:
-                        filtered += 1
-                        continue
-                    elif args.filterRNAstrand == 'reverse' and read.flag & 16 == 16:
-                        filtered += 1
-                        continue
+        read_filter = readFilter.ReadFilter.fromArgs(args)
+        alignments = genomeSampler.readsOnce(bam.fetch(chrom, start, end), chrom, start, end, edges)
+        for reads, keep in read_filter.batches(alignments):
+            tot += len(reads)
+            filtered += len(reads) - int(keep.sum())
 
     return (filtered, tot)
 
@@ -95,13 +54,12 @@ def fraction_kept(args):
     whichever is smaller (unless there are fewer than 100,000 alignments, in
     which case sample everything).
 
-    The sampling works by dividing the genome into bins and only looking at the
-    first 50000 bases. If this doesn't yield sufficient alignments then the bin
-    size is halved.
+    The sampling works by looking at windows of 50000 bases, 1 Mb apart.
+    If this doesn't yield sufficient alignments, windows in between those
+    already sampled are added (see genomeSampler.sampleRounds).
     """
     filtered = 0
     total = 0
-    distanceBetweenBins = 2000000
     bam_handle = bamHandler.openBam(args.bam)
     bam_mapped = utilities.bam_total_reads(bam_handle, args.ignoreForNormalization)
     num_needed_to_sample = max(bam_mapped if bam_mapped <= 100000 else 0, min(100000, 0.01 * bam_mapped))
@@ -111,22 +69,20 @@ def fraction_kept(args):
     else:
         chrom_sizes = list(zip(bam_handle.references, bam_handle.lengths))
 
-    while total < num_needed_to_sample and distanceBetweenBins > 50000:
-        # If we've iterated, then halve distanceBetweenBins
-        distanceBetweenBins /= 2
-        if distanceBetweenBins < 50000:
-            distanceBetweenBins = 50000
-
-        res = mapReduce.mapReduce((bam_handle.filename, args),
-                                  getFractionKept_wrapper,
-                                  chrom_sizes,
-                                  genomeChunkLength=distanceBetweenBins,
-                                  blackListFileName=args.blackListFileName,
-                                  numberOfProcessors=args.numberOfProcessors,
-                                  verbose=args.verbose)
-
+    for res in genomeSampler.sampleRounds((bam_handle.filename, args),
+                                          getFractionKept_wrapper,
+                                          chrom_sizes,
+                                          windowSize=50000,
+                                          spacing=1000000,
+                                          blackListFileName=args.blackListFileName,
+                                          numberOfProcessors=args.numberOfProcessors,
+                                          verbose=args.verbose):
         if len(res):
-            filtered, total = np.sum(res, axis=0)
+            round_filtered, round_total = np.sum(res, axis=0)
+            filtered += round_filtered
+            total += round_total
+        if total >= num_needed_to_sample:
+            break
 
     if total == 0:
         # This should never happen
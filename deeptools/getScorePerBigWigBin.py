@@ -8,6 +8,7 @@ import warnings
 # deepTools packages
 import deeptools.mapReduce as mapReduce
 import deeptools.utilities
+from deeptools import fileHandles
 # debug = 0
 
 old_settings = np.seterr(all='ignore')
@@ -59,7 +60,7 @@ def countFragmentsInRegions_worker(chrom, start, end,
 
     rows = 0
 
-    bigwig_handlers = [pyBigWig.open(bw) for bw in bigWigFiles]
+    bigwig_handlers = [fileHandles.openBigWig(bw) for bw in bigWigFiles]
 
     regions_to_consider = []
     if bedRegions:
@@ -5,9 +5,10 @@ from collections import OrderedDict
 import numpy as np
 from copy import deepcopy
 
-import pyBigWig
 from deeptools import getScorePerBigWigBin
 from deeptools import mapReduce
+from deeptools import sharedOutput
+from deeptools import fileHandles
 from deeptools.utilities import toString, toBytes
 
 old_settings = np.seterr(all='ignore')
@@ -173,6 +174,19 @@ def compute_sub_matrix_wrapper(args):
     return heatmapper.compute_sub_matrix_worker(*args)
 
 
+def compute_sub_matrix_shared_wrapper(args):
+    """
+    Like compute_sub_matrix_wrapper, but the sub matrix is written to the
+    SharedRows object given as last static argument, in the rows reserved
+    for the task (the last argument). In place of the sub matrix, the
+    (offset, number of rows) written is returned.
+    """
+    output = args[6]
+    sub_matrix, sub_regions, regions_no_score = \
+        heatmapper.compute_sub_matrix_worker(*(args[:6] + args[7:8]))
+    return output.write(args[-1], sub_matrix), sub_regions, regions_no_score
+
+
 class heatmapper(object):
     """
     Class to handle the reading and
@@ -233,36 +247,66 @@ class heatmapper(object):
             keepExons = allArgs.get("keepExons", keepExons)
 
         chromSizes, _ = getScorePerBigWigBin.getChromSizes(score_file_list)
-        res, labels = mapReduce.mapReduce([score_file_list, parameters],
-                                          compute_sub_matrix_wrapper,
-                                          chromSizes,
-                                          self_=self,
-                                          bedFile=regions_file,
-                                          blackListFileName=blackListFileName,
-                                          numberOfProcessors=parameters['proc number'],
-                                          includeLabels=True,
-                                          transcriptID=transcriptID,
-                                          exonID=exonID,
-                                          transcript_id_designator=transcript_id_designator,
-                                          keepExons=keepExons)
         # each worker in the pool returns a tuple containing
         # the submatrix data, the regions that correspond to the
-        # submatrix, and the number of regions lacking scores
-        # Since this is largely unsorted, we need to sort by group
-
-        # merge all the submatrices into matrix
-        matrix = np.concatenate([r[0] for r in res], axis=0)
+        # submatrix, and the number of regions lacking scores.
+        # These are collected as soon as they are returned.
+        sub_matrices = []
         regions = []
-        regions_no_score = 0
-        for idx in range(len(res)):
-            if len(res[idx][1]):
-                regions.extend(res[idx][1])
-                regions_no_score += res[idx][2]
+        counts = {'regions_no_score': 0}
+
+        def collect(result):
+            sub_matrices.append(result[0])
+            if len(result[1]):
+                regions.extend(result[1])
+                counts['regions_no_score'] += result[2]
+
+        # the workers write the sub matrices directly in a matrix shared
+        # with this process, in rows reserved for each task as it is
+        # created, unless the results are checkpointed (see CountReadsPerBin)
+        output = None
+        staticArgs = [score_file_list, parameters]
+        worker = compute_sub_matrix_wrapper
+        if mapReduce.getCheckpoint()[0] is None:
+            region_length = sum(parameters[x] for x in
+                                ['upstream', 'unscaled 5 prime', 'body', 'unscaled 3 prime', 'downstream'])
+            matrix_cols = len(score_file_list) * (region_length // parameters['bin size'])
+            output = sharedOutput.SharedRows(matrix_cols)
+            staticArgs = [score_file_list, parameters, output]
+            worker = compute_sub_matrix_shared_wrapper
+
+        def reserveRows(task):
+            # one row per region at most
+            return output.reserve(len(task[3]))
+
+        __, labels = mapReduce.mapReduce(staticArgs,
+                                         worker,
+                                         chromSizes,
+                                         self_=self,
+                                         bedFile=regions_file,
+                                         blackListFileName=blackListFileName,
+                                         numberOfProcessors=parameters['proc number'],
+                                         includeLabels=True,
+                                         transcriptID=transcriptID,
+                                         exonID=exonID,
+                                         transcript_id_designator=transcript_id_designator,
+                                         keepExons=keepExons,
+                                         consumer=collect,
+                                         taskInfo=reserveRows if output else None)
+        # Since the regions are ordered by position, we need to sort by group
+        regions_no_score = counts['regions_no_score']
         groups = [x[3] for x in regions]
         foo = sorted(zip(groups, list(range(len(regions))), regions))
         sortIdx = [x[1] for x in foo]
         regions = [x[2] for x in foo]
-        matrix = matrix[sortIdx]
+
+        # merge all the submatrices into matrix
+        if output is None:
+            matrix = np.concatenate(sub_matrices, axis=0)
+            matrix = matrix[sortIdx]
+        else:
+            matrix = output.rows(sub_matrices, order=sortIdx)
+            output.close()
 
         # mask invalid (nan) values
         matrix = np.ma.masked_invalid(matrix)
@@ -344,7 +388,7 @@ class heatmapper(object):
         # read BAM or scores file
         score_file_handlers = []
         for sc_file in score_file_list:
-            score_file_handlers.append(pyBigWig.open(sc_file))
+            score_file_handlers.append(fileHandles.openBigWig(sc_file))
 
         # determine the number of matrix columns based on the lengths
         # given by the user, times the number of score files
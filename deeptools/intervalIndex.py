@@ -0,0 +1,205 @@
+import os
+import json
+import atexit
+import hashlib
+import tempfile
+import numpy as np
+from deeptoolsintervals import GTF
+
+# indices already loaded by this process, by file names. Worker
+# processes forked after an index is loaded inherit it.
+_indices = {}
+
+# the pid of the main process (inherited by the forked workers), such
+# that concurrent runs do not share (and remove) each other's index files
+_runId = os.getpid()
+
+
+class IntervalIndex(object):
+    """
+    Immutable index of the intervals of one or more BED/GTF files (e.g. a
+    blacklist), for fast overlap queries.
+
+    For each chromosome, the intervals are kept sorted by start in numpy
+    arrays, together with the running maximum of their ends, such that
+    the overlaps of a region are found with two binary searches.
+
+    findOverlaps() returns the (start, end) of the intervals that overlap
+    a region, like GTF.findOverlaps() (which also returns the name, label,
+    exons and strand of each interval). The intervals are returned in the
+    same order and chromosome names are matched in the same way (e.g. chr1
+    and 1).
+
+    >>> root = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+    >>> bl = IntervalIndex.fromFiles(root + "test_filtering.blacklist.bed")
+    >>> bl.chroms
+    ['3R']
+    >>> bl.findOverlaps('3R', 0, 1000)
+    [(800, 900)]
+    >>> bl.findOverlaps('chr3R', 900, 1000)
+    []
+    >>> bl.findOverlaps('chrX', 0, 1000)
+    []
+    """
+
+    def __init__(self, data, chroms):
+        # data has three rows: starts, ends and the running maximum of
+        # the ends. chroms is {chrom: (first, last + 1) column of data}
+        self.data = data
+        self.offsets = chroms
+        self.chroms = sorted(chroms)
+
+    @classmethod
+    def fromFiles(cls, fileNames):
+        """
+        Parses the files (with deeptoolsintervals.GTF) and builds the index
+        """
+        gtf = GTF(fileNames)
+        starts = []
+        ends = []
+        chroms = {}
+        for chrom in gtf.chroms:
+            overlaps = gtf.findOverlaps(chrom, 0, 2 ** 31 - 1) or []
+            chroms[chrom] = (len(starts), len(starts) + len(overlaps))
+            starts.extend(x[0] for x in overlaps)
+            ends.extend(x[1] for x in overlaps)
+        data = np.zeros((3, len(starts)), dtype=np.int64)
+        data[0] = starts
+        data[1] = ends
+        for first, last in chroms.values():
+            if last > first:
+                data[2, first:last] = np.maximum.accumulate(data[1, first:last])
+        return cls(data, chroms)
+
+    def save(self, fileName):
+        """
+        Saves the index as a numpy array (fileName) and a list of the
+        chromosomes (fileName + '.chroms'). The array is renamed into place
+        last, thus an index is never read partially written.
+        """
+        with open(fileName + ".chroms.tmp", 'w') as fh:
+            json.dump(self.offsets, fh)
+        os.rename(fileName + ".chroms.tmp", fileName + ".chroms")
+        with open(fileName + ".tmp", 'wb') as fh:
+            np.save(fh, self.data)
+        os.rename(fileName + ".tmp", fileName)
+
+    @classmethod
+    def load(cls, fileName):
+        """
+        Loads an index saved by save(). The array is memory mapped, such
+        that all the processes that load the same index share its memory.
+        """
+        with open(fileName + ".chroms") as fh:
+            chroms = dict((k, tuple(v)) for k, v in json.load(fh).items())
+        return cls(np.load(fileName, mmap_mode='r'), chroms)
+
+    def matchChrom(self, chrom):
+        return matchChromName(chrom, self.offsets)
+
+    def findOverlaps(self, chrom, start, end):
+        """
+        Returns a list of the (start, end) of the intervals overlapping
+        [start, end), sorted by start
+        """
+        if len(self) == 0:
+            return None
+        chrom = self.matchChrom(chrom)
+        if chrom is None:
+            return []
+        first, last = self.offsets[chrom]
+        # intervals starting before the end of the region...
+        hi = first + np.searchsorted(self.data[0, first:last], end, side='left')
+        # ...after the first interval that ends after its start
+        lo = first + np.searchsorted(self.data[2, first:hi], start, side='right')
+        if lo >= hi:
+            return []
+        starts = self.data[0, lo:hi]
+        ends = self.data[1, lo:hi]
+        keep = ends > start
+        return list(zip(starts[keep].tolist(), ends[keep].tolist()))
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def __repr__(self):
+        return "IntervalIndex({} intervals on {} chromosomes)".format(len(self), len(self.chroms))
+
+
+def getIndex(fileNames):
+    """
+    Returns the IntervalIndex of the given files, building it only once
+    for all the processes of a run.
+
+    The first process that needs an index (usually the main process,
+    before any task is sent to the workers) parses the files and saves the
+    index in the temporary directory, under a name derived from the path,
+    size and modification time of the files. The other processes (e.g. the
+    workers) memory map that file. The index is also kept by each process,
+    thus workers that are forked afterwards inherit it.
+
+    :param fileNames: file name or list of file names
+    """
+    if not isinstance(fileNames, (list, tuple)):
+        fileNames = [fileNames]
+    key = tuple(fileNames)
+    if key not in _indices:
+        fileName = _indexFileName(fileNames)
+        if os.path.exists(fileName):
+            _indices[key] = IntervalIndex.load(fileName)
+        else:
+            _indices[key] = IntervalIndex.fromFiles(list(fileNames))
+            try:
+                _indices[key].save(fileName)
+                atexit.register(_removeIndex, fileName)
+            except (IOError, OSError):
+                # not shared, each process parses the files
+                pass
+    return _indices[key]
+
+
+def _indexFileName(fileNames):
+    fingerprints = []
+    for fileName in fileNames:
+        stat = os.stat(fileName)
+        fingerprints.append("{}:{}:{}".format(os.path.abspath(fileName), stat.st_size, stat.st_mtime))
+    digest = hashlib.sha1("\n".join(fingerprints).encode('utf-8')).hexdigest()
+    return os.path.join(_tempDir(), "_deeptools_intervals_{}_{}.npy".format(_runId, digest))
+
+
+def _tempDir():
+    # the same directory as utilities.getTempFileName
+    from deeptools import config as cfg
+    tmp_dir = cfg.config.get('general', 'tmp_dir')
+    if tmp_dir == 'default' or not os.path.isdir(tmp_dir):
+        return tempfile.gettempdir()
+    return tmp_dir
+
+
+def _removeIndex(fileName):
+    for name in [fileName, fileName + ".chroms"]:
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def matchChromName(chrom, names):
+    """
+    Returns the name in names that matches chrom, allowing
+    for the chr1 <-> 1 and chrM <-> MT conversions, or None
+
+    >>> matchChromName('chr1', ['1', '2'])
+    '1'
+    >>> matchChromName('MT', ['chrM']), matchChromName('chr3', ['1'])
+    ('chrM', None)
+    """
+    if chrom in names:
+        return chrom
+    if chrom == "MT" and "chrM" in names:
+        return "chrM"
+    if chrom == "chrM" and "MT" in names:
+        return "MT"
+    if chrom.startswith("chr") and len(chrom) > 3 and chrom[3:] in names:
+        return chrom[3:]
+    if "chr" + chrom in names:
+        return "chr" + chrom
+    return None
@@ -1,9 +1,56 @@
 import multiprocessing
+from multiprocessing.pool import ThreadPool
+import collections
+import contextlib
+import itertools
+import atexit
+import time
+import os
+import pickle
+import uuid
 from deeptoolsintervals import GTF
+from deeptools.checkpoint import Checkpoint
+from deeptools import taskTrace
+from deeptools import intervalIndex
+from deeptools import fileHandles
+from deeptools import threadBudget
 import random
 
 debug = 0
 
+# The pool of workers is shared by all the mapReduce calls of a
+# tool run, to avoid paying for the fork and teardown of the worker
+# processes on every call. Note that the workers are forked when the
+# pool is created, thus, module globals set afterwards by the parent
+# (e.g. the `global_vars` of the GC bias tools) are not seen by the
+# workers unless closePool() is called first.
+_pool = None
+_pool_key = None
+
+# The workers can be processes, threads (useful when most of the work
+# is done by C code that releases the GIL, as the results are not
+# pickled) or the calling process itself (serial)
+EXECUTORS = ('processes', 'threads', 'serial')
+_default_executor = 'processes'
+
+# see setCheckpoint()
+_default_work_dir = None
+_default_resume = False
+
+# see setTrace()
+_trace = None
+
+# state kept by each (worker) process between tasks and between
+# mapReduce calls, see workerCache()
+_worker_state = {}
+
+# static context (func, self_, staticArgs) of the mapReduce calls,
+# by token, see TaskContext. Contexts loaded by a worker from a file
+# are kept in _loaded_contexts, up to MAX_LOADED_CONTEXTS of them.
+_contexts = {}
+_loaded_contexts = collections.OrderedDict()
+MAX_LOADED_CONTEXTS = 4
+
 
 def mapReduce(staticArgs, func, chromSize,
               genomeChunkLength=None,
@@ -17,7 +64,14 @@ def mapReduce(staticArgs, func, chromSize,
               transcriptID="transcriptID",
               exonID="exonID",
               transcript_id_designator="transcript_id",
-              self_=None):
+              self_=None,
+              consumer=None,
+              maxTasksInFlight=None,
+              chunks=None,
+              executor=None,
+              workDir=None,
+              resume=False,
+              taskInfo=None):
     """
     Split the genome into parts that are sent to workers using a defined
     number of procesors. Results are collected and returned.
@@ -28,7 +82,9 @@ def mapReduce(staticArgs, func, chromSize,
      chrom, start, end, staticArgs
 
     The *arg* are static, *pickable* variables that need to be sent
-    to workers.
+    to workers. The static arguments, func and self_ are sent to each
+    worker process only once per mapReduce call (see TaskContext), the
+    tasks themselves only hold the region.
 
     The genome chunk length corresponds to a fraction of the genome, in bp,
     that is send to each of the workers for processing.
@@ -46,7 +102,9 @@ def mapReduce(staticArgs, func, chromSize,
                  following parameters (chrom, start, end, staticArgs)
     :param bedFile: Is a bed file is given, the args to the func to be
                     called are extended to include a list of bed
-                    defined regions.
+                    defined regions. The regions of a task are only
+                    looked up when the task is sent to the workers, and
+                    the results are collected in genomic order.
     :param blackListFileName: A list of regions to exclude from all computations.
                               Note that this has genomeChunkLength resolution...
     :param self_: In case mapreduce should make a call to an object
@@ -54,6 +112,44 @@ def mapReduce(staticArgs, func, chromSize,
     :param includeLabels: Pass group and transcript labels into the calling
                           function. These are added to the static args
                           (groupLabel and transcriptName).
+    :param consumer: If given, the results are not collected. Instead, the
+                     tasks are generated lazily, and each result is passed
+                     to consumer(result) as soon as all the results that
+                     precede it in genomic order have been passed. In this
+                     case None is returned in place of the results list.
+    :param maxTasksInFlight: Maximum number of tasks that have been sent to
+                             the workers but whose results have not yet been
+                             consumed. Only used together with 'consumer'.
+                             Default: 4 * numberOfProcessors
+    :param chunks: List of (chrom, start, end[, weight]) tuples, e.g. from
+                   chunkPlanner.planChunks. If given, these are used in place
+                   of splitting chromSize into genomeChunkLength pieces, and
+                   'region' is ignored. The tasks are sent to the workers
+                   from the largest to the smallest weight (default weight:
+                   end - start), all at once when the results are collected
+                   or in groups of about maxTasksInFlight / 2 tasks when a
+                   consumer is given, but the results are returned (or
+                   consumed) in the order of the chunks.
+    :param executor: One of 'processes', 'threads' or 'serial'. Default:
+                     the value set by setExecutor() ('processes' unless
+                     changed)
+    :param workDir: If given, the result of each task is saved in this
+                    directory as soon as it is ready (see checkpoint.py).
+                    Default: the value set by setCheckpoint()
+    :param resume: If True, the tasks whose result was saved in workDir
+                   by a previous run are not computed again.
+    :param taskInfo: If given, taskInfo(task) is called, in this process and
+                     in genomic order, as each task (chrom, start, end[, bed
+                     regions]) is created, and its return value is appended
+                     to the arguments of func. This is used to reserve the
+                     rows of a sharedOutput.SharedRows for each task.
+
+    If a trace file was set with setTrace(), the run time of each task and
+    of the consumer calls is recorded, and a summary is printed at the end.
+
+    When there are fewer tasks than processors, the idle processors are
+    given to the tasks as extra threads, which are used to decompress the
+    BAM files (see threadBudget).
 
     If "includeLabels" is true, a tuple of (results, labels) is returned
     """
@@ -62,6 +158,11 @@ def mapReduce(staticArgs, func, chromSize,
         genomeChunkLength = 1e5
     genomeChunkLength = int(genomeChunkLength)
 
+    if executor is None:
+        executor = _default_executor
+    if executor == 'serial':
+        numberOfProcessors = 1
+
     if verbose:
         print("genome partition size for multiprocessing: {0}".format(
             genomeChunkLength))
@@ -85,16 +186,27 @@ def mapReduce(staticArgs, func, chromSize,
         bed_interval_tree = GTF(bedFile, defaultGroup=defaultGroup, transcriptID=transcriptID, exonID=exonID, transcript_id_designator=transcript_id_designator, keepExons=keepExons)
 
     if blackListFileName:
-        blackList = GTF(blackListFileName)
-
-    TASKS = []
-    # iterate over all chromosomes
-    for chrom, size in chromSize:
-        # the start is zero unless a specific region is defined
-        start = 0 if region_start == 0 else region_start
-        for startPos in range(start, size, genomeChunkLength):
-            endPos = min(size, startPos + genomeChunkLength)
-
+        blackList = intervalIndex.getIndex(blackListFileName)
+
+    def genomeChunks():
+        if chunks is not None:
+            for chunk in chunks:
+                weight = chunk[3] if len(chunk) > 3 else chunk[2] - chunk[1]
+                yield chunk[0], chunk[1], chunk[2], weight
+            return
+        # iterate over all chromosomes
+        for chrom, size in chromSize:
+            # the start is zero unless a specific region is defined
+            start = 0 if region_start == 0 else region_start
+            for startPos in range(start, size, genomeChunkLength):
+                endPos = min(size, startPos + genomeChunkLength)
+                yield chrom, startPos, endPos, endPos - startPos
+
+    # weight of each task, used to send the largest tasks first
+    weights = collections.deque()
+
+    def tasks():
+        for chrom, startPos, endPos, weight in genomeChunks():
             # Reject a chunk if it overlaps
             if blackListFileName:
                 regions = blSubtract(blackList, chrom, [startPos, endPos])
@@ -102,14 +214,9 @@ def mapReduce(staticArgs, func, chromSize,
                 regions = [[startPos, endPos]]
 
             for reg in regions:
-                if self_ is not None:
-                    argsList = [self_]
-                else:
-                    argsList = []
-
-                argsList.extend([chrom, reg[0], reg[1]])
-                # add to argument list the static list received the the function
-                argsList.extend(staticArgs)
+                # the static arguments and self_ are added
+                # by the TaskContext, in the worker
+                argsList = [chrom, reg[0], reg[1]]
 
                 # if a bed file is given, append to the TASK list,
                 # a list of bed regions that overlap with the
@@ -130,18 +237,106 @@ def mapReduce(staticArgs, func, chromSize,
                     # add to argument list, the position of the bed regions to use
                     argsList.append(bed_regions_list)
 
-                TASKS.append(tuple(argsList))
-
-    if len(TASKS) > 1 and numberOfProcessors > 1:
-        if verbose:
-            print(("using {} processors for {} "
-                   "number of tasks".format(numberOfProcessors,
-                                            len(TASKS))))
-        random.shuffle(TASKS)
-        pool = multiprocessing.Pool(numberOfProcessors)
-        res = pool.map_async(func, TASKS).get(9999999)
+                if taskInfo is not None:
+                    argsList.append(taskInfo(tuple(argsList)))
+
+                weights.append(float(weight) * (reg[1] - reg[0]) / max(endPos - startPos, 1))
+                yield tuple(argsList)
+
+    if workDir is None:
+        workDir, resume = _default_work_dir, _default_resume
+    checkpoint = None
+    if workDir:
+        checkpoint = Checkpoint(workDir, resume, func, staticArgs, self_)
+
+    res = None
+    if consumer is None and bedFile:
+        # the bed regions of each task are looked up as the task is
+        # sent, thus, the tasks are not kept in a list (the regions of
+        # all of them could take more memory than the results)
+        res = []
+        consumer = res.append
+
+    context = TaskContext(func, staticArgs, self_)
+    context.threads = threadBudget.workerThreads(numberOfProcessors,
+                                                 expectedTasks(chromSize, genomeChunkLength, region_start, chunks))
+    # the checkpoint keys depend on func, not on the traced call
+    trace = _trace
+    startTime = time.time()
+    worker = context
+    if trace is not None:
+        worker = trace.wrap(context, getattr(func, '__name__', 'task'))
+        if consumer is not None:
+            consumer = trace.timedConsumer(consumer)
+
+    def submit(pool, task):
+        if checkpoint is not None:
+            return checkpoint.submit(pool, worker, task)
+        return pool.apply_async(worker, (task,))
+
+    def run(task):
+        if checkpoint is not None:
+            return checkpoint.submit(None, worker, task).get()
+        return worker(task)
+
+    if consumer is not None:
+        # look ahead two tasks to decide whether a pool is worth it
+        TASKS = tasks()
+        head = list(itertools.islice(TASKS, 2))
+        TASKS = itertools.chain(head, TASKS)
+        if len(head) > 1 and numberOfProcessors > 1:
+            if maxTasksInFlight is None:
+                maxTasksInFlight = 4 * numberOfProcessors
+            if verbose:
+                print("using {} {}, with at most {} tasks "
+                      "in flight".format(numberOfProcessors, executor, maxTasksInFlight))
+            pool = getPool(numberOfProcessors, executor)
+            context.share(executor)
+            # largest tasks first within each group of tasks
+            for result in imapBounded(pool, worker, TASKS, maxTasksInFlight,
+                                      submit=submit, weights=weights):
+                consumer(result)
+        else:
+            for task in TASKS:
+                # the weights are only used by the pool
+                weights.clear()
+                consumer(run(task))
     else:
-        res = list(map(func, TASKS))
+        TASKS = list(tasks())
+        weights = list(weights)
+        context.threads = threadBudget.workerThreads(numberOfProcessors, len(TASKS))
+        if len(TASKS) > 1 and numberOfProcessors > 1:
+            if verbose:
+                print(("using {} processors for {} "
+                       "number of tasks".format(numberOfProcessors,
+                                                len(TASKS))))
+            pool = getPool(numberOfProcessors, executor)
+            context.share(executor)
+            if chunks is not None:
+                # largest tasks first, such that no worker is left
+                # processing a large task at the end
+                order = sorted(range(len(TASKS)), key=lambda i: -weights[i])
+            else:
+                order = list(range(len(TASKS)))
+                random.shuffle(order)
+            if checkpoint is not None:
+                # each result is saved as soon as it is ready
+                pending = {}
+                for i in order:
+                    pending[i] = submit(pool, TASKS[i])
+                res = [pending[i].get(9999999) for i in range(len(TASKS))]
+            else:
+                sorted_res = pool.map_async(worker, [TASKS[i] for i in order],
+                                            chunksize=1 if chunks is not None else None).get(9999999)
+                res = [None] * len(TASKS)
+                for i, result in zip(order, sorted_res):
+                    res[i] = result
+        else:
+            res = list(map(run, TASKS))
+
+    context.close()
+    if trace is not None:
+        trace.finish(getattr(func, '__name__', 'mapReduce'), startTime, numberOfProcessors)
 
     if includeLabels:
         if bedFile:
@@ -151,6 +346,293 @@ def mapReduce(staticArgs, func, chromSize,
     return res
 
 
+class TaskContext(object):
+    """
+    The part of the arguments of func that is the same for all the tasks
+    of a mapReduce call: func itself, self_ and the static arguments.
+
+    Calling the object with a task (chrom, start, end[, bed regions])
+    calls func with the complete arguments
+    (self_, chrom, start, end, staticArgs..., bed regions).
+
+    When the object is pickled (i.e. sent to a worker process along with
+    each task) only a token is sent. The context itself is pickled once,
+    by share(), to a temporary file that each worker process loads on
+    first use and keeps for the next tasks. Threads use the context of
+    the calling process directly.
+
+    >>> context = TaskContext(lambda args: args, [5, 6], self_='self')
+    >>> context(('chr1', 0, 100, ['bed regions']))
+    ('self', 'chr1', 0, 100, 5, 6, ['bed regions'])
+    >>> len(pickle.dumps(context)) < 200
+    True
+    >>> context.close()
+    """
+
+    def __init__(self, func, staticArgs, self_=None):
+        self.token = uuid.uuid4().hex
+        self.fileName = None
+        # extra threads of each task, see threadBudget
+        self.threads = 0
+        _contexts[self.token] = (func, self_, tuple(staticArgs))
+
+    def __getstate__(self):
+        return {'token': self.token, 'fileName': self.fileName, 'threads': self.threads}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def share(self, executor):
+        """
+        Saves the context for the worker processes, unless
+        they are threads of the calling process.
+        """
+        if executor not in ('threads', 'serial') and self.fileName is None:
+            # imported here, utilities imports this module
+            from deeptools.utilities import getTempFileName
+            fileName = getTempFileName(suffix='.context')
+            with open(fileName, 'wb') as fh:
+                pickle.dump(_contexts[self.token], fh, protocol=pickle.HIGHEST_PROTOCOL)
+            self.fileName = fileName
+            # in case the mapReduce call fails
+            atexit.register(self.close)
+
+    def load(self):
+        if self.token in _contexts:
+            return _contexts[self.token]
+        if self.token not in _loaded_contexts:
+            with open(self.fileName, 'rb') as fh:
+                _loaded_contexts[self.token] = pickle.load(fh)
+            while len(_loaded_contexts) > MAX_LOADED_CONTEXTS:
+                _loaded_contexts.popitem(last=False)
+        return _loaded_contexts[self.token]
+
+    def __call__(self, task):
+        func, self_, staticArgs = self.load()
+        args = [self_] if self_ is not None else []
+        args.extend(task[:3])
+        args.extend(staticArgs)
+        args.extend(task[3:])
+        previous = threadBudget.setWorkerThreads(self.threads)
+        try:
+            return func(tuple(args))
+        finally:
+            threadBudget.setWorkerThreads(previous)
+
+    def close(self):
+        _contexts.pop(self.token, None)
+        if self.fileName is not None and os.path.exists(self.fileName):
+            os.remove(self.fileName)
+
+
+def setExecutor(executor):
+    """
+    Sets the executor used by default by mapReduce and getPool.
+
+    :param executor: One of 'processes', 'threads' or 'serial'
+    """
+    global _default_executor
+    if executor not in EXECUTORS:
+        raise ValueError("Unknown executor '{}'. Valid options are: "
+                         "{}".format(executor, ", ".join(EXECUTORS)))
+    _default_executor = executor
+
+
+def getExecutor():
+    """
+    Returns the executor used by default
+    """
+    return _default_executor
+
+
+def setCheckpoint(workDir, resume=False):
+    """
+    Sets the work directory in which mapReduce saves the result of each
+    task by default, and whether the results saved by a previous run
+    are used.
+
+    :param workDir: directory name, or None to not save the results
+    :param resume: use the results of a previous run
+    """
+    global _default_work_dir, _default_resume
+    if resume and not workDir:
+        raise ValueError("A work directory is needed to resume a run")
+    _default_work_dir = workDir
+    _default_resume = resume
+
+
+def setTrace(fileName):
+    """
+    Enables the tracing of the mapReduce calls. The start and end time,
+    worker, region and result size of each task are saved in fileName in
+    the Chrome trace event format (see taskTrace.py) after each call, and
+    a summary of the usage of the workers is printed to stderr.
+
+    :param fileName: name of the trace file, or None to disable tracing
+    """
+    global _trace
+    if _trace is not None:
+        _trace.close()
+    _trace = taskTrace.Trace(fileName) if fileName else None
+
+
+def getCheckpoint():
+    """
+    Returns the (work directory, resume) set by setCheckpoint()
+    """
+    return _default_work_dir, _default_resume
+
+
+def getPool(numberOfProcessors, executor=None):
+    """
+    Returns the pool of workers shared by all the mapReduce calls. The
+    pool is created on first use and is replaced if a different number of
+    processors or a different executor is requested.
+
+    :param numberOfProcessors: number of worker processes (or threads)
+    :param executor: 'processes' or 'threads'. Default: see setExecutor()
+    """
+    global _pool, _pool_key
+    if executor is None:
+        executor = _default_executor
+    if executor == 'serial':
+        # a pool that runs the tasks in the calling thread is not
+        # available, a single worker is the closest
+        executor = 'threads'
+        numberOfProcessors = 1
+    key = (executor, numberOfProcessors)
+    if _pool is not None and _pool_key != key:
+        closePool()
+    if _pool is None:
+        if executor == 'threads':
+            _pool = ThreadPool(numberOfProcessors)
+        else:
+            _pool = multiprocessing.Pool(numberOfProcessors)
+        _pool_key = key
+    return _pool
+
+
+def closePool():
+    """
+    Shuts down the shared pool of workers, if any. A new pool is created
+    by the next call to getPool(). This is also called at exit. The files
+    kept open by the workers (see fileHandles) are closed as they exit,
+    those of the calling thread (e.g. by the serial executor) here.
+    """
+    global _pool, _pool_key
+    fileHandles.closeAll()
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+        _pool_key = None
+
+
+atexit.register(closePool)
+
+
+@contextlib.contextmanager
+def sharedPool(numberOfProcessors, executor=None):
+    """
+    Context manager that yields the shared pool of workers and shuts it
+    down on exit.
+
+    >>> with sharedPool(2) as pool:
+    ...     pool.map(abs, [-1, -2])
+    [1, 2]
+    >>> _pool is None
+    True
+    """
+    try:
+        yield getPool(numberOfProcessors, executor)
+    finally:
+        closePool()
+
+
+def workerCache(key, factory):
+    """
+    Returns the object stored under `key` in the state of the current
+    process, calling factory() to create it on first use. Because the
+    pool of workers is kept alive between mapReduce calls, this allows
+    workers to keep objects that are expensive to create (e.g. a parsed
+    blacklist) from one task to the next.
+
+    >>> workerCache(('doctest', 1), list) is workerCache(('doctest', 1), list)
+    True
+    """
+    try:
+        return _worker_state[key]
+    except KeyError:
+        _worker_state[key] = factory()
+        return _worker_state[key]
+
+
+def imapBounded(pool, func, tasks, maxTasksInFlight, submit=None, weights=None):
+    """
+    Like pool.imap(func, tasks), but the tasks iterator is only advanced
+    when fewer than maxTasksInFlight results are pending. The results are
+    yielded in the same order as the tasks.
+
+    pool.imap reads the whole tasks iterator up front, which would
+    keep every task (and then every result) in memory.
+
+    If given, submit(pool, task) is used in place of
+    pool.apply_async(func, (task,)).
+
+    If weights is given, a deque with the weight of each task that is
+    read from tasks, the tasks are read in groups of about half of
+    maxTasksInFlight and the tasks of each group are sent from the
+    largest to the smallest weight, such that no worker is left
+    processing a large task at the end. The results are still yielded
+    in the order of the tasks.
+
+    >>> from multiprocessing.pool import ThreadPool
+    >>> list(imapBounded(ThreadPool(2), abs, iter([-3, 2, -1]), 2))
+    [3, 2, 1]
+    >>> list(imapBounded(ThreadPool(2), abs, iter([-3, 2, -1]), 4, weights=collections.deque([1, 5, 2])))
+    [3, 2, 1]
+    """
+    if submit is None:
+        def submit(pool, task):
+            return pool.apply_async(func, (task,))
+    tasks = iter(tasks)
+    # more tasks are read once no more than `refill` results are pending
+    refill = maxTasksInFlight - 1 if weights is None else maxTasksInFlight // 2
+    pending = collections.deque()
+    exhausted = False
+    while True:
+        if not exhausted and len(pending) <= refill:
+            size = maxTasksInFlight - len(pending)
+            group = list(itertools.islice(tasks, size))
+            exhausted = len(group) < size
+            order = range(len(group))
+            if weights is not None:
+                groupWeights = [weights.popleft() for _ in group]
+                order = sorted(order, key=lambda i: -groupWeights[i])
+            results = [None] * len(group)
+            for i in order:
+                results[i] = submit(pool, group[i])
+            pending.extend(results)
+        if not pending:
+            return
+        yield pending.popleft().get(9999999)
+
+
+def expectedTasks(chromSize, genomeChunkLength, region_start=0, chunks=None):
+    """
+    Number of tasks of a mapReduce call, before the blacklist is
+    subtracted and the regions without BED entries are skipped
+
+    >>> expectedTasks([('chr1', 1000), ('chr2', 50)], 300)
+    5
+    >>> expectedTasks([], 300, chunks=[('chr1', 0, 10)])
+    1
+    """
+    if chunks is not None and hasattr(chunks, '__len__'):
+        return len(chunks)
+    return sum(max(-(-(size - region_start) // genomeChunkLength), 0) for _, size in chromSize)
+
+
 def getUserRegion(chrom_sizes, region_string, max_chunk_size=1e6):
     r"""
     Verifies if a given region argument, given by the user
@@ -164,6 +164,15 @@ def bamcorrelate_args(case='bins'):
                        help='Save the counts per region to a tab-delimited file.',
                        metavar='FILE')
 
+    group.add_argument('--countsDtype',
+                       help='Data type of the coverage matrix, in memory and in '
+                       'the --outFileName file. uint32 and float32 take half the '
+                       'space of float64, uint16 a quarter. Counts larger than '
+                       'the maximum of uint16 (65535) or uint32 are truncated '
+                       'and a warning is printed.',
+                       choices=countR.COUNTS_DTYPES,
+                       default='float64')
+
     return parser
 
 
@@ -188,6 +197,7 @@ def main(args=None):
 
     """
     args = process_args(args)
+    parserCommon.apply_run_options(args)
 
     if 'BED' in args:
         bed_regions = args.BED
@@ -219,7 +229,8 @@ def main(args=None):
         maxFragmentLength=args.maxFragmentLength,
         stepSize=stepsize,
         zerosToNans=False,
-        out_file_for_raw_data=args.outRawCounts)
+        out_file_for_raw_data=args.outRawCounts,
+        countsDtype=args.countsDtype)
 
     num_reads_per_bin = c.run(allArgs=args)
 
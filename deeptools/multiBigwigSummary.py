@@ -195,6 +195,7 @@ def main(args=None):
 
     """
     args = process_args(args)
+    parserCommon.apply_run_options(args)
 
     if 'BED' in args:
         bed_regions = args.BED
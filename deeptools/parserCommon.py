@@ -1,4 +1,5 @@
 import argparse
+import sys
 import deeptools.config as cfg
 import os
 from deeptools._version import __version__
@@ -266,7 +267,7 @@ def normalization_options():
     return parser
 
 
-def getParentArgParse(args=None, binSize=True, blackList=True):
+def getParentArgParse(args=None, binSize=True, blackList=True, checkpoint=True, trace=True, memory=True):
     """
     Typical arguments for several tools
     """
@@ -312,6 +313,33 @@ def getParentArgParse(args=None, binSize=True, blackList=True):
                                                  'default_proc_number'),
                           required=False)
 
+    optional.add_argument('--executor',
+                          help='How the work is distributed among the '
+                          '--numberOfProcessors workers. "processes" uses '
+                          'separate processes. "threads" uses threads of a '
+                          'single process, which avoids copying the data '
+                          'between processes and is usually faster when most '
+                          'of the time is spent reading BAM or bigWig files. '
+                          '"serial" does all the work in a single process.',
+                          choices=['processes', 'threads', 'serial'],
+                          default=cfg.config.get('general',
+                                                 'default_executor'),
+                          required=False)
+
+    if memory:
+        optional.add_argument('--maxWorkerMemory',
+                              help='Approximate memory, in MB, that each of the '
+                              '--numberOfProcessors workers should use at most. '
+                              'When reading BAM files, the parts of the genome '
+                              'expected to hold more reads than fit in that memory '
+                              '(e.g. rDNA or chrM) are split further. By default '
+                              'there is no limit.',
+                              metavar="INT",
+                              type=int,
+                              required=False)
+
+    run_options(optional, checkpoint=checkpoint, trace=trace)
+
     optional.add_argument('--verbose', '-v',
                           help='Set to see processing messages.',
                           action='store_true')
@@ -319,6 +347,67 @@ def getParentArgParse(args=None, binSize=True, blackList=True):
     return parser
 
 
+def run_options(group, checkpoint=True, trace=True):
+    """
+    Adds the --workDir and --resume options (if checkpoint is True) and
+    the --trace option (if trace is True) to the given parser or argument
+    group. The tools need to call apply_run_options() with the parsed
+    arguments.
+    """
+    if checkpoint:
+        group.add_argument('--workDir',
+                           help='Directory in which the partial results are saved '
+                           'as soon as they are computed. If a run is interrupted '
+                           '(e.g. killed for using too much memory), it can be '
+                           'restarted with the same options plus --resume, and the '
+                           'parts that were already computed are not computed '
+                           'again. The directory is not removed at the end of '
+                           'the run.',
+                           metavar="DIR",
+                           required=False)
+
+        group.add_argument('--resume',
+                           help='Use the partial results saved in --workDir by a '
+                           'previous run with the same options and input files.',
+                           action='store_true')
+
+    if trace:
+        group.add_argument('--trace',
+                           help='File name to save, in Chrome trace format '
+                           '(see chrome://tracing or https://ui.perfetto.dev), when '
+                           'and where each part of the genome was processed. '
+                           'A summary of the processor usage and of the slowest '
+                           'parts is also printed.',
+                           metavar="FILE",
+                           required=False)
+
+
+def apply_run_options(args):
+    """
+    Passes the --executor, --workDir, --resume and --trace options to
+    mapReduce and the --maxWorkerMemory option to chunkPlanner
+    """
+    from deeptools import mapReduce
+    from deeptools import chunkPlanner
+    executor = getattr(args, 'executor', None)
+    if not executor:
+        executor = cfg.config.get('general', 'default_executor')
+    try:
+        mapReduce.setExecutor(executor)
+    except ValueError as e:
+        sys.exit("\n--executor: {}\n".format(e))
+    workDir = getattr(args, 'workDir', None)
+    resume = getattr(args, 'resume', False)
+    if resume and not workDir:
+        sys.exit("\n--resume requires --workDir\n")
+    mapReduce.setCheckpoint(workDir, resume)
+    mapReduce.setTrace(getattr(args, 'trace', None))
+    try:
+        chunkPlanner.setMemoryLimit(getattr(args, 'maxWorkerMemory', None))
+    except ValueError as e:
+        sys.exit("\n--maxWorkerMemory: {}\n".format(e))
+
+
 def numberOfProcessors(string):
     import multiprocessing
     availProc = multiprocessing.cpu_count()
@@ -123,6 +123,7 @@ def required_args():
 
 def main(args=None):
     args = process_args(args)
+    parserCommon.apply_run_options(args)
     cr = countR.CountReadsPerBin(args.bamfiles,
                                  binLength=1,
                                  numberOfSamples=args.numberOfSamples,
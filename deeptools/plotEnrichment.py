@@ -10,12 +10,12 @@ import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 
 from deeptools.mapReduce import mapReduce, getUserRegion, blSubtract
-from deeptools import parserCommon, utilities
+from deeptools import parserCommon, utilities, intervalIndex, readFilter
 from deeptools.getScaleFactor import fraction_kept
 from deeptools.getFragmentAndReadSize import get_read_and_fragment_length
 from deeptools.utilities import getCommonChrNames, mungeChromosome
 from deeptools.bamHandler import openBam
-from deeptoolsintervals import Enrichment, GTF
+from deeptoolsintervals import Enrichment
 from deeptools.countReadsPerBin import CountReadsPerBin as cr
 
 
@@ -223,29 +223,9 @@ def getEnrichment_worker(arglist):
 
         chrom = mungeChromosome(chrom, fh.references)
 
-        prev_start_pos = None  # to store the start positions
-        for read in fh.fetch(chrom, start, end):
-            # Filter
-            if read.pos < start:
-                # Ensure that a given alignment is processed only once
-                continue
-            if read.flag & 4:
-                continue
-            if args.minMappingQuality and read.mapq < args.minMappingQuality:
-                continue
-            if args.samFlagInclude and read.flag & args.samFlagInclude != args.samFlagInclude:
-                continue
-            if args.samFlagExclude and read.flag & args.samFlagExclude != 0:
-                continue
-            if args.minFragmentLength > 0 and abs(read.template_length) < args.minFragmentLength:
-                continue
-            if args.maxFragmentLength > 0 and abs(read.template_length) > args.maxFragmentLength:
-                continue
-            if args.ignoreDuplicates and prev_start_pos \
-                    and prev_start_pos == (read.reference_start, read.pnext, read.is_reverse):
-                continue
-            prev_start_pos = (read.reference_start, read.pnext, read.is_reverse)
-
+        # Ensure that a given alignment is processed only once
+        reads = (r for r in fh.fetch(chrom, start, end) if r.pos >= start and not r.flag & 4)
+        for read in readFilter.ReadFilter.fromArgs(args).filter(reads):
             # Get blocks, possibly extending
             features = gtf.findOverlaps(chrom, getBAMBlocks(read, defaultFragmentLength, args.centerReads))
 
@@ -327,7 +307,7 @@ def getChunkLength(args, chromSize):
 
     bl = None
     if args.blackListFileName:
-        bl = GTF(args.blackListFileName)
+        bl = intervalIndex.getIndex(args.blackListFileName)
 
     lengths = []
     for k, v in chromSize:
@@ -349,6 +329,7 @@ def getChunkLength(args, chromSize):
 def main(args=None):
 
     args = parse_arguments().parse_args(args)
+    parserCommon.apply_run_options(args)
 
     if args.labels is None:
         args.labels = args.bamfiles
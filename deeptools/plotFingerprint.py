@@ -136,6 +136,7 @@ def get_output_args():
 
 def main(args=None):
     args = process_args(args)
+    parserCommon.apply_run_options(args)
 
     cr = countR.CountReadsPerBin(
         args.bamfiles,
@@ -0,0 +1,210 @@
+from itertools import islice
+from operator import attrgetter
+import numpy as np
+
+# reads are filtered in batches of this size
+BATCH_SIZE = 10000
+
+
+class ReadFilter(object):
+    """
+    The read filters shared by the tools that process BAM files (minimum
+    mapping quality, SAM flags, fragment length, duplicates and RNA strand).
+
+    The reads are taken in batches, the attributes needed by the active
+    filters are copied into numpy columns (one C level attrgetter call per
+    read) and all the filters are applied at once as boolean masks.
+
+    The filters are applied in this order:
+
+    * minMappingQuality, samFlagInclude, samFlagExclude, minFragmentLength
+      and maxFragmentLength
+    * ignoreDuplicates: a read is a duplicate if its start, mate start and
+      strand are those of the previous read that passed the filters above.
+    * filterRNAstrand ('forward' or 'reverse')
+
+    >>> from deeptools.countReadsPerBin import Tester
+    >>> import pysam
+    >>> bam = pysam.AlignmentFile(Tester().bamFile_PE)
+    >>> len(list(bam.fetch('chr2')))
+    47
+    >>> len(list(ReadFilter(samFlagExclude=16).filter(bam.fetch('chr2'))))
+    24
+    >>> len(list(ReadFilter(minFragmentLength=200, ignoreDuplicates=True).filter(bam.fetch('chr2'))))
+    25
+    """
+
+    def __init__(self, minMappingQuality=None, samFlagInclude=None, samFlagExclude=None,
+                 minFragmentLength=0, maxFragmentLength=0, ignoreDuplicates=False,
+                 filterRNAstrand=None, batchSize=None):
+        self.minMappingQuality = minMappingQuality
+        self.samFlagInclude = samFlagInclude
+        self.samFlagExclude = samFlagExclude
+        self.minFragmentLength = minFragmentLength
+        self.maxFragmentLength = maxFragmentLength
+        self.ignoreDuplicates = ignoreDuplicates
+        self.filterRNAstrand = filterRNAstrand
+        self.batchSize = batchSize if batchSize else BATCH_SIZE
+
+        self.columns = []
+        if minMappingQuality:
+            self.columns.append('mapping_quality')
+        if samFlagInclude or samFlagExclude or ignoreDuplicates or filterRNAstrand:
+            self.columns.append('flag')
+        if (minFragmentLength and minFragmentLength > 0) or (maxFragmentLength and maxFragmentLength > 0):
+            self.columns.append('template_length')
+        if ignoreDuplicates:
+            self.columns.extend(['reference_start', 'next_reference_start'])
+
+    @classmethod
+    def fromArgs(cls, args, **kwargs):
+        """
+        Returns the filter of the parsed command line arguments, the
+        arguments a tool does not have are not used
+        """
+        options = {}
+        for name in ['minMappingQuality', 'samFlagInclude', 'samFlagExclude',
+                     'minFragmentLength', 'maxFragmentLength', 'ignoreDuplicates',
+                     'filterRNAstrand']:
+            if getattr(args, name, None) is not None:
+                options[name] = getattr(args, name)
+        options.update(kwargs)
+        return cls(**options)
+
+    def isActive(self):
+        return len(self.columns) > 0
+
+    def batches(self, reads, fragments=None):
+        """
+        Yields (reads, mask) for consecutive batches of reads, where mask is
+        True for the reads that pass the filters
+
+        If fragments is given, a function that returns the fragment blocks
+        of a read (e.g. CountReadsPerBin.get_fragment_from_read), it is
+        called for the reads that pass the filters applied before the
+        duplicate filter and (reads, mask, blocks) is yielded, with the
+        blocks of each of those reads (None for the others). The reads for
+        which fragments raises a TypeError are not kept, and as they are
+        not counted they are not the previous read of the duplicate filter.
+        """
+        reads = iter(reads)
+        getter = attrgetter(*self.columns) if self.columns else None
+        # (start, mate start, is reverse) of the last read kept before
+        # the duplicate filter
+        previous = None
+        while True:
+            batch = list(islice(reads, self.batchSize))
+            if not batch:
+                break
+            if getter is None:
+                mask = np.ones(len(batch), dtype=bool)
+            else:
+                values = np.array([getter(r) for r in batch], dtype=np.int64).reshape(len(batch), -1)
+                columns = dict(zip(self.columns, values.T))
+            if fragments is None:
+                if getter is not None:
+                    mask, previous = self.mask(columns, previous)
+                yield batch, mask
+                continue
+
+            valid = mask if getter is None else self.prefilter(columns)
+            blocks = [None] * len(batch)
+            for idx in np.flatnonzero(valid):
+                try:
+                    blocks[idx] = fragments(batch[idx])
+                except TypeError:
+                    # the get_fragment_from_read functions returns None in some cases.
+                    # Those cases are to be skipped.
+                    valid[idx] = False
+            if getter is not None:
+                mask, previous = self.mask(columns, previous, valid=valid)
+            yield batch, mask, blocks
+
+    def prefilter(self, columns):
+        """
+        Returns the mask of the reads of columns (see mask()) that pass
+        the filters applied before the duplicate filter
+        """
+        nreads = len(next(iter(columns.values()))) if columns else 0
+        mask = np.ones(nreads, dtype=bool)
+        if self.minMappingQuality:
+            mask &= columns['mapping_quality'] >= self.minMappingQuality
+        if self.samFlagInclude:
+            mask &= columns['flag'] & self.samFlagInclude == self.samFlagInclude
+        if self.samFlagExclude:
+            mask &= columns['flag'] & self.samFlagExclude == 0
+        if 'template_length' in columns:
+            tlen = np.abs(columns['template_length'])
+            if self.minFragmentLength and self.minFragmentLength > 0:
+                mask &= tlen >= self.minFragmentLength
+            if self.maxFragmentLength and self.maxFragmentLength > 0:
+                mask &= tlen <= self.maxFragmentLength
+        return mask
+
+    def mask(self, columns, previous=None, valid=None):
+        """
+        Applies the filters to columns, a dictionary of numpy arrays with
+        the pysam attribute names as keys. Returns the mask of the kept
+        reads and the duplicate key of the last read that passed the
+        filters before the duplicate filter (or previous). The reads that
+        are False in valid, if given, are discarded before the duplicate
+        filter.
+
+        >>> f = ReadFilter(minMappingQuality=10, ignoreDuplicates=True)
+        >>> cols = {'mapping_quality': np.array([20, 20, 5, 20, 20]),
+        ...         'flag': np.array([0, 0, 0, 0, 16]),
+        ...         'reference_start': np.array([1, 1, 2, 1, 1]),
+        ...         'next_reference_start': np.array([-1, -1, -1, -1, -1])}
+        >>> mask, previous = f.mask(cols)
+        >>> mask.tolist(), previous
+        ([True, False, False, False, True], (1, -1, 1))
+        >>> f.mask(cols, previous=(1, -1, 0))[0].tolist()
+        [False, False, False, False, True]
+        >>> f.mask(cols, valid=np.array([False, True, True, True, True]))[0].tolist()
+        [False, True, False, False, True]
+        """
+        mask = self.prefilter(columns)
+        if valid is not None:
+            mask &= valid
+        if 'flag' in columns:
+            flag = columns['flag']
+
+        if self.ignoreDuplicates:
+            # within a run of reads with the same key only the first is kept
+            kept = np.flatnonzero(mask)
+            keys = np.vstack([columns['reference_start'][kept],
+                              columns['next_reference_start'][kept],
+                              (flag[kept] & 16) // 16])
+            if len(kept):
+                duplicate = np.zeros(len(kept), dtype=bool)
+                duplicate[1:] = (keys[:, 1:] == keys[:, :-1]).all(axis=0)
+                if previous is not None:
+                    duplicate[0] = tuple(keys[:, 0].tolist()) == tuple(previous)
+                mask[kept[duplicate]] = False
+                previous = tuple(keys[:, -1].tolist())
+
+        if self.filterRNAstrand in ['forward', 'reverse']:
+            paired = flag & 1 == 1
+            if self.filterRNAstrand == 'forward':
+                strand = np.where(paired,
+                                  ((flag & 128 == 128) & (flag & 16 == 0)) | ((flag & 64 == 64) & (flag & 32 == 0)),
+                                  flag & 16 == 16)
+            else:
+                strand = np.where(paired,
+                                  (flag & 144 == 144) | (flag & 96 == 96),
+                                  flag & 16 == 0)
+            mask &= strand
+
+        return mask, previous
+
+    def filter(self, reads):
+        """
+        Yields the reads that pass the filters, in the same order
+        """
+        if not self.isActive():
+            for read in reads:
+                yield read
+            return
+        for batch, mask in self.batches(reads):
+            for idx in np.flatnonzero(mask):
+                yield batch[idx]
@@ -0,0 +1,110 @@
+import os
+import numpy as np
+
+from deeptools.utilities import getTempFileName
+
+
+class SharedRows(object):
+    """
+    A matrix, kept in a temporary file, whose rows are written in place by
+    the workers of mapReduce, such that the results do not need to be
+    pickled back to the main process and concatenated.
+
+    The main process reserves the rows of each task as the task is created
+    (see the taskInfo option of mapReduce), the worker writes the rows of
+    its result at that offset and returns the (offset, rows written)
+    segment, and at the end the main process gets the matrix from the list
+    of segments. The object itself only holds the name of the file and the
+    shape, thus it is cheap to send to the workers.
+
+    >>> out = SharedRows(2)
+    >>> first = out.reserve(3)
+    >>> second = out.reserve(2)
+    >>> out.write(second, np.array([[5, 6]]))
+    (3, 1)
+    >>> out.write(first, np.arange(6).reshape(3, 2))
+    (0, 3)
+    >>> out.rows([(0, 3), (3, 1)])
+    array([[ 0.,  1.],
+           [ 2.,  3.],
+           [ 4.,  5.],
+           [ 5.,  6.]])
+    >>> out.rows([(0, 3), (3, 1)], order=[3, 0])
+    array([[ 5.,  6.],
+           [ 0.,  1.]])
+    >>> out.close()
+    """
+
+    def __init__(self, numCols, dtype='float64'):
+        self.numCols = int(numCols)
+        self.dtype = np.dtype(dtype).str
+        self.numRows = 0
+        self.fileName = getTempFileName(suffix='.rows')
+
+    def rowBytes(self):
+        return self.numCols * np.dtype(self.dtype).itemsize
+
+    def reserve(self, rows):
+        """
+        Reserves space for `rows` rows, returns a (row offset, rows) segment
+        """
+        offset = self.numRows
+        self.numRows += rows
+        with open(self.fileName, 'r+b') as fh:
+            fh.truncate(self.numRows * self.rowBytes())
+        return offset, rows
+
+    def write(self, segment, values):
+        """
+        Writes the values, that can have fewer rows than reserved, at the
+        start of the segment. Returns the (row offset, rows written)
+        """
+        offset, rows = segment
+        values = np.asarray(values).reshape(-1, self.numCols)
+        if len(values) > rows:
+            raise ValueError("{} rows do not fit in the {} reserved "
+                             "rows".format(len(values), rows))
+        if len(values):
+            out = np.memmap(self.fileName, dtype=self.dtype, mode='r+',
+                            offset=offset * self.rowBytes(),
+                            shape=(len(values), self.numCols))
+            out[:] = values
+            out.flush()
+            del out
+        return offset, len(values)
+
+    def rows(self, segments, order=None):
+        """
+        Returns the matrix made of the given (offset, rows) segments. If
+        order is given, the rows are also reordered (as matrix[order]).
+
+        If the segments are all the rows in order, the matrix is a view of
+        the file. Otherwise the rows are copied.
+        """
+        if self.numRows == 0:
+            return np.zeros((0, self.numCols), dtype=self.dtype)
+        matrix = np.memmap(self.fileName, dtype=self.dtype, mode='r+',
+                           shape=(self.numRows, self.numCols))
+        expected = 0
+        for offset, rows in segments:
+            if offset != expected:
+                break
+            expected += rows
+        else:
+            if expected == self.numRows and order is None:
+                return np.asarray(matrix)
+        index = np.concatenate([np.arange(offset, offset + rows, dtype=np.int64)
+                                for offset, rows in segments] + [np.zeros(0, dtype=np.int64)])
+        if order is not None:
+            index = index[np.asarray(order, dtype=np.int64)]
+        return np.asarray(matrix[index])
+
+    def close(self):
+        """
+        Removes the file. Matrices returned by rows() are still valid.
+        """
+        try:
+            os.remove(self.fileName)
+        except OSError:
+            # the file can not be removed while mapped on some systems
+            pass
@@ -0,0 +1,222 @@
+import os
+import atexit
+import sys
+import json
+import time
+import threading
+import tempfile
+import numpy as np
+
+# counters of the task running in the current thread, see addCount()
+_counters = threading.local()
+
+
+def addCount(name, value):
+    """
+    Adds value to the counter `name` of the task that is running in the
+    current thread. The counters are part of the trace of the task. This
+    does nothing useful when the trace is not enabled, but is cheap.
+
+    >>> addCount('reads', 10)
+    """
+    counts = getattr(_counters, 'counts', None)
+    if counts is not None:
+        counts[name] = counts.get(name, 0) + value
+
+
+class TracedCall(object):
+    """
+    Wraps the function called by mapReduce for each task (chrom, start,
+    end, ...). For each call, a line with the start and end time, the process and thread,
+    the genomic region, the rows and bytes of the result and the
+    counters set with addCount() is appended to eventsFile.
+
+    The object is sent to the workers, thus it only holds the function
+    (that must be picklable) and a few values.
+    """
+
+    def __init__(self, func, eventsFile, name):
+        self.func = func
+        self.eventsFile = eventsFile
+        self.name = name
+
+    def __call__(self, task):
+        _counters.counts = {}
+        start = time.time()
+        try:
+            result = self.func(task)
+        finally:
+            end = time.time()
+            counts = _counters.counts
+            _counters.counts = None
+        region = task[0:3]
+        event = {'name': "{}:{}-{}".format(*region),
+                 'cat': self.name,
+                 'ph': 'X',
+                 'ts': start * 1e6,
+                 'dur': (end - start) * 1e6,
+                 'pid': os.getpid(),
+                 'tid': threading.current_thread().ident,
+                 'args': {'chrom': region[0], 'start': region[1], 'end': region[2],
+                          'rows': resultRows(result),
+                          'bytes': resultBytes(result)}}
+        event['args'].update(counts)
+        # a single write per line, the file is shared by all workers
+        with open(self.eventsFile, 'a') as fh:
+            fh.write(json.dumps(event) + "\n")
+        return result
+
+
+class Trace(object):
+    """
+    Collects the events of all the mapReduce calls of a run and saves
+    them in the Chrome trace event format (a JSON file that can be
+    loaded in chrome://tracing or https://ui.perfetto.dev)
+
+    >>> outFile = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+    >>> t = Trace(outFile.name)
+    >>> traced = t.wrap(len, 'len')
+    >>> traced(('chr1', 0, 100))
+    3
+    >>> t.finish('len', t.start, 1, summary=False)
+    >>> trace = json.load(open(outFile.name))
+    >>> for x in trace['traceEvents']:
+    ...     if x['ph'] == 'X':
+    ...         print(x['name'])
+    chr1:0-100
+    len
+    >>> t.close()
+    >>> os.remove(outFile.name)
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.start = time.time()
+        _fh, self.eventsFile = tempfile.mkstemp(suffix='.trace')
+        os.close(_fh)
+        atexit.register(self.close)
+
+    def wrap(self, func, name):
+        return TracedCall(func, self.eventsFile, name)
+
+    def addEvent(self, name, start, end, **args):
+        """
+        Records an event of the calling process (e.g. merging results)
+        """
+        event = {'name': name, 'cat': 'mapReduce', 'ph': 'X',
+                 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                 'pid': os.getpid(), 'tid': threading.current_thread().ident,
+                 'args': args}
+        with open(self.eventsFile, 'a') as fh:
+            fh.write(json.dumps(event) + "\n")
+
+    def timedConsumer(self, consumer):
+        """
+        Wraps a mapReduce consumer, such that the time spent
+        merging the results is part of the trace
+        """
+        def timed(result):
+            start = time.time()
+            consumer(result)
+            self.addEvent('merge', start, time.time())
+        return timed
+
+    def events(self):
+        with open(self.eventsFile) as fh:
+            return [json.loads(line) for line in fh]
+
+    def finish(self, name, start, numberOfProcessors, summary=True):
+        """
+        Called at the end of each mapReduce call. Records the call and
+        rewrites the trace file. If summary is True, prints the processor
+        usage and the slowest tasks of the call.
+        """
+        end = time.time()
+        self.addEvent(name, start, end, numberOfProcessors=numberOfProcessors)
+        events = self.events()
+        if summary:
+            events = [x for x in events if start * 1e6 <= x['ts'] <= end * 1e6]
+            tasks = [x for x in events if x['cat'] != 'mapReduce']
+            merge = [x for x in events if x['name'] == 'merge']
+            sys.stderr.write(summarize(name, tasks, merge, end - start, numberOfProcessors))
+        self.write(self.events())
+
+    def write(self, events):
+        # process and thread names, and times relative to the start
+        pids = sorted(set(x['pid'] for x in events))
+        meta = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                 'args': {'name': 'main' if pid == os.getpid() else 'worker {}'.format(pid)}}
+                for pid in pids]
+        for event in events:
+            event['ts'] -= self.start * 1e6
+        with open(self.fileName, 'w') as fh:
+            json.dump({'traceEvents': meta + events,
+                       'displayTimeUnit': 'ms'}, fh)
+
+    def close(self):
+        if os.path.exists(self.eventsFile):
+            os.remove(self.eventsFile)
+
+
+def summarize(name, tasks, merge, wallTime, numberOfProcessors, slowest=5):
+    """
+    Returns a summary of the usage of the workers and the slowest tasks
+
+    >>> tasks = [{'name': 'chr1:0-10', 'dur': 2e6, 'pid': 1, 'args': {'rows': 10}},
+    ...          {'name': 'chr1:10-20', 'dur': 1e6, 'pid': 2, 'args': {'rows': 10, 'reads': 5}}]
+    >>> print(summarize('count', tasks, [], 2.0, 2, slowest=1))
+    count: 2 tasks, 2 workers, 2.00 s
+      task time 3.00 s, worker usage 75.0%, merge time 0.00 s
+      slowest tasks:
+        chr1:0-10  2.000 s  pid 1  rows 10
+    <BLANKLINE>
+    """
+    busy = sum(x['dur'] for x in tasks) / 1e6
+    usage = 100.0 * busy / (wallTime * max(numberOfProcessors, 1)) if wallTime > 0 else 0
+    lines = ["{}: {} tasks, {} workers, {:.2f} s".format(name, len(tasks), numberOfProcessors, wallTime),
+             "  task time {:.2f} s, worker usage {:.1f}%, merge time {:.2f} s".format(
+                 busy, usage, sum(x['dur'] for x in merge) / 1e6),
+             "  slowest tasks:"]
+    for task in sorted(tasks, key=lambda x: -x['dur'])[:slowest]:
+        info = "  ".join("{} {}".format(k, v) for k, v in sorted(task['args'].items())
+                         if k in ('rows', 'reads', 'bytes', 'files_opened') and v is not None)
+        lines.append("    {}  {:.3f} s  pid {}  {}".format(task['name'], task['dur'] / 1e6,
+                                                           task['pid'], info).rstrip())
+    return "\n".join(lines) + "\n"
+
+
+def resultRows(result):
+    """
+    Number of rows of the first array found in the result
+
+    >>> resultRows((np.zeros((3, 2)), 'file'))
+    3
+    >>> resultRows('file') is None
+    True
+    """
+    if isinstance(result, np.ndarray):
+        return int(result.shape[0]) if result.ndim else 1
+    if isinstance(result, (list, tuple)):
+        for item in result:
+            rows = resultRows(item) if isinstance(item, np.ndarray) else None
+            if rows is not None:
+                return rows
+    return None
+
+
+def resultBytes(result, depth=0):
+    """
+    Approximate size of the result, including the files it points to
+
+    >>> resultBytes((np.zeros(4), ['ab', 'c']))
+    35
+    """
+    if isinstance(result, np.ndarray):
+        return int(result.nbytes)
+    if isinstance(result, str):
+        if os.path.isabs(result) and os.path.isfile(result):
+            return os.path.getsize(result)
+        return len(result)
+    if isinstance(result, (list, tuple)) and depth < 3:
+        return sum(resultBytes(x, depth + 1) for x in result)
+    return sys.getsizeof(result)
@@ -0,0 +1,199 @@
+"""
+Compares the run time of the mapReduce executors on the test BAM files.
+
+Usage::
+
+    python -m deeptools.test.benchmark [--numberOfProcessors 4] [--repeats 5]
+
+For each executor, the reads of the test BAM files are counted
+(CountReadsPerBin) and bedGraph files are written (WriteBedGraph), in
+chunks of 50 bp. The best time out of the repeats is reported.
+
+The number of bytes pickled per task is also reported, for the
+tasks sent to the worker processes and for a task that would carry
+the complete arguments of the function.
+
+Finally, the coverage of the read blocks of test_paired2.bam is
+computed per tile with CountReadsPerBin.coverage_from_blocks and with
+a per block loop (coverage_loop, the former implementation).
+"""
+import argparse
+import os
+import pickle
+import sys
+import tempfile
+import time
+import numpy as np
+
+from deeptools import mapReduce
+from deeptools import bamHandler
+from deeptools import countReadsPerBin as cr
+from deeptools import writeBedGraph as wbg
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + "/test_data/"
+BAM_FILES = [ROOT + "test1.bam", ROOT + "test2.bam"]
+PAIRED_BAM = ROOT + "test_paired2.bam"
+
+
+# the test files are small, thus, the genome is split in
+# small chunks to have several tasks per worker
+CHUNK_LENGTH = 50
+CHROM_SIZES = [('3R', 1500)]
+
+
+def count_reads(numberOfProcessors):
+    c = cr.CountReadsPerBin(BAM_FILES, binLength=10, stepSize=10,
+                            numberOfProcessors=numberOfProcessors)
+    return mapReduce.mapReduce([], cr.countReadsInRegions_wrapper, CHROM_SIZES,
+                               self_=c, genomeChunkLength=CHUNK_LENGTH,
+                               numberOfProcessors=numberOfProcessors)
+
+
+def write_bedgraph(numberOfProcessors):
+    c = wbg.WriteBedGraph(BAM_FILES[:1], binLength=10, stepSize=10,
+                          numberOfProcessors=numberOfProcessors)
+    c.smoothLength = 0
+    out_file = tempfile.NamedTemporaryFile(suffix='.bg', delete=False)
+    out_file.close()
+    writer = wbg.CoverageWriter(out_file.name, CHROM_SIZES, 'bedgraph')
+    mapReduce.mapReduce([wbg.scaleCoverage, {'scaleFactor': 1.0}],
+                        wbg.writeBedGraph_wrapper, CHROM_SIZES,
+                        self_=c, genomeChunkLength=CHUNK_LENGTH,
+                        numberOfProcessors=numberOfProcessors,
+                        consumer=writer)
+    writer.close()
+    os.remove(out_file.name)
+
+
+def payload_sizes():
+    """
+    Returns the bytes pickled per task by mapReduce and the bytes
+    of the complete arguments of a CountReadsPerBin task
+    """
+    c = cr.CountReadsPerBin(BAM_FILES, binLength=10, stepSize=10)
+    context = mapReduce.TaskContext(cr.countReadsInRegions_wrapper, [], self_=c)
+    context.share('processes')
+    try:
+        task = (context, ('3R', 0, CHUNK_LENGTH))
+        full = (cr.countReadsInRegions_wrapper, (c, '3R', 0, CHUNK_LENGTH))
+        return (len(pickle.dumps(task, pickle.HIGHEST_PROTOCOL)),
+                len(pickle.dumps(full, pickle.HIGHEST_PROTOCOL)))
+    finally:
+        context.close()
+
+
+def coverage_loop(starts, ends, read_ids, reg_start, reg_end, tile_size, nbins):
+    """
+    Same as CountReadsPerBin.coverage_from_blocks, one block at a time
+    """
+    coverage = np.zeros(nbins, dtype='float64')
+    last_eIdx = None
+    last_read = None
+    for fragmentStart, fragmentEnd, read_id in zip(starts, ends, read_ids):
+        if read_id != last_read:
+            last_eIdx = None
+            last_read = read_id
+        if fragmentEnd - fragmentStart == 0:
+            continue
+        if fragmentEnd <= reg_start or fragmentStart >= reg_end:
+            continue
+        sIdx = max((fragmentStart - reg_start) // tile_size, 0)
+        eIdx = min(np.ceil(float(fragmentEnd - reg_start) / tile_size).astype('int'), nbins)
+        if last_eIdx is not None:
+            sIdx = max(last_eIdx, sIdx)
+            if sIdx >= eIdx:
+                continue
+        coverage[sIdx:eIdx] += 1
+        last_eIdx = eIdx
+    return coverage
+
+
+def read_blocks(bamFile, copies=50):
+    """
+    Returns the blocks of all the reads of bamFile, repeated
+    copies times, and the region that they span
+    """
+    c = cr.CountReadsPerBin([bamFile], binLength=1, stepSize=1, extendReads=True)
+    c.defaultFragmentLength = 200
+    starts, ends, read_ids = [], [], []
+    bam = bamHandler.openBam(bamFile)
+    reads = [r for r in bam.fetch() if not r.is_unmapped]
+    for read_id, read in enumerate(reads * copies):
+        for block in c.get_fragment_from_read(read):
+            starts.append(block[0])
+            ends.append(block[1])
+            read_ids.append(read_id)
+    bam.close()
+    return starts, ends, read_ids, min(starts), max(ends)
+
+
+def coverage_kernels(repeats, tile_size=10):
+    """
+    Returns the best time of coverage_from_blocks and of coverage_loop
+    """
+    starts, ends, read_ids, reg_start, reg_end = read_blocks(PAIRED_BAM)
+    nbins = (reg_end - reg_start) // tile_size
+    times = []
+    for func in [cr.CountReadsPerBin.coverage_from_blocks, coverage_loop]:
+        best = None
+        for __ in range(repeats):
+            start = time.time()
+            func(starts, ends, read_ids, reg_start, reg_end, tile_size, nbins)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        times.append(best)
+    return len(starts), times
+
+
+BENCHMARKS = [('CountReadsPerBin', count_reads),
+              ('WriteBedGraph', write_bedgraph)]
+
+
+def run(executor, func, numberOfProcessors, repeats):
+    mapReduce.setExecutor(executor)
+    times = []
+    # the first call also starts the pool of workers
+    func(numberOfProcessors)
+    for __ in range(repeats):
+        start = time.time()
+        func(numberOfProcessors)
+        times.append(time.time() - start)
+    mapReduce.closePool()
+    return min(times)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--numberOfProcessors', '-p', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args(args)
+
+    # the tools are chatty on stderr
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    results = []
+    try:
+        for name, func in BENCHMARKS:
+            for executor in mapReduce.EXECUTORS:
+                results.append((name, executor,
+                                run(executor, func, args.numberOfProcessors, args.repeats)))
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+        mapReduce.setExecutor('processes')
+
+    print("{:<20}{:<12}{:>12}".format("benchmark", "executor", "seconds"))
+    for name, executor, seconds in results:
+        print("{:<20}{:<12}{:>12.4f}".format(name, executor, seconds))
+
+    task, full = payload_sizes()
+    print("\nbytes pickled per task: {} (complete arguments: {})".format(task, full))
+
+    blocks, (vectorized, loop) = coverage_kernels(args.repeats)
+    print("\ncoverage of {} blocks: {:.4f} s (per block loop: {:.4f} s, {:.1f}x)".format(
+        blocks, vectorized, loop, loop / vectorized))
+
+
+if __name__ == "__main__":
+    main()
@@ -44,6 +44,65 @@ def test_bam_coverage_arguments():
     unlink(outfile)
 
 
+def test_bam_coverage_additional_output():
+    """
+    The additional outputs are the outputs of bamCoverage with their bin size
+    """
+    outfile = '/tmp/test_file.bg'
+    outfile_100 = '/tmp/test_file_100.bg'
+    outfile_25 = '/tmp/test_file_25.bg'
+    args = "-b {} -o {} --extendReads 100 --outFileFormat bedgraph " \
+        "--additionalOutput {}:100 {}:25".format(BAMFILE_B, outfile, outfile_100, outfile_25).split()
+    bam_cov.main(args)
+    resp = {}
+    for bin_size, fileName in [(50, outfile), (100, outfile_100), (25, outfile_25)]:
+        _foo = open(fileName, 'r')
+        resp[bin_size] = _foo.readlines()
+        _foo.close()
+        unlink(fileName)
+
+    for bin_size in [50, 100, 25]:
+        args = "-b {} -o {} --extendReads 100 --outFileFormat bedgraph " \
+            "--binSize {}".format(BAMFILE_B, outfile, bin_size).split()
+        bam_cov.main(args)
+        _foo = open(outfile, 'r')
+        expected = _foo.readlines()
+        _foo.close()
+        assert_equal(resp[bin_size], expected)
+        unlink(outfile)
+
+
+def test_bam_coverage_additional_output_region():
+    """
+    With a region whose start is not a multiple of the bin sizes, the
+    tiles of each additional output are those of a separate run
+    """
+    outfile = '/tmp/test_file.bg'
+    outfile_30 = '/tmp/test_file_30.bg'
+    outfile_40 = '/tmp/test_file_40.bg'
+    args = "-b {} -o {} --extendReads 100 --outFileFormat bedgraph --binSize 10 " \
+        "--region 3R:100:1300 --additionalOutput {}:30 {}:40".format(BAMFILE_FILTER1, outfile,
+                                                                     outfile_30, outfile_40).split()
+    bam_cov.main(args)
+    resp = {}
+    for bin_size, fileName in [(10, outfile), (30, outfile_30), (40, outfile_40)]:
+        _foo = open(fileName, 'r')
+        resp[bin_size] = _foo.readlines()
+        _foo.close()
+        unlink(fileName)
+    assert resp[30][0].split()[1] == '90'
+
+    for bin_size in [10, 30, 40]:
+        args = "-b {} -o {} --extendReads 100 --outFileFormat bedgraph " \
+            "--region 3R:100:1300 --binSize {}".format(BAMFILE_FILTER1, outfile, bin_size).split()
+        bam_cov.main(args)
+        _foo = open(outfile, 'r')
+        expected = _foo.readlines()
+        _foo.close()
+        assert_equal(resp[bin_size], expected)
+        unlink(outfile)
+
+
 def test_bam_coverage_extend():
     outfile = '/tmp/test_file.bg'
     args = "-b {} -o {} --extendReads 100 --outFileFormat bedgraph".format(BAMFILE_B, outfile).split()
@@ -174,3 +174,94 @@ class TestCountReadsPerBin(object):
                                         [np.nan, 1],
                                         [1, 1],
                                         [1, 2]]))
+
+
+def test_coverage_from_blocks_as_loop():
+    from deeptools.test.benchmark import coverage_loop, read_blocks
+    starts, ends, read_ids, reg_start, reg_end = read_blocks(ROOT + "test_paired2.bam", copies=1)
+    for tile_size in [1, 7, 50]:
+        for start, end in [(reg_start, reg_end), (reg_start + 1000, reg_start + 5003)]:
+            nbins = (end - start) // tile_size
+            nt.assert_array_equal(cr.CountReadsPerBin.coverage_from_blocks(starts, ends, read_ids,
+                                                                           start, end, tile_size, nbins),
+                                  coverage_loop(starts, ends, read_ids, start, end, tile_size, nbins))
+
+    # split reads, with overlapping and unsorted blocks
+    rng = np.random.RandomState(0)
+    starts = rng.randint(0, 1000, 500)
+    ends = starts + rng.randint(-5, 100, 500)
+    read_ids = np.sort(rng.randint(0, 200, 500))
+    for tile_size in [1, 10, 33]:
+        nbins = 900 // tile_size
+        nt.assert_array_equal(cr.CountReadsPerBin.coverage_from_blocks(starts, ends, read_ids,
+                                                                       50, 950, tile_size, nbins),
+                              coverage_loop(starts, ends, read_ids, 50, 950, tile_size, nbins))
+
+
+def test_coalesced_fetch_as_fetch():
+    import pysam
+    bam = pysam.AlignmentFile(ROOT + "test_paired2.bam")
+    chrom = bam.references[0]
+    windows = [(x, x + 50) for x in range(0, bam.lengths[0], 170)]
+    windows += [(100, 3000), None, (200, 400), (1000, 1000)]
+    for max_gap in [0, 200, 10000]:
+        fetched = cr.coalescedFetch(bam, chrom, windows, maxGap=max_gap)
+        for window, reads in zip(windows, fetched):
+            if window is None:
+                assert reads is None
+            else:
+                # the reads have to be consumed before fetching again
+                reads = list(reads)
+                expected = [r for r in bam.fetch(chrom, window[0], window[1]) if r.flag & 4 == 0]
+                assert [r.query_name for r in reads] == [r.query_name for r in expected]
+                assert [r.flag for r in reads] == [r.flag for r in expected]
+
+    # sampled bins, fetched together or one by one
+    c = cr.CountReadsPerBin([ROOT + "test_paired2.bam"], binLength=20, stepSize=130,
+                            extendReads=True, numberOfProcessors=1)
+    coverage, _ = c.count_reads_in_region(chrom, 0, bam.lengths[0])
+    cr.FETCH_MERGE_GAP = 0
+    try:
+        nt.assert_array_equal(c.count_reads_in_region(chrom, 0, bam.lengths[0])[0], coverage)
+    finally:
+        cr.FETCH_MERGE_GAP = 1000
+
+
+def test_coalesced_fetch_clipped_windows():
+    """
+    Windows fetched together that end before the previous ones, as the
+    windows clipped by a blacklist
+    """
+    import pysam
+    from deeptools import intervalIndex
+    bam_file = ROOT + "test_filtering.bam"
+    blacklist_file = ROOT + "test_filtering.blacklist.bed"
+    bam = pysam.AlignmentFile(bam_file)
+    windows = [(0, 850)] + [(0, 800)] * 7 + [(100, 300)]
+    for window, reads in zip(windows, cr.coalescedFetch(bam, '3R', windows)):
+        expected = [r for r in bam.fetch('3R', window[0], window[1]) if r.flag & 4 == 0]
+        assert [r.query_name for r in reads] == [r.query_name for r in expected]
+
+    # sampled bins, fetched together or one by one
+    c = cr.CountReadsPerBin([bam_file], binLength=50, stepSize=100, extendReads=200,
+                            blackListFileName=blacklist_file, numberOfProcessors=1)
+    blacklist = intervalIndex.getIndex(blacklist_file)
+    bins = [(x, x + 50) for x in range(0, 1500, 100) if not blacklist.findOverlaps('3R', x, x + 50)]
+    nt.assert_array_equal(c.get_coverage_of_region(bam, '3R', bins),
+                          np.concatenate([c.get_coverage_of_region(bam, '3R', [x]) for x in bins]))
+
+
+def test_streamed_read_batches():
+    """
+    The coverage does not depend on the number of reads processed at once
+    """
+    from deeptools import readFilter
+    c = cr.CountReadsPerBin([ROOT + "test_paired2.bam"], binLength=10, stepSize=10,
+                            extendReads=True, ignoreDuplicates=True, numberOfProcessors=1)
+    coverage, _ = c.count_reads_in_region('chr2', 4999000, 5003000)
+    assert np.sum(coverage) > 0
+    readFilter.BATCH_SIZE = 3
+    try:
+        nt.assert_array_equal(c.count_reads_in_region('chr2', 4999000, 5003000)[0], coverage)
+    finally:
+        readFilter.BATCH_SIZE = 10000
@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+
+from deeptools import fileHandles
+from deeptools import taskTrace
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + "/test_data/"
+
+
+def test_handles_are_reused():
+    out = tempfile.mkdtemp()
+    try:
+        for ext in ["", ".bai"]:
+            shutil.copy(ROOT + "test2.bam" + ext, out)
+        bam = os.path.join(out, "test2.bam")
+        taskTrace._counters.counts = {}
+        first = fileHandles.openBam(bam)
+        assert fileHandles.openBam(bam) is first
+        assert taskTrace._counters.counts == {'files_opened': 1}
+
+        # a modified file is opened again
+        os.utime(bam, (0, 0))
+        assert fileHandles.openBam(bam) is not first
+        assert taskTrace._counters.counts == {'files_opened': 2, 'files_closed': 1}
+    finally:
+        taskTrace._counters.counts = None
+        fileHandles.closeAll()
+        shutil.rmtree(out)
+
+
+def test_least_recently_used_are_closed():
+    out = tempfile.mkdtemp()
+    max_open = fileHandles.MAX_OPEN_FILES
+    fileHandles.MAX_OPEN_FILES = 2
+    try:
+        names = []
+        for idx in range(3):
+            names.append(os.path.join(out, str(idx)))
+            open(names[-1], 'w').close()
+        first = fileHandles.getHandle('text', names[0], open)
+        fileHandles.getHandle('text', names[1], open)
+        assert fileHandles.getHandle('text', names[0], open) is first
+        fileHandles.getHandle('text', names[2], open)
+        # names[1] was the least recently used
+        assert not first.closed
+        assert sorted(x[1] for x in fileHandles._local.handles) == [names[0], names[2]]
+    finally:
+        fileHandles.MAX_OPEN_FILES = max_open
+        fileHandles.closeAll()
+        shutil.rmtree(out)
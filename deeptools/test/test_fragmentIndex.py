@@ -0,0 +1,83 @@
+import os.path
+import shutil
+import tempfile
+import itertools
+import numpy as np
+import numpy.testing as nt
+
+import deeptools.countReadsPerBin as cr
+from deeptools import fragmentIndex
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + "/test_data/"
+
+
+def copy_bam(bamFile, directory):
+    for ext in ["", ".bai"]:
+        shutil.copy(ROOT + bamFile + ext, directory)
+    return os.path.join(directory, bamFile)
+
+
+def test_coverage_as_bam():
+    """
+    The coverages computed from the index are those of the bam file
+    """
+    out = tempfile.mkdtemp()
+    try:
+        for bamFile, chrom, start, end in [("test_paired2.bam", "chr2", 4999000, 5003000),
+                                           ("test_filtering.bam", "3R", 0, 1500),
+                                           ("test2.bam", "3R", 0, 1500)]:
+            bam = copy_bam(bamFile, out)
+            index = fragmentIndex.build(bam)
+            assert fragmentIndex.getIndex(bam) is not None
+            options = itertools.product([False, 60, 200], [False, True], [False, True], [None, 20], [17, 40])
+            for extendReads, center_read, ignoreDuplicates, minMappingQuality, stepSize in options:
+                counts = []
+                for use_index in [index, None]:
+                    fragmentIndex._indices[bam] = use_index
+                    c = cr.CountReadsPerBin([bam], binLength=17, stepSize=stepSize, extendReads=extendReads,
+                                            center_read=center_read, ignoreDuplicates=ignoreDuplicates,
+                                            minMappingQuality=minMappingQuality, numberOfProcessors=1)
+                    counts.append(c.count_reads_in_region(chrom, start, end)[0])
+                nt.assert_array_equal(counts[0], counts[1])
+                assert np.sum(counts[0]) > 0
+    finally:
+        shutil.rmtree(out)
+        fragmentIndex._indices.clear()
+
+
+def test_stale_index():
+    out = tempfile.mkdtemp()
+    try:
+        bam = copy_bam("test2.bam", out)
+        fragmentIndex.build(bam)
+        assert fragmentIndex.getIndex(bam) is not None
+        fragmentIndex._indices.clear()
+        os.utime(bam, (0, 0))
+        assert fragmentIndex.getIndex(bam) is None
+    finally:
+        shutil.rmtree(out)
+        fragmentIndex._indices.clear()
+
+
+def test_chunked_build():
+    """
+    The index does not depend on the number of reads written at once
+    """
+    out = tempfile.mkdtemp()
+    try:
+        bam = copy_bam("test_paired2.bam", out)
+        whole = fragmentIndex.build(bam, os.path.join(out, "whole.dtfrag"))
+        fragmentIndex.BUFFER_SIZE = 3
+        try:
+            chunked = fragmentIndex.build(bam, os.path.join(out, "chunked.dtfrag"))
+        finally:
+            fragmentIndex.BUFFER_SIZE = 100000
+        assert chunked.manifest['chroms'] == whole.manifest['chroms']
+        for chrom in whole.chroms:
+            for name, column in whole.columns(chrom).items():
+                nt.assert_array_equal(chunked.columns(chrom)[name], column)
+            idx = np.arange(len(whole.columns(chrom)['reference_start']))
+            for blocks, expected in zip(chunked.blocks(chrom, idx), whole.blocks(chrom, idx)):
+                nt.assert_array_equal(blocks, expected)
+    finally:
+        shutil.rmtree(out)
@@ -0,0 +1,47 @@
+import argparse
+import os.path
+import numpy as np
+import pysam
+
+from deeptools import genomeSampler
+from deeptools import getScaleFactor
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + "/test_data/"
+
+
+def test_windows_cover_genome_once():
+    """
+    The windows of all the rounds do not overlap and, together, they
+    cover the whole genome
+    """
+    chromSizes = [('chr1', 10007), ('chr2', 333), ('chr3', 5000)]
+    for windowSize, spacing in [(50, 1000), (100, 337), (1, 64), (700, 500)]:
+        covered = {chrom: np.zeros(size, dtype=int) for chrom, size in chromSizes}
+        roundNumber = 0
+        while True:
+            for chrom, start, end in genomeSampler.samplingWindows(chromSizes, windowSize, spacing, roundNumber):
+                assert 0 < end - start <= windowSize
+                covered[chrom][start:end] += 1
+            if float(spacing) / 2 ** roundNumber <= windowSize:
+                break
+            roundNumber += 1
+        for chrom, _ in chromSizes:
+            assert np.all(covered[chrom] == 1)
+
+
+def test_reads_counted_once():
+    """
+    The reads that overlap two adjacent windows are counted once, in
+    the window sampled first
+    """
+    bamFile = ROOT + "test_paired2.bam"
+    bam = pysam.AlignmentFile(bamFile)
+    chromSizes = [(chrom, size) for chrom, size in zip(bam.references, bam.lengths) if bam.count(chrom)]
+    expected = sum(len(list(bam.fetch(chrom))) for chrom, _ in chromSizes)
+    total = 0
+    for res in genomeSampler.sampleRounds((bamFile, argparse.Namespace()),
+                                          getScaleFactor.getFractionKept_wrapper,
+                                          chromSizes, windowSize=5000, spacing=200000,
+                                          numberOfProcessors=1):
+        total += sum(x[1] for x in res)
+    assert total == expected
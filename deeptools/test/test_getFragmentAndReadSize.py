@@ -0,0 +1,70 @@
+import os.path
+import shutil
+import tempfile
+import numpy.testing as nt
+
+from deeptools import getFragmentAndReadSize as gfs
+from deeptools import config as cfg
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + "/test_data/"
+
+
+def copy_bam(bamFile, directory):
+    for ext in ["", ".bai"]:
+        shutil.copy(ROOT + bamFile + ext, directory)
+    return os.path.join(directory, bamFile)
+
+
+def test_lengths_cache():
+    out = tempfile.mkdtemp()
+    tmp_dir = cfg.config.get('general', 'tmp_dir')
+    try:
+        # the stats are saved in the temporary directory
+        cfg.config.set('general', 'tmp_dir', out)
+        bam = copy_bam("test_paired2.bam", out)
+        statsFile = gfs._statsFile(bam)
+        assert os.path.dirname(statsFile) == out
+        fl = gfs.sampleLengths(bam, binSize=10000, distanceBetweenBins=100000, numberOfProcessors=1)
+        assert len(fl) > 0
+        assert os.path.exists(statsFile)
+        assert not os.path.exists(bam + ".dtstats.json")
+        assert gfs.sampleLengths(bam, binSize=10000, distanceBetweenBins=100000) is fl
+
+        # the distribution of each column is saved, not every length
+        saved = list(gfs._readStats(statsFile, bam)['lengths'].values())
+        assert len(saved) == 1
+        for values, counts in saved[0]:
+            assert sum(counts) == len(fl)
+
+        # read back from the stats file
+        gfs._sampled.clear()
+        nt.assert_array_equal(gfs.sampleLengths(bam, binSize=10000, distanceBetweenBins=100000), fl)
+
+        # a modified bam file is sampled again
+        gfs._sampled.clear()
+        os.utime(bam, (0, 0))
+        assert gfs._readStats(statsFile, bam)['lengths'] == {}
+        nt.assert_array_equal(gfs.sampleLengths(bam, binSize=10000, distanceBetweenBins=100000,
+                                                numberOfProcessors=1), fl)
+    finally:
+        cfg.config.set('general', 'tmp_dir', tmp_dir)
+        shutil.rmtree(out)
+        gfs._sampled.clear()
+
+
+def test_lengths_cache_not_writable():
+    """
+    The lengths are sampled even if the stats can not be saved
+    """
+    out = tempfile.mkdtemp()
+    statsFile = gfs._statsFile
+    try:
+        gfs._statsFile = lambda bamFile: os.path.join(out, "missing", "stats.json")
+        fl = gfs.sampleLengths(ROOT + "test_paired2.bam", binSize=10000, distanceBetweenBins=100000,
+                               numberOfProcessors=1)
+        assert len(fl) > 0
+        assert os.listdir(out) == []
+    finally:
+        gfs._statsFile = statsFile
+        shutil.rmtree(out)
+        gfs._sampled.clear()
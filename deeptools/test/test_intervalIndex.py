@@ -0,0 +1,29 @@
+import os
+from nose.tools import assert_equal
+from deeptoolsintervals import GTF
+import deeptoolsintervals
+import deeptools.intervalIndex as ii
+
+__author__ = 'deeptools'
+
+BED = os.path.dirname(os.path.abspath(deeptoolsintervals.__file__)) + "/test/GRCh38.84.bed"
+
+
+def test_overlaps_as_gtf():
+    gtf = GTF(BED)
+    index = ii.IntervalIndex.fromFiles(BED)
+    for chrom in ['1', 'chr1', 'chrX', '2']:
+        for start in range(0, 3000000, 25000):
+            for length in [0, 1, 5000, 200000]:
+                expected = gtf.findOverlaps(chrom, start, start + length)
+                expected = [(x[0], x[1]) for x in expected]
+                assert_equal(index.findOverlaps(chrom, start, start + length), expected)
+
+
+def test_index_is_shared():
+    index = ii.getIndex([BED])
+    assert ii.getIndex([BED]) is index
+    # another process loads the saved index
+    fileName = ii._indexFileName([BED])
+    loaded = ii.IntervalIndex.load(fileName)
+    assert_equal(loaded.findOverlaps('1', 0, 3000000), index.findOverlaps('1', 0, 3000000))
@@ -0,0 +1,167 @@
+import deeptools.mapReduce as mr
+from nose.tools import assert_equal
+import json
+import os
+import shutil
+import tempfile
+
+__author__ = 'deeptools'
+
+
+def chunk_length(args):
+    chrom, start, end = args
+    return chrom, end - start
+
+
+def region_exons(args):
+    chrom, start, end, regions = args
+    return chrom, start, [x[1] for x in regions]
+
+
+CALLS = []
+
+
+def worker_threads(args):
+    from deeptools import threadBudget
+    return threadBudget.getWorkerThreads()
+
+
+def counted_chunk_length(args):
+    CALLS.append(args)
+    return chunk_length(args)
+
+
+class TestMapReduce(object):
+
+    def setUp(self):
+        self.chrom_sizes = [('chr1', 1050), ('chr2', 300)]
+        self.expected = [('chr1', 100)] * 10 + [('chr1', 50)] + [('chr2', 100)] * 3
+
+    def test_collected_results(self):
+        res = mr.mapReduce([], chunk_length, self.chrom_sizes,
+                           genomeChunkLength=100, numberOfProcessors=2)
+        assert_equal(sorted(res), sorted(self.expected))
+
+    def test_consumer_in_genomic_order(self):
+        for proc in [1, 2]:
+            consumed = []
+            res = mr.mapReduce([], chunk_length, self.chrom_sizes,
+                               genomeChunkLength=100,
+                               numberOfProcessors=proc,
+                               consumer=consumed.append,
+                               maxTasksInFlight=3)
+            assert res is None
+            assert_equal(consumed, self.expected)
+
+    def test_pool_is_reused(self):
+        pool = mr.getPool(2)
+        mr.mapReduce([], chunk_length, self.chrom_sizes,
+                     genomeChunkLength=100, numberOfProcessors=2)
+        assert mr.getPool(2) is pool
+        mr.closePool()
+        assert mr.getPool(2) is not pool
+        mr.closePool()
+
+    def test_chunks_results_in_chunk_order(self):
+        chunks = [('chr1', 0, 10, 1), ('chr1', 10, 1050, 100), ('chr2', 0, 300, 5)]
+        res = mr.mapReduce([], chunk_length, self.chrom_sizes,
+                           numberOfProcessors=2, chunks=chunks)
+        assert_equal(res, [('chr1', 10), ('chr1', 1040), ('chr2', 300)])
+        mr.closePool()
+
+    def test_chunks_consumed_in_chunk_order(self):
+        chunks = [('chr1', 0, 10, 1), ('chr1', 10, 1050, 100), ('chr2', 0, 300, 5)]
+        consumed = []
+        mr.mapReduce([], chunk_length, self.chrom_sizes, numberOfProcessors=2,
+                     chunks=chunks, consumer=consumed.append, maxTasksInFlight=2)
+        assert_equal(consumed, [('chr1', 10), ('chr1', 1040), ('chr2', 300)])
+        mr.closePool()
+
+    def test_bounded_largest_first(self):
+        """
+        The tasks of each group are sent from the largest to the
+        smallest weight, the results are yielded in the order of the tasks
+        """
+        from collections import deque
+        from deeptools.checkpoint import _Ready
+        sent = []
+
+        class Pool(object):
+            def apply_async(self, func, args):
+                sent.append(args[0])
+                return _Ready(func(*args))
+
+        weights = deque([1, 3, 2, 8, 5, 4, 7, 6])
+        res = list(mr.imapBounded(Pool(), abs, iter(range(8)), 4, weights=weights))
+        assert_equal(res, list(range(8)))
+        assert_equal(sent, [3, 1, 2, 0, 4, 5, 6, 7])
+
+    def test_executors(self):
+        for executor in mr.EXECUTORS:
+            res = mr.mapReduce([], chunk_length, self.chrom_sizes,
+                               genomeChunkLength=100, numberOfProcessors=2,
+                               executor=executor)
+            assert_equal(sorted(res), sorted(self.expected))
+        mr.closePool()
+
+    def test_resume(self):
+        work_dir = tempfile.mkdtemp()
+        del CALLS[:]
+        res = mr.mapReduce([], counted_chunk_length, self.chrom_sizes,
+                           genomeChunkLength=100, numberOfProcessors=1,
+                           workDir=work_dir)
+        assert_equal(len(CALLS), 14)
+        # a run on a longer chromosome only computes the new chunk
+        res = mr.mapReduce([], counted_chunk_length, self.chrom_sizes + [('chr3', 100)],
+                           genomeChunkLength=100, numberOfProcessors=1,
+                           workDir=work_dir, resume=True)
+        assert_equal(len(CALLS), 15)
+        assert_equal(res, self.expected + [('chr3', 100)])
+        shutil.rmtree(work_dir)
+
+    def test_trace(self):
+        trace_file = tempfile.NamedTemporaryFile(suffix='.json', delete=False).name
+        mr.setTrace(trace_file)
+        consumed = []
+        try:
+            mr.mapReduce([], chunk_length, self.chrom_sizes,
+                         genomeChunkLength=100, numberOfProcessors=2,
+                         consumer=consumed.append)
+        finally:
+            mr.setTrace(None)
+            mr.closePool()
+        assert_equal(consumed, self.expected)
+        events = json.load(open(trace_file))['traceEvents']
+        tasks = [x['name'] for x in events if x.get('cat') == 'chunk_length']
+        assert_equal(sorted(tasks), sorted("{}:{}-{}".format(chrom, start, min(start + 100, size))
+                                           for chrom, size in self.chrom_sizes
+                                           for start in range(0, size, 100)))
+        assert_equal(len([x for x in events if x['name'] == 'merge']), 14)
+        os.remove(trace_file)
+
+    def test_bed_regions_in_genomic_order(self):
+        bed = tempfile.NamedTemporaryFile(suffix='.bed', delete=False, mode='w')
+        bed.write("chr1\t10\t20\tA\t0\t+\nchr1\t150\t160\tB\t0\t+\n"
+                  "chr1\t170\t180\tC\t0\t-\nchr2\t250\t260\tD\t0\t+\n")
+        bed.close()
+        for proc in [1, 2]:
+            res = mr.mapReduce([], region_exons, self.chrom_sizes,
+                               genomeChunkLength=100, numberOfProcessors=proc,
+                               bedFile=[bed.name])
+            assert_equal(res, [('chr1', 0, [[(10, 20)]]),
+                               ('chr1', 100, [[(150, 160)], [(170, 180)]]),
+                               ('chr2', 200, [[(250, 260)]])])
+        mr.closePool()
+        os.remove(bed.name)
+
+    def test_idle_processors_given_to_tasks(self):
+        # 2 tasks for 8 processors
+        res = mr.mapReduce([], worker_threads, self.chrom_sizes,
+                           genomeChunkLength=2000, numberOfProcessors=8,
+                           executor='threads')
+        assert_equal(res, [3, 3])
+        res = mr.mapReduce([], worker_threads, self.chrom_sizes,
+                           genomeChunkLength=100, numberOfProcessors=8,
+                           executor='threads')
+        assert_equal(res, [0] * 14)
+        mr.closePool()
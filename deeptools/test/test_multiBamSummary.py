@@ -34,3 +34,15 @@ def test_multiBamSummary_metagene():
     nt.assert_allclose(matrix, np.array([[25.0, 25.0],
                                          [31.0, 31.0]]))
     unlink(outfile)
+
+
+def test_multiBamSummary_countsDtype():
+    outfile = '/tmp/_test.npz'
+    args = 'BED-file --BED {0} -b {1} {1} -o {2} --countsDtype uint16'.format(GTF, BAM, outfile).split()
+    mbs.main(args)
+    resp = np.load(outfile)
+    matrix = resp['matrix']
+    assert matrix.dtype == np.uint16
+    nt.assert_equal(matrix, np.array([[144, 144],
+                                      [143, 143]]))
+    unlink(outfile)
@@ -0,0 +1,92 @@
+import os.path
+import itertools
+import zlib
+import numpy as np
+import pysam
+
+from deeptools.readFilter import ReadFilter
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + "/test_data/"
+
+
+def filter_loop(reads, minMappingQuality=None, samFlagInclude=None, samFlagExclude=None,
+                minFragmentLength=0, maxFragmentLength=0, ignoreDuplicates=False,
+                filterRNAstrand=None, fragments=None):
+    """
+    the read by read filters that ReadFilter replaces, the reads for
+    which fragments raises a TypeError are skipped before they are the
+    previous read of the duplicate filter
+    """
+    prev_start_pos = None
+    for read in reads:
+        if minMappingQuality and read.mapq < minMappingQuality:
+            continue
+        if samFlagInclude and read.flag & samFlagInclude != samFlagInclude:
+            continue
+        if samFlagExclude and read.flag & samFlagExclude != 0:
+            continue
+        if minFragmentLength > 0 and abs(read.template_length) < minFragmentLength:
+            continue
+        if maxFragmentLength > 0 and abs(read.template_length) > maxFragmentLength:
+            continue
+        if ignoreDuplicates and prev_start_pos \
+                and prev_start_pos == (read.reference_start, read.pnext, read.is_reverse):
+            continue
+        if fragments is not None:
+            try:
+                fragments(read)
+            except TypeError:
+                continue
+        prev_start_pos = (read.reference_start, read.pnext, read.is_reverse)
+        if read.is_paired:
+            if filterRNAstrand == 'forward':
+                if not ((read.flag & 128 == 128 and read.flag & 16 == 0) or (read.flag & 64 == 64 and read.flag & 32 == 0)):
+                    continue
+            elif filterRNAstrand == 'reverse':
+                if not (read.flag & 144 == 144 or read.flag & 96 == 96):
+                    continue
+        else:
+            if filterRNAstrand == 'forward' and read.flag & 16 == 0:
+                continue
+            elif filterRNAstrand == 'reverse' and read.flag & 16 == 16:
+                continue
+        yield read
+
+
+def test_filter_as_loop():
+    options = [('minMappingQuality', [None, 20]),
+               ('samFlagInclude', [None, 64]),
+               ('samFlagExclude', [None, 16]),
+               ('minFragmentLength', [0, 150]),
+               ('maxFragmentLength', [0, 400]),
+               ('ignoreDuplicates', [False, True]),
+               ('filterRNAstrand', [None, 'forward', 'reverse'])]
+    for bamFile in ["test_paired2.bam", "test_filtering.bam", "test_proper_pair_filtering.bam"]:
+        bam = pysam.AlignmentFile(ROOT + bamFile)
+        for values in itertools.product(*[x[1] for x in options]):
+            kwargs = dict(zip([x[0] for x in options], values))
+            expected = [(r.query_name, r.flag) for r in filter_loop(bam.fetch(), **kwargs)]
+            # small batches, such that duplicates span batches
+            got = [(r.query_name, r.flag) for r in ReadFilter(batchSize=7, **kwargs).filter(bam.fetch())]
+            assert got == expected, kwargs
+
+
+def test_fragments_as_loop():
+    def fragments(read):
+        # about half of the reads have no fragment, as the reads
+        # for which get_fragment_from_read returns None
+        if zlib.crc32(read.query_name.encode()) % 2:
+            raise TypeError
+        return [(read.reference_start, read.reference_end)]
+
+    for bamFile in ["test_paired2.bam", "test_filtering.bam", "test_proper_pair_filtering.bam"]:
+        bam = pysam.AlignmentFile(ROOT + bamFile)
+        for minMappingQuality, ignoreDuplicates in itertools.product([None, 20], [False, True]):
+            kwargs = dict(minMappingQuality=minMappingQuality, ignoreDuplicates=ignoreDuplicates)
+            expected = [(r.query_name, r.flag) for r in filter_loop(bam.fetch(), fragments=fragments, **kwargs)]
+            got = []
+            for reads, mask, blocks in ReadFilter(batchSize=7, **kwargs).batches(bam.fetch(), fragments):
+                for idx in np.flatnonzero(mask):
+                    assert blocks[idx] == fragments(reads[idx])
+                    got.append((reads[idx].query_name, reads[idx].flag))
+            assert got == expected, kwargs
@@ -1,6 +1,8 @@
 from unittest import TestCase
 from nose.tools import *
 import os
+import tempfile
+import pyBigWig
 
 import deeptools.writeBedGraph as wr
 from deeptools.writeBedGraph import scaleCoverage
@@ -47,31 +49,29 @@ class TestWriteBedGraph(TestCase):
         self.c.zerosToNans = False
         self.c.skipZeros = False
 
-        tempFile = self.c.writeBedGraph_worker('3R', 0, 200, scaleCoverage, self.func_args)
-        _foo = open(tempFile, 'r')
-        res = _foo.readlines()
-        _foo.close()
+        res = wr.bedGraphLines(*self.c.writeBedGraph_worker('3R', 0, 200, scaleCoverage, self.func_args))
         assert_equal(res, ['3R\t0\t100\t0.00\n', '3R\t100\t200\t1.00\n'])
-        os.remove(tempFile)
 
     def test_writeBedGraph_worker_zerotonan(self):
         # turn on zeroToNan
         self.c.zerosToNans = True
-        tempFile2 = self.c.writeBedGraph_worker('3R', 0, 200, scaleCoverage, self.func_args)
-        _foo = open(tempFile2, 'r')
-        res = _foo.readlines()
-        _foo.close()
+        res = wr.bedGraphLines(*self.c.writeBedGraph_worker('3R', 0, 200, scaleCoverage, self.func_args))
         assert_equal(res, ['3R\t100\t200\t1.00\n'])
-        os.remove(tempFile2)
 
     def test_writeBedGraph_worker_scaling(self):
         func_args = {'scaleFactor': 3.0}
-        tempFile = self.c.writeBedGraph_worker('3R', 0, 200, scaleCoverage, func_args)
-        _foo = open(tempFile, 'r')
-        res = _foo.readlines()
-        _foo.close()
+        res = wr.bedGraphLines(*self.c.writeBedGraph_worker('3R', 0, 200, scaleCoverage, func_args))
+        assert_equal(res, ['3R\t0\t100\t0.00\n', '3R\t100\t200\t3.00\n'])
+
+    def test_writeBedGraph_worker_per_tile_function(self):
+        # functions that are not marked with tileArray get one tile at a time
+        def per_tile(tile_coverage, args):
+            assert_equal(len(tile_coverage), 1)
+            return args['scaleFactor'] * tile_coverage[0]
+
+        func_args = {'scaleFactor': 3.0}
+        res = wr.bedGraphLines(*self.c.writeBedGraph_worker('3R', 0, 200, per_tile, func_args))
         assert_equal(res, ['3R\t0\t100\t0.00\n', '3R\t100\t200\t3.00\n'])
-        os.remove(tempFile)
 
     def test_writeBedGraph_worker_ignore_duplicates(self):
         self.c = wr.WriteBedGraph([self.bamFile2],
@@ -79,23 +79,33 @@ class TestWriteBedGraph(TestCase):
                                   stepSize=self.step_size, ignoreDuplicates=True)
         self.c.zerosToNans = True
 
-        tempFile = self.c.writeBedGraph_worker('3R', 0, 200, scaleCoverage, self.func_args)
-        _foo = open(tempFile, 'r')
-        res = _foo.readlines()
-        _foo.close()
+        res = wr.bedGraphLines(*self.c.writeBedGraph_worker('3R', 0, 200, scaleCoverage, self.func_args))
         assert_equal(res, ['3R\t50\t200\t1.00\n'])
-        os.remove(tempFile)
 
     def test_writeBedGraph_worker_smoothing(self):
         self.c.binLength = 20
         self.c.stepSize = 20
         self.c.smoothLength = 60
-        tempFile = self.c.writeBedGraph_worker('3R', 100, 200, scaleCoverage, self.func_args)
-        _foo = open(tempFile, 'r')
-        res = _foo.readlines()
-        _foo.close()
+        # as for --region 3R:100:200, the smoothing is not extended
+        # beyond the region
+        self.c.regionStart, self.c.regionEnd = 100, 200
+        res = wr.bedGraphLines(*self.c.writeBedGraph_worker('3R', 100, 200, scaleCoverage, self.func_args))
         assert_equal(res, ['3R\t100\t120\t1.00\n', '3R\t120\t180\t1.33\n', '3R\t180\t200\t1.00\n'])
-        os.remove(tempFile)
+
+    def test_writeBedGraph_worker_smoothing_across_chunks(self):
+        self.c.binLength = 20
+        self.c.stepSize = 20
+        self.c.smoothLength = 60
+        whole = self.c.writeBedGraph_worker('3R', 0, 200, scaleCoverage, self.func_args)
+        split = [self.c.writeBedGraph_worker('3R', 0, 120, scaleCoverage, self.func_args),
+                 self.c.writeBedGraph_worker('3R', 120, 200, scaleCoverage, self.func_args)]
+        # the smoothing at the chunk boundary uses the tiles of both
+        # chunks, as for the whole chromosome
+        assert_equal(wr.bedGraphLines(*whole),
+                     ['3R\t0\t80\t0.00\n', '3R\t80\t100\t0.33\n', '3R\t100\t120\t0.67\n',
+                      '3R\t120\t180\t1.33\n', '3R\t180\t200\t1.00\n'])
+        assert_equal(wr.bedGraphLines(*split[0]) + wr.bedGraphLines(*split[1]),
+                     wr.bedGraphLines(*whole))
 
     def test_writeBedGraph_cigar(self):
         """
@@ -108,10 +118,7 @@ class TestWriteBedGraph(TestCase):
         self.c.extendPairedEnds = False
         self.c.binLength = 10
         self.c.stepSize = 10
-        tempFile = self.c.writeBedGraph_worker('chr_cigar', 0, 100, scaleCoverage, self.func_args)
-        _foo = open(tempFile, 'r')
-        res = _foo.readlines()
-        _foo.close()
+        res = wr.bedGraphLines(*self.c.writeBedGraph_worker('chr_cigar', 0, 100, scaleCoverage, self.func_args))
 
         # the sigle read is split into bin 10-30, and then 40-50
         assert_equal(res, ['chr_cigar\t0\t10\t0.00\n',
@@ -119,4 +126,31 @@ class TestWriteBedGraph(TestCase):
                            'chr_cigar\t30\t40\t0.00\n',
                            'chr_cigar\t40\t50\t1.00\n',
                            'chr_cigar\t50\t100\t0.00\n'])
-        os.remove(tempFile)
+
+    def test_writeBedGraph_bigwig(self):
+        """
+        The bigwig file is written directly and has the same
+        intervals as the bedgraph file.
+        """
+        self.c.numberOfProcessors = 1
+        bg = tempfile.NamedTemporaryFile(suffix='.bg', delete=False)
+        bw = tempfile.NamedTemporaryFile(suffix='.bw', delete=False)
+        bg.close()
+        bw.close()
+        self.c.run(scaleCoverage, self.func_args, bg.name)
+        self.c.run(scaleCoverage, self.func_args, bw.name, format='bigwig')
+
+        expected = []
+        for line in open(bg.name):
+            chrom, start, end, value = line.split()
+            expected.append((chrom, int(start), int(end), float(value)))
+        fh = pyBigWig.open(bw.name)
+        res = []
+        for chrom in fh.chroms():
+            res.extend((chrom,) + interval for interval in fh.intervals(chrom))
+        fh.close()
+        os.remove(bg.name)
+        os.remove(bw.name)
+
+        assert_true(len(res) > 0)
+        assert_equal(sorted(res), sorted(expected))
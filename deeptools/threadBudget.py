@@ -0,0 +1,70 @@
+import os
+import threading
+
+# compressed bytes of a BAM file per decompression thread, smaller
+# files are not worth the threads
+BYTES_PER_THREAD = 2 ** 26
+
+# threads that the task running in the current thread can use, see
+# setWorkerThreads()
+_local = threading.local()
+
+
+def workerThreads(numberOfProcessors, numTasks):
+    """
+    Returns the number of threads, besides its own, that each worker can
+    use when numTasks tasks are run by numberOfProcessors workers: when
+    there are fewer tasks than processors, the processors left idle are
+    shared among the busy workers (e.g. to decompress the BAM files with
+    htslib threads).
+
+    >>> workerThreads(64, 5)
+    11
+    >>> workerThreads(64, 1000)
+    0
+    >>> workerThreads(1, 1)
+    0
+    """
+    workers = max(min(numberOfProcessors, numTasks), 1)
+    return max(numberOfProcessors // workers - 1, 0)
+
+
+def fileThreads(fileName, threads):
+    """
+    Returns how many of the given threads to use to read fileName:
+    at most one per BYTES_PER_THREAD bytes of the file. All of them if
+    the size is unknown (e.g. a URL).
+
+    >>> fileThreads(__file__, 4)
+    0
+    """
+    try:
+        size = os.path.getsize(fileName)
+    except (OSError, TypeError):
+        return threads
+    return int(min(threads, size // BYTES_PER_THREAD))
+
+
+def setWorkerThreads(threads):
+    """
+    Sets the number of extra threads that the task running in the current
+    thread can use. mapReduce sets it for each task, see workerThreads().
+    Returns the previous value.
+    """
+    previous = getWorkerThreads()
+    _local.threads = threads
+    return previous
+
+
+def getWorkerThreads():
+    return getattr(_local, 'threads', 0)
+
+
+def threadsFor(fileName):
+    """
+    The decompression threads to use for fileName in the current task
+    """
+    threads = getWorkerThreads()
+    if threads <= 0:
+        return 0
+    return fileThreads(fileName, threads)
@@ -1,8 +1,9 @@
 import sys
 import os
 import pysam
-from deeptoolsintervals import GTF
 from deeptools.bamHandler import openBam
+from deeptools import mapReduce
+from deeptools import intervalIndex
 
 
 debug = 0
@@ -366,7 +367,7 @@ def bam_blacklisted_reads(bam_handle, chroms_to_ignore, blackListFileName=None,
         chrom, _len, nmapped, _nunmapped = line.split('\t')
         chromLens[chrom] = int(_len)
 
-    bl = GTF(blackListFileName)
+    bl = intervalIndex.getIndex(blackListFileName)
     regions = []
     for chrom in bl.chroms:
         if (not chroms_to_ignore or chrom not in chroms_to_ignore) and chrom in chromLens:
@@ -374,9 +375,8 @@ def bam_blacklisted_reads(bam_handle, chroms_to_ignore, blackListFileName=None,
                 regions.append([bam_handle.filename, chrom, reg[0], reg[1]])
 
     if len(regions) > 0:
-        import multiprocessing
         if len(regions) > 1 and numberOfProcessors > 1:
-            pool = multiprocessing.Pool(numberOfProcessors)
+            pool = mapReduce.getPool(numberOfProcessors)
             res = pool.map_async(bam_blacklisted_worker, regions).get(9999999)
         else:
             res = [bam_blacklisted_worker(x) for x in regions]
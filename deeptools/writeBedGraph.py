@@ -1,15 +1,16 @@
 import os
 import sys
-import shutil
 import numpy as np
 import pyBigWig
 
 # own modules
 from deeptools import mapReduce
+from deeptools import chunkPlanner
 from deeptools.utilities import getCommonChrNames, toBytes
 import deeptools.countReadsPerBin as cr
 from deeptools import bamHandler
-from deeptools import utilities
+from deeptools import fileHandles
+from deeptools import intervalIndex
 from deeptools import config as cfg
 
 debug = 0
@@ -33,10 +34,11 @@ class WriteBedGraph(cr.CountReadsPerBin):
     r"""Reads bam files coverages and writes a bedgraph or bigwig file
 
     Extends the CountReadsPerBin object such that the coverage
-    of bam files is writen to multiple bedgraph files at once.
+    of bam files is computed by several workers at once.
 
-    The bedgraph files are later merge into one and converted
-    into a bigwig file if necessary.
+    Each worker returns the runs of equal value of its part of the
+    genome, which are written to the bedgraph or bigwig file, in
+    genomic order, as soon as they are returned (see CoverageWriter).
 
     The constructor arguments are the same as for CountReadsPerBin. However,
     when calling the `run` method, the following parameters have
@@ -84,12 +86,29 @@ class WriteBedGraph(cr.CountReadsPerBin):
     >>> c.run(function_to_call, funcArgs, outFile.name)
     >>> open(outFile.name, 'r').readlines()
     ['3R\t0\t100\t0.00\n', '3R\t100\t200\t1.50\n']
+
+    The coverage with other bin sizes can be written at the same time,
+    from the same reads
+
+    >>> outFile2 = tempfile.NamedTemporaryFile()
+    >>> c = WriteBedGraph([bam_file], binLength=bin_length, region=region, stepSize=step_size)
+    >>> c.run(function_to_call, funcArgs, outFile.name, additionalOutputs=[(outFile2.name, 100)])
+    >>> open(outFile2.name, 'r').readlines()
+    ['3R\t0\t100\t0.00\n', '3R\t100\t200\t3.00\n']
     >>> outFile.close()
+    >>> outFile2.close()
 
 
     """
 
-    def run(self, func_to_call, func_args, out_file_name, blackListFileName=None, format="bedgraph", smoothLength=0):
+    # the tile sizes of the additional outputs, see run()
+    additionalTileSizes = ()
+    # start and end of the region given by the user, see run()
+    regionStart = 0
+    regionEnd = None
+
+    def run(self, func_to_call, func_args, out_file_name, blackListFileName=None, format="bedgraph", smoothLength=0,
+            additionalOutputs=None):
         r"""
         Given a list of bamfiles, a function and a function arguments,
         this method writes a bedgraph file (or bigwig) file
@@ -113,62 +132,87 @@ class WriteBedGraph(cr.CountReadsPerBin):
         smoothLength : int
             Distance in bp for smoothing the coverage per tile.
 
+        additionalOutputs : list
+            List of (file name, tile size) tuples. The coverage of each
+            of these tile sizes is written to the given file, in the same
+            format. The reads are read once for all the outputs. The tiles
+            of each output are those of a separate run with its tile size,
+            i.e. with a region they start at the region start rounded
+            down to the tile size.
+
 
         """
         self.__dict__["smoothLength"] = smoothLength
+        additionalOutputs = list(additionalOutputs or [])
+        self.__dict__["additionalTileSizes"] = [int(tile_size) for _, tile_size in additionalOutputs]
         bam_handlers = [bamHandler.openBam(x) for x in self.bamFilesList]
         genome_chunk_length = getGenomeChunkLength(bam_handlers, self.binLength)
         # check if both bam files correspond to the same species
         # by comparing the chromosome names:
         chrom_names_and_size, non_common = getCommonChrNames(bam_handlers, verbose=False)
 
+        align = commonTileLength([self.binLength] + self.additionalTileSizes)
+        chunks_region = None
         if self.region:
+            # the chunks start at the region start rounded down to all
+            # the tile sizes, see writeBedGraph_worker
+            region_sizes, region_start = mapReduce.getUserRegion(chrom_names_and_size,
+                                                                 ":".join(self.region.split(":")[:3]))[:2]
+            self.__dict__["regionStart"] = region_start
+            self.__dict__["regionEnd"] = region_sizes[0][1]
+            chunks_region = "{}:{}:{}".format(region_sizes[0][0], region_start - region_start % align,
+                                              region_sizes[0][1])
             # in case a region is used, append the tilesize
             self.region += ":{}".format(self.binLength)
 
         for x in list(self.__dict__.keys()):
             sys.stderr.write("{}: {}\n".format(x, self.__getattribute__(x)))
 
-        res = mapReduce.mapReduce([func_to_call, func_args],
-                                  writeBedGraph_wrapper,
-                                  chrom_names_and_size,
-                                  self_=self,
-                                  genomeChunkLength=genome_chunk_length,
-                                  region=self.region,
-                                  blackListFileName=blackListFileName,
-                                  numberOfProcessors=self.numberOfProcessors)
-
-        # concatenate intermediary bedgraph files
-        out_file = open(out_file_name + ".bg", 'wb')
-        for tempfilename in res:
-            if tempfilename:
-                # concatenate all intermediate tempfiles into one
-                # bedgraph file
-                _foo = open(tempfilename, 'rb')
-                shutil.copyfileobj(_foo, out_file)
-                _foo.close()
-                os.remove(tempfilename)
-
-        bedgraph_file = out_file.name
-        out_file.close()
-        if format == 'bedgraph':
-            os.rename(bedgraph_file, out_file_name)
-            if self.verbose:
-                print("output file: {}".format(out_file_name))
+        # the chunks have similar expected numbers of reads, with
+        # genome_chunk_length as their mean length, and their boundaries
+        # are boundaries of the tiles of all the outputs
+        chunks = chunkPlanner.planChunks(self.bamFilesList, chrom_names_and_size,
+                                         genome_chunk_length,
+                                         alignTo=align,
+                                         region=chunks_region)
+
+        # the runs of each part of the genome are written as soon as
+        # the workers return them, in genomic order
+        writers = [CoverageWriter(file_name, chrom_names_and_size, format)
+                   for file_name in [out_file_name] + [x[0] for x in additionalOutputs]]
+        if len(writers) == 1:
+            consumer = writers[0]
         else:
-            bedGraphToBigWig(
-                chrom_names_and_size, bedgraph_file, out_file_name, True)
+            # the workers return the runs of each output
+            def consumer(results):
+                for writer, runs in zip(writers, results):
+                    writer(runs)
+
+        mapReduce.mapReduce([func_to_call, func_args],
+                            writeBedGraph_wrapper,
+                            chrom_names_and_size,
+                            self_=self,
+                            genomeChunkLength=genome_chunk_length,
+                            region=self.region,
+                            blackListFileName=blackListFileName,
+                            numberOfProcessors=self.numberOfProcessors,
+                            consumer=consumer,
+                            chunks=chunks)
+
+        for writer in writers:
+            writer.close()
             if self.verbose:
-                print("output file: {}".format(out_file_name))
-            os.remove(bedgraph_file)
+                print("output file: {}".format(writer.fileName))
 
     def writeBedGraph_worker(self, chrom, start, end,
                              func_to_call, func_args,
                              bed_regions_list=None):
-        r"""Writes a bedgraph based on the read coverage found on bamFiles
+        r"""Computes the bedgraph values of a region based on the read
+        coverage found on bamFiles
 
         The given func is called to compute the desired bedgraph value
-        using the funcArgs
+        using the funcArgs. Consecutive tiles of equal value are merged
+        into a single run, and the runs of NaN values are skipped.
 
         Parameters
         ----------
@@ -195,7 +239,11 @@ class WriteBedGraph(cr.CountReadsPerBin):
 
         Returns
         -------
-        temporary file with the bedgraph results for the region queried.
+        tuple
+            (chrom, starts, ends, values) of the runs of the region
+            queried, the last three as numpy arrays (see CoverageWriter).
+            With additionalTileSizes, a tuple with the runs of the
+            binLength tiles followed by the runs of each additional size.
 
         Examples
         --------
@@ -207,10 +255,9 @@ class WriteBedGraph(cr.CountReadsPerBin):
         >>> funcArgs = {'scaleFactor': 1.0}
 
         >>> c = WriteBedGraph([bamFile1], bin_length, number_of_samples, stepSize=50)
-        >>> tempFile = c.writeBedGraph_worker( '3R', 0, 200, func_to_call, funcArgs)
-        >>> open(tempFile, 'r').readlines()
+        >>> runs = c.writeBedGraph_worker( '3R', 0, 200, func_to_call, funcArgs)
+        >>> bedGraphLines(*runs)
         ['3R\t0\t100\t0.00\n', '3R\t100\t200\t1.00\n']
-        >>> os.remove(tempFile)
 
 
         """
@@ -218,56 +265,343 @@ class WriteBedGraph(cr.CountReadsPerBin):
             raise NameError("start position ({0}) bigger "
                             "than end position ({1})".format(start, end))
 
-        coverage, _ = self.count_reads_in_region(chrom, start, end)
-
-        _file = open(utilities.getTempFileName(suffix='.bg'), 'w')
-        previous_value = None
-        line_string = "{}\t{}\t{}\t{:.2f}\n"
-        for tileIndex in range(coverage.shape[0]):
-
-            if self.smoothLength is not None and self.smoothLength > 0:
-                vector_start, vector_end = self.getSmoothRange(tileIndex,
-                                                               self.binLength,
-                                                               self.smoothLength,
-                                                               coverage.shape[0])
-                tileCoverage = np.mean(coverage[vector_start:vector_end, :], axis=0)
-            else:
-                tileCoverage = coverage[tileIndex, :]
-
-            value = func_to_call(tileCoverage, func_args)
-            """
-            # uncomment these lines if fixed step bedgraph is required
-            if not np.isnan(value):
-                writeStart = start + tileIndex*self.binLength
-                writeEnd  =  min(writeStart+self.binLength, end)
-                _file.write(line_string.format(chrom, writeStart,
-                                           end, previous_value))
-            """
-
-            if previous_value is None:
-                writeStart = start + tileIndex * self.binLength
-                writeEnd = min(writeStart + self.binLength, end)
-                previous_value = value
-
-            elif previous_value == value:
-                writeEnd = min(writeEnd + self.binLength, end)
-
-            elif previous_value != value:
-                if not np.isnan(previous_value):
-                    _file.write(
-                        line_string.format(chrom, writeStart, writeEnd, previous_value))
-                previous_value = value
-                writeStart = writeEnd
-                writeEnd = min(writeStart + self.binLength, end)
-
-        # write remaining value if not a nan
-        if previous_value is not None and writeStart != end and not np.isnan(previous_value):
-            _file.write(line_string.format(chrom, writeStart,
-                                           end, previous_value))
-
-        tempfilename = _file.name
-        _file.close()
-        return tempfilename
+        tile_sizes = [self.binLength] + list(self.additionalTileSizes)
+        # as in a separate run with each tile size, the tiles start at
+        # the region start rounded down to the tile size
+        tile_starts = [max(start, self.regionStart - self.regionStart % tile_size)
+                       for tile_size in tile_sizes]
+        smooth = self.smoothLength is not None and self.smoothLength > 0
+        fetch_start, fetch_end = start, end
+        if smooth:
+            # the tiles next to the region are counted as well, such
+            # that the smoothing is not truncated at the region edges
+            fetch_start, fetch_end = self.smoothingFlanks(chrom, start, end, tile_sizes)
+
+        if len(tile_sizes) > 1:
+            coverages = self.count_reads_in_tiles(chrom, fetch_start, fetch_end, tile_sizes)
+        else:
+            coverages = [self.count_reads_in_region(chrom, fetch_start, fetch_end)[0]]
+
+        results = []
+        for tile_size, tile_start, coverage in zip(tile_sizes, tile_starts, coverages):
+            # the value functions (e.g. a difference) need signed values
+            coverage = coverage.astype('float64', copy=False)
+
+            if smooth:
+                coverage = smoothTiles(coverage, tile_size, self.smoothLength)
+            first_tile = (tile_start - fetch_start) // tile_size
+            num_tiles = max(end - tile_start, 0) // tile_size
+            coverage = coverage[first_tile:first_tile + num_tiles]
+
+            values = tileValues(func_to_call, coverage, func_args)
+            results.append((chrom,) + tileRuns(values, min(tile_start, end), end, tile_size))
+
+        if len(results) == 1:
+            return results[0]
+        return tuple(results)
+
+    def count_reads_in_tiles(self, chrom, start, end, tileSizes):
+        """
+        Like count_reads_in_region, for tiles of each of the given sizes.
+        Returns a list with the (tiles x bam files) matrix of each tile
+        size. The reads of each bam file are fetched only once.
+
+        >>> test_path = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+        >>> c = WriteBedGraph([test_path + "testA.bam"], binLength=50, stepSize=50)
+        >>> [x[:, 0].tolist() for x in c.count_reads_in_tiles('3R', 0, 200, [50, 100])]
+        [[0.0, 0.0, 1.0, 1.0], [0.0, 2.0]]
+        """
+        per_bam = [self.get_coverage_of_region(fileHandles.openBam(bam), chrom,
+                                               [(start, end, self.binLength)], tileSizes=tileSizes)
+                   for bam in self.bamFilesList]
+        return [cr.castCounts(np.column_stack([coverages[index] for coverages in per_bam]),
+                              self.countsDtype)
+                for index in range(len(tileSizes))]
+
+    def smoothingFlanks(self, chrom, start, end, tileSizes=None):
+        """
+        Returns the region, around start and end, whose tiles are needed
+        to smooth the tiles from start to end (see smoothTiles): the
+        region is extended by whole tiles (of all the tileSizes, by
+        default binLength), up to the chromosome ends or the edges of the
+        region given by the user, thus, only across the boundaries
+        between chunks. It is not extended into blacklisted regions.
+
+        >>> test_path = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+        >>> c = WriteBedGraph([test_path + "testA.bam"], binLength=20, stepSize=20, smoothLength=60)
+        >>> c.smoothingFlanks('3R', 100, 160)
+        (80, 180)
+        >>> c.smoothingFlanks('3R', 10, 190)
+        (10, 200)
+        >>> c.smoothingFlanks('3R', 100, 160, [20, 30])
+        (40, 180)
+        >>> c.regionStart, c.regionEnd = 100, 170
+        >>> c.smoothingFlanks('3R', 100, 160)
+        (100, 170)
+        """
+        if tileSizes is None:
+            tileSizes = [self.binLength]
+        flanks = [smoothingTiles(tile_size, self.smoothLength) for tile_size in tileSizes]
+        left = max(left_tiles * tile_size for tile_size, (left_tiles, _) in zip(tileSizes, flanks))
+        right = max(right_tiles * tile_size for tile_size, (_, right_tiles) in zip(tileSizes, flanks))
+
+        # the left flank is a multiple of all the tile sizes, such that
+        # the tiles of the region are tiles of the extended region
+        align = commonTileLength(tileSizes)
+        # the first chunk starts at the region start rounded down to align
+        first = (start - (self.regionStart - self.regionStart % align)) // align
+        fetch_start = start - max(min(-(-left // align), first), 0) * align
+        bam = fileHandles.openBam(self.bamFilesList[0])
+        fetch_end = min(end + right, bam.get_reference_length(chrom))
+        if self.regionEnd is not None:
+            fetch_end = min(fetch_end, self.regionEnd)
+        fetch_end = max(fetch_end, end)
+
+        if self.blackListFileName is not None:
+            blackList = intervalIndex.getIndex(self.blackListFileName)
+            if fetch_start < start and blackList.findOverlaps(chrom, fetch_start, start):
+                fetch_start = start
+            if fetch_end > end and blackList.findOverlaps(chrom, end, fetch_end):
+                fetch_end = end
+        return fetch_start, fetch_end
+
+
+def commonTileLength(tileSizes):
+    """
+    Returns the least common multiple of the tile sizes
+
+    >>> commonTileLength([10, 25, 50])
+    50
+    >>> commonTileLength([4, 6])
+    12
+    """
+    common = 1
+    for tile_size in tileSizes:
+        a, b = common, int(tile_size)
+        while b:
+            a, b = b, a % b
+        common = common * int(tile_size) // a
+    return common
+
+
+def smoothingTiles(tileSize, smoothLength):
+    """
+    Returns the number of tiles, (left, right), next to each tile that
+    are averaged with it, as in CountReadsPerBin.getSmoothRange.
+
+    >>> smoothingTiles(10, 30)
+    (1, 1)
+    >>> smoothingTiles(10, 40)
+    (2, 1)
+    >>> smoothingTiles(10, 10)
+    (0, 0)
+    """
+    side = float(int(smoothLength / tileSize) - 1) / 2
+    return int(np.ceil(side)), max(int(np.floor(side)), 0)
+
+
+def smoothTiles(coverage, tileSize, smoothLength):
+    """
+    Returns the mean of the coverage of each tile (the rows of coverage)
+    and the tiles next to it, within smoothLength. The range of tiles is
+    the one of CountReadsPerBin.getSmoothRange, truncated at the first and
+    last tile. The means are computed from the cumulative sums of the
+    coverage, thus, the cost does not depend on smoothLength. Only the
+    ranges with NaN or infinite values are averaged one by one.
+
+    >>> smoothTiles(np.array([1., 2., 3., 4.]), 10, 30)
+    array([1.5, 2. , 3. , 3.5])
+    >>> smoothTiles(np.array([[1.], [np.nan], [3.], [4.], [5.]]), 10, 30)[:, 0]
+    array([nan, nan, nan, 4. , 4.5])
+
+    The ranges are those of getSmoothRange
+
+    >>> c = cr.CountReadsPerBin([], 1, 1, 1, 0)
+    >>> cov = np.arange(7.) ** 2
+    >>> all(np.allclose(smoothTiles(cov, 10, w), [cov[slice(*c.getSmoothRange(i, 10, w, 7))].mean()
+    ...                                            for i in range(7)]) for w in (10, 24, 30, 40, 65))
+    True
+    """
+    coverage = np.asarray(coverage, dtype=np.float64)
+    num_tiles = coverage.shape[0]
+    left_tiles, right_tiles = smoothingTiles(tileSize, smoothLength)
+
+    index = np.arange(num_tiles)
+    range_starts = np.maximum(index - left_tiles, 0)
+    range_ends = np.minimum(index + right_tiles + 1, num_tiles)
+    counts = (range_ends - range_starts).reshape((-1,) + (1,) * (coverage.ndim - 1))
+
+    finite = np.isfinite(coverage)
+    cumsum = np.zeros((num_tiles + 1,) + coverage.shape[1:])
+    cumsum[1:] = np.cumsum(np.where(finite, coverage, 0), axis=0)
+    smoothed = (cumsum[range_ends] - cumsum[range_starts]) / counts
+
+    if not finite.all():
+        not_finite = np.zeros(cumsum.shape, dtype=np.int64)
+        not_finite[1:] = np.cumsum(~finite, axis=0)
+        for position in zip(*np.nonzero(not_finite[range_ends] - not_finite[range_starts])):
+            tile = position[0]
+            smoothed[position] = np.mean(coverage[(slice(range_starts[tile], range_ends[tile]),) + position[1:]])
+    return smoothed
+
+
+def tileValues(func, coverage, funcArgs):
+    """
+    Returns the values of func for the coverage of each tile, given as
+    the rows of the coverage matrix (one column per file). None values
+    (func could not compute a value) are returned as NaN.
+
+    The functions marked with tileArray are called once, with the whole
+    matrix. Any other function is called for each tile, with its row.
+
+    >>> tileValues(scaleCoverage, np.array([[1.0], [2.0]]), {'scaleFactor': 2})
+    array([2., 4.])
+    >>> tileValues(lambda x, args: x[0] if x[0] else None, np.array([[1.0], [0.0]]), {})
+    array([ 1., nan])
+    """
+    if getattr(func, 'tileArray', False):
+        return np.asarray(func(coverage, funcArgs), dtype=np.float64)
+    values = [func(tile_coverage, funcArgs) for tile_coverage in coverage]
+    return np.array([np.nan if x is None else x for x in values], dtype=np.float64)
+
+
+def tileArray(func):
+    """
+    Marks func as a value function that computes the values of all the
+    tiles of a region at once: it receives an (nTiles, nSamples) array of
+    coverages and returns the nTiles values (see tileValues). Such
+    functions accept the coverage of a single tile as well, see asTiles().
+    """
+    func.tileArray = True
+    return func
+
+
+def asTiles(tileCoverage):
+    """
+    Returns the coverage given to a tileArray function as a 2D array,
+    with one row per tile, and a function that returns its values in
+    the form expected by the caller: a float for a single tile (a 1D
+    coverage) or the array of values otherwise.
+
+    >>> tiles, result = asTiles([1, 2])
+    >>> tiles
+    array([[1., 2.]])
+    >>> result(tiles[:, 0] + tiles[:, 1])
+    3.0
+    """
+    tiles = np.asarray(tileCoverage, dtype=np.float64)
+    if tiles.ndim == 2:
+        return tiles, lambda values: values
+    return tiles.reshape(1, -1), lambda values: float(values[0])
+
+
+def tileRuns(values, start, end, tileSize):
+    """
+    Merges the consecutive tiles of equal value, from start to end, into
+    runs. The last run ends at end. Returns the (starts, ends, values) arrays of the runs, without
+    the runs of NaN values. The tiles are compared before rounding, as
+    two runs with different values are written as two bedgraph lines
+    even if they are printed with the same two decimals.
+
+    >>> starts, ends, values = tileRuns(np.array([0, 0, 1, np.nan, np.nan, 1]), 100, 275, 30)
+    >>> starts.tolist(), ends.tolist(), values.tolist()
+    ([100, 160, 250], [160, 190, 275], [0.0, 1.0, 1.0])
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.float64))
+    # values[1:] != values[:-1] rather than np.diff, such that equal
+    # infinite values are merged as well
+    boundaries = np.flatnonzero(values[1:] != values[:-1]) + 1
+    first = np.concatenate([[0], boundaries])
+    last = np.concatenate([boundaries, [len(values)]])
+    run_starts = np.minimum(start + first.astype(np.int64) * tileSize, end)
+    run_ends = np.minimum(start + last.astype(np.int64) * tileSize, end)
+    # the last run covers the rest of the region, e.g. the bases at the
+    # end of a chromosome that do not make a whole tile
+    run_ends[-1] = end
+    run_values = values[first]
+    keep = ~np.isnan(run_values) & (run_starts < run_ends)
+    return run_starts[keep], run_ends[keep], run_values[keep]
+
+
+def bedGraphLines(chrom, starts, ends, values, lastDecimals=2):
+    r"""
+    Returns the bedgraph lines of the given runs, with two decimals
+    (lastDecimals for the last run)
+
+    >>> bedGraphLines('chr1', [0, 10], [10, 30], [1, 2.555])
+    ['chr1\t0\t10\t1.00\n', 'chr1\t10\t30\t2.56\n']
+    >>> bedGraphLines('chr1', [0, 10], [10, 30], [1, 2.555], lastDecimals=1)
+    ['chr1\t0\t10\t1.00\n', 'chr1\t10\t30\t2.6\n']
+    """
+    lines = ["%s\t%d\t%d\t%.2f\n" % (chrom, start, end, value)
+             for start, end, value in zip(np.asarray(starts).tolist(), np.asarray(ends).tolist(),
+                                          np.asarray(values, dtype=np.float64).tolist())]
+    if lines and lastDecimals != 2:
+        lines[-1] = "%s\t%d\t%d\t%.*f\n" % (chrom, starts[-1], ends[-1], lastDecimals, values[-1])
+    return lines
+
+
+class CoverageWriter(object):
+    r"""
+    Writes the runs (chrom, starts, ends, values) returned by the workers
+    to a bedgraph or bigwig file, in the order in which they are given,
+    which must be the order of chromSizes and of the positions within
+    each chromosome (i.e. the order of the mapReduce consumer). The
+    bigwig entries are added directly, without an intermediate bedgraph
+    file. Their values are rounded to two decimals, as in the bedgraph
+    files. The runs can have a fifth item, the number of decimals of
+    the last run.
+
+    >>> import tempfile
+    >>> outFile = tempfile.NamedTemporaryFile(suffix='.bw', delete=False)
+    >>> writer = CoverageWriter(outFile.name, [('chr2', 200), ('chr1', 100)], 'bigwig')
+    >>> writer(('chr2', np.array([0, 50]), np.array([50, 200]), np.array([1.0, 2.0 / 3])))
+    >>> writer(('chr1', np.array([10]), np.array([20]), np.array([4.0])))
+    >>> writer.close()
+    >>> bw = pyBigWig.open(outFile.name)
+    >>> bw.intervals('chr2')
+    ((0, 50, 1.0), (50, 200, 0.67...))
+    >>> bw.close()
+    >>> os.remove(outFile.name)
+    """
+
+    def __init__(self, fileName, chromSizes, format="bedgraph"):
+        self.fileName = fileName
+        self.format = format
+        self.entries = 0
+        if format == 'bedgraph':
+            self.fh = open(fileName, 'w')
+        else:
+            self.fh = pyBigWig.open(fileName, "w")
+            assert self.fh is not None
+            # The lack of maxZooms will change the results a bit, perhaps the defaults are better
+            self.fh.addHeader([(chrom, int(size)) for chrom, size in chromSizes], maxZooms=10)
+
+    def __call__(self, runs):
+        chrom, starts, ends, values = runs[:4]
+        lastDecimals = runs[4] if len(runs) > 4 else 2
+        if len(starts) == 0:
+            return
+        self.entries += len(starts)
+        if self.format == 'bedgraph':
+            # all the runs at once
+            self.fh.write("".join(bedGraphLines(chrom, starts, ends, values, lastDecimals)))
+        else:
+            values = np.asarray(values, dtype=np.float64)
+            values = np.append(np.round(values[:-1], 2), np.round(values[-1], lastDecimals))
+            self.fh.addEntries([chrom] * len(starts), np.asarray(starts).tolist(),
+                               ends=np.asarray(ends).tolist(), values=values.tolist())
+
+    def close(self):
+        self.fh.close()
+        if self.format != 'bedgraph' and self.entries == 0:
+            sys.stderr.write(
+                "Error: The generated bigwig file was empty. Please adjust\n"
+                "your deepTools settings and check your input files.\n")
+            exit(1)
 
 
 def bedGraphToBigWig(chromSizes, bedGraphPath, bigWigPath, sort=True):
@@ -309,7 +643,7 @@ def bedGraphToBigWig(chromSizes, bedGraphPath, bigWigPath, sort=True):
         bedGraphPath = tempfilename1
 
     bw = pyBigWig.open(bigWigPath, "w")
-    assert(bw is not None)
+    assert bw is not None
     # The lack of maxZooms will change the results a bit, perhaps the defaults are better
     bw.addHeader(cl, maxZooms=10)
     for line in open(bedGraphPath):
@@ -344,15 +678,22 @@ def getGenomeChunkLength(bamHandlers, tile_size):
     return genomeChunkLength
 
 
+@tileArray
 def scaleCoverage(tile_coverage, args):
     """
-    tileCoverage should be an list with only one element
+    tileCoverage should have only one column (one element per tile)
+
+    >>> scaleCoverage(np.array([[1.0], [2.0]]), {'scaleFactor': 0.5})
+    array([0.5, 1. ])
     """
-    return args['scaleFactor'] * tile_coverage[0]
+    tiles, result = asTiles(tile_coverage)
+    return result(args['scaleFactor'] * tiles[:, 0])
 
 
+@tileArray
 def ratio(tile_coverage, args):
     """
-    tileCoverage should be an list of two elements
+    tileCoverage should have two columns (two elements per tile)
     """
-    return float(tile_coverage[0]) / tile_coverage[1]
+    tiles, result = asTiles(tile_coverage)
+    return result(tiles[:, 0] / tiles[:, 1])
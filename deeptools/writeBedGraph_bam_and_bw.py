@@ -1,9 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import os
-import shutil
-import tempfile
 import numpy as np
 
 # NGS packages
@@ -11,9 +8,10 @@ import pyBigWig
 
 # own module
 from deeptools import mapReduce
-from deeptools.utilities import getCommonChrNames, toBytes
+from deeptools.utilities import getCommonChrNames
 from deeptools.writeBedGraph import *
 from deeptools import bamHandler
+from deeptools import fileHandles
 
 old_settings = np.seterr(all='ignore')
 
@@ -46,12 +44,16 @@ def writeBedGraph_worker(
         bamOrBwFileList, func, funcArgs, extendPairedEnds=True, smoothLength=0,
         missingDataAsZero=False, fixed_step=False):
     r"""
-    Writes a bedgraph having as base a number of bam files.
+    Computes the bedgraph values of a region having as base a number
+    of bam files.
 
     The given func is called to compute the desired bedgraph value
     using the funcArgs
 
     tileSize
+
+    Returns the (chrom, starts, ends, values, lastDecimals) runs of the
+    region, see CoverageWriter.
     """
     if start > end:
         raise NameError("start position ({0}) bigger than "
@@ -61,89 +63,47 @@ def writeBedGraph_worker(
 
     for indexFile, fileFormat in bamOrBwFileList:
         if fileFormat == 'bam':
-            bamHandle = bamHandler.openBam(indexFile)
+            bamHandle = fileHandles.openBam(indexFile)
             coverage.append(getCoverageFromBam(
                 bamHandle, chrom, start, end, tileSize,
                 defaultFragmentLength, extendPairedEnds,
                 True))
-            bamHandle.close()
         elif fileFormat == 'bigwig':
-            bigwigHandle = pyBigWig.open(indexFile)
+            bigwigHandle = fileHandles.openBigWig(indexFile)
             coverage.append(
                 getCoverageFromBigwig(
                     bigwigHandle, chrom, start, end,
                     tileSize, missingDataAsZero))
-            bigwigHandle.close()
-
-    # is /dev/shm available?
-    # working in this directory speeds the process
-    try:
-        _file = tempfile.NamedTemporaryFile(dir="/dev/shm", delete=False)
-    except OSError:
-        _file = tempfile.NamedTemporaryFile(delete=False)
 
-    previousValue = None
     lengthCoverage = len(coverage[0])
-    for tileIndex in range(lengthCoverage):
-
-        tileCoverage = []
-        for index in range(len(bamOrBwFileList)):
-            if smoothLength > 0:
-                vectorStart, vectorEnd = getSmoothRange(
-                    tileIndex, tileSize, smoothLength, lengthCoverage)
-                tileCoverage.append(
-                    np.mean(coverage[index][vectorStart:vectorEnd]))
-            else:
-                try:
-                    tileCoverage.append(coverage[index][tileIndex])
-                except IndexError:
-                    print("Chromosome {} probably not in one of the bigwig "
-                          "files. Remove this chromosome from the bigwig file "
-                          "to continue".format(chrom))
-                    exit(0)
-
-#        if  zerosToNans == True and sum(tileCoverage) == 0.0:
-#            continue
-
-        value = func(tileCoverage, funcArgs)
-
-        if fixed_step:
-            writeStart = start + tileIndex * tileSize
-            writeEnd = min(writeStart + tileSize, end)
-            try:
-                _file.write(toBytes("%s\t%d\t%d\t%.2f\n" % (chrom, writeStart,
-                                                            writeEnd, value)))
-            except TypeError:
-                _file.write(toBytes("{}\t{}\t{}\t{}\n".format(chrom, writeStart,
-                                                              writeEnd, value)))
-        else:
-            if previousValue is None:
-                writeStart = start + tileIndex * tileSize
-                writeEnd = min(writeStart + tileSize, end)
-                previousValue = value
-
-            elif previousValue == value:
-                writeEnd = min(writeEnd + tileSize, end)
-
-            elif previousValue != value:
-                if not np.isnan(previousValue):
-                    _file.write(
-                        toBytes("{0}\t{1}\t{2}\t{3:.2f}\n".format(chrom, writeStart,
-                                                                  writeEnd, previousValue)))
-                previousValue = value
-                writeStart = writeEnd
-                writeEnd = min(writeStart + tileSize, end)
-
-    if not fixed_step:
-        # write remaining value if not a nan
-        if previousValue and writeStart != end and \
-                not np.isnan(previousValue):
-            _file.write(toBytes("{0}\t{1}\t{2}\t{3:.1f}\n".format(chrom, writeStart,
-                                                                  end, previousValue)))
-
-    tempFileName = _file.name
-    _file.close()
-    return(tempFileName)
+    # one row per tile, one column per file
+    tileCoverage = np.zeros((lengthCoverage, len(bamOrBwFileList)))
+    for index in range(len(bamOrBwFileList)):
+        if len(coverage[index]) < lengthCoverage:
+            print("Chromosome {} probably not in one of the bigwig "
+                  "files. Remove this chromosome from the bigwig file "
+                  "to continue".format(chrom))
+            exit(0)
+        tileCoverage[:, index] = coverage[index][:lengthCoverage]
+
+    if smoothLength > 0:
+        tileCoverage = smoothTiles(tileCoverage, tileSize, smoothLength)
+
+    values = tileValues(func, tileCoverage, funcArgs)
+
+    if fixed_step:
+        starts = start + np.arange(lengthCoverage, dtype=np.int64) * tileSize
+        ends = np.minimum(starts + tileSize, end)
+        return chrom, starts, ends, values
+
+    starts, ends, runValues = tileRuns(values, start, end, tileSize)
+    if len(starts) and values[-1] == 0 and ends[-1] == end:
+        # the last run is not written when its value is zero
+        starts, ends, runValues = starts[:-1], ends[:-1], runValues[:-1]
+
+    # the last run of the region is written with one decimal
+    lastDecimals = 1 if len(starts) and ends[-1] == end else 2
+    return chrom, starts, ends, runValues, lastDecimals
 
 
 def writeBedGraph(
@@ -201,36 +161,21 @@ def writeBedGraph(
         # in case a region is used, append the tilesize
         region += ":{}".format(tileSize)
 
-    res = mapReduce.mapReduce((tileSize, fragmentLength, bamOrBwFileList,
-                               func, funcArgs, extendPairedEnds, smoothLength,
-                               missingDataAsZero, fixed_step),
-                              writeBedGraph_wrapper,
-                              chromNamesAndSize,
-                              genomeChunkLength=genomeChunkLength,
-                              region=region,
-                              blackListFileName=blackListFileName,
-                              numberOfProcessors=numberOfProcessors)
-
-    # concatenate intermediary bedgraph files
-    outFile = open(outputFileName + ".bg", 'wb')
-    for tempFileName in res:
-        if tempFileName:
-            # concatenate all intermediate tempfiles into one
-            # bedgraph file
-            _foo = open(tempFileName, 'rb')
-            shutil.copyfileobj(_foo, outFile)
-            _foo.close()
-            os.remove(tempFileName)
-
-    bedGraphFile = outFile.name
-    outFile.close()
-    if format == 'bedgraph':
-        os.rename(bedGraphFile, outputFileName)
-        if debug:
-            print("output file: %s" % (outputFileName))
-    else:
-        bedGraphToBigWig(
-            chromNamesAndSize, bedGraphFile, outputFileName, True)
-        if debug:
-            print("output file: %s" % (outputFileName))
-        os.remove(bedGraphFile)
+    # the runs of each part of the genome are written as soon as
+    # the workers return them, in genomic order
+    writer = CoverageWriter(outputFileName, chromNamesAndSize, format)
+
+    mapReduce.mapReduce((tileSize, fragmentLength, bamOrBwFileList,
+                         func, funcArgs, extendPairedEnds, smoothLength,
+                         missingDataAsZero, fixed_step),
+                        writeBedGraph_wrapper,
+                        chromNamesAndSize,
+                        genomeChunkLength=genomeChunkLength,
+                        region=region,
+                        blackListFileName=blackListFileName,
+                        numberOfProcessors=numberOfProcessors,
+                        consumer=writer)
+
+    writer.close()
+    if debug:
+        print("output file: %s" % (outputFileName))